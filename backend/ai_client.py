@@ -1,19 +1,129 @@
-# back end/ ai_client.py
+# backend/ai_client.py
+#
+# Accesso al motore di segmentazione con la stessa interfaccia in due modalità (AI_MODE):
+#   http      microservizio separato (uvicorn ai_microservice.ai_api:app --port 9000), default
+#   embedded  motore caricato dentro il processo backend: niente hop HTTP in loopback né
+#             serializzazioni JSON/base64 in più (installazioni su un solo host)
+# Le risposte hanno status_code, json() e content come quelle di httpx, così chi chiama
+# (main.py, coord_optimizer.py) non sa quale modalità è attiva.
+
+import asyncio
+import json
+import os
 import httpx
-from schemas import AIRequest
-
-async def call_ai_segmenta(image_b64: str, lat: float, lng: float, crop_width: int = None, crop_height: int = None, zoom: int = None):
-    url = "http://localhost:9000/segmenta_ai"
-    req = {
-        "image": image_b64,
-        "lat": lat,
-        "lng": lng,
-        "crop_width": crop_width,
-        "crop_height": crop_height,
-        "zoom": zoom,
-    }
-    # Elimina None prima di inviare
-    req = {k: v for k, v in req.items() if v is not None}
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(url, json=req)
-        return resp.json()
+
+AI_MODE = os.getenv("AI_MODE", "http")
+AI_URL = os.getenv("AI_URL", "http://localhost:9000")
+
+
+class AIResult:
+    """Risposta del motore: corpo già decodificato (embedded) o byte JSON (http)."""
+
+    def __init__(self, status_code: int, data=None, content: bytes = None):
+        self.status_code = status_code
+        self._data = data
+        self._content = content
+
+    def json(self):
+        if self._data is None:
+            self._data = json.loads(self._content)
+        return self._data
+
+    @property
+    def content(self) -> bytes:
+        if self._content is None:
+            # Stessa serializzazione di JSONResponse
+            self._content = json.dumps(self._data, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        return self._content
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"Motore AI: status {self.status_code}")
+
+
+def _meta(meta: dict) -> dict:
+    return {k: v for k, v in meta.items() if v is not None}
+
+
+class HTTPAIClient:
+    def __init__(self, base_url: str = AI_URL):
+        self.base_url = base_url.rstrip("/")
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
+            timeout=httpx.Timeout(60.0),
+        )
+
+    async def start(self):
+        pass
+
+    async def segmenta(self, image_b64: str, meta: dict) -> AIResult:
+        res = await self._client.post(f"{self.base_url}/segmenta_ai", json=dict(_meta(meta), image=image_b64))
+        return AIResult(res.status_code, content=res.content)
+
+    async def segmenta_bin(self, data: bytes, meta: dict, content_type: str = "image/jpeg") -> AIResult:
+        res = await self._client.post(
+            f"{self.base_url}/segmenta_ai_bin", content=data,
+            headers={"Content-Type": content_type}, params=_meta(meta),
+        )
+        return AIResult(res.status_code, content=res.content)
+
+    async def status(self) -> AIResult:
+        res = await self._client.get(f"{self.base_url}/status")
+        return AIResult(res.status_code, content=res.content)
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+class EmbeddedAIClient:
+    """Motore in-process: stesso percorso delle rotte di ai_api (batching, cache, registry)."""
+
+    def __init__(self):
+        self._api = None
+        self._background = set()
+
+    async def start(self):
+        # Import pesante (torch, transformers) solo in questa modalità; il modello si carica
+        # in background come nel microservizio, intanto le richieste ricevono 503
+        from ai_microservice import ai_api
+        self._api = ai_api
+        await ai_api.start_service()
+        print(f"[AI] motore embedded avviato (backend {ai_api.common.INFERENCE_BACKEND})")
+
+    async def _run(self, decode, payload, meta) -> AIResult:
+        if self._api is None:
+            return AIResult(503, {"errore": "Motore AI non avviato"})
+        from fastapi import BackgroundTasks
+        tasks = BackgroundTasks()
+        status, body = await self._api.segmenta_request(decode, payload, _meta(meta), tasks)
+        if tasks.tasks:
+            # Persistenza della cache su disco dopo la risposta, come farebbe FastAPI
+            t = asyncio.create_task(tasks())
+            self._background.add(t)
+            t.add_done_callback(self._background.discard)
+        return AIResult(status, body)
+
+    async def segmenta(self, image_b64: str, meta: dict) -> AIResult:
+        return await self._run(self._api.common.decode_image if self._api else None, image_b64, meta)
+
+    async def segmenta_bin(self, data: bytes, meta: dict, content_type: str = "image/jpeg") -> AIResult:
+        return await self._run(self._api.common.decode_image_bytes if self._api else None, data, meta)
+
+    async def status(self) -> AIResult:
+        if self._api is None:
+            return AIResult(503, {"errore": "Motore AI non avviato"})
+        return AIResult(200, await self._api.status())
+
+    async def aclose(self):
+        if self._api is not None:
+            await asyncio.gather(*self._background, return_exceptions=True)
+            await self._api.stop_service()
+            self._api = None
+
+
+if AI_MODE == "embedded":
+    ai = EmbeddedAIClient()
+elif AI_MODE == "http":
+    ai = HTTPAIClient(AI_URL)
+else:
+    raise ValueError(f"AI_MODE non valido: {AI_MODE} (http | embedded)")
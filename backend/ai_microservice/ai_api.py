@@ -1,138 +1,444 @@
 # backend/ai_microservice/ai_api.py
 
-from fastapi import FastAPI, BackgroundTasks
+import time
+_T_IMPORT = time.perf_counter()  # import leggeri: torch e transformers arrivano con engine in _bootstrap
+
+from fastapi import FastAPI, BackgroundTasks, Request
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from io import BytesIO
-import base64
-from PIL import Image
-import torch
-import numpy as np
-from transformers import SegformerForSemanticSegmentation, SegformerFeatureExtractor
-import cv2
+from typing import Optional
+import asyncio
 import os
-from datetime import datetime
-
-# Abilita autotuning delle convoluzioni (utile quando le dimensioni input si ripetono)
-torch.backends.cudnn.benchmark = True
-
-# ======= MAPPING CLASSI CVAT =======
-CVAT_CLASSES = [
-    {"id": 0, "label": "background",           "color": "#000000"},
-    {"id": 1, "label": "Stalli AT",            "color": "#FFA07A"},
-    {"id": 2, "label": "Locale AT/MT",         "color": "#FFE082"},
-    {"id": 3, "label": "Parcheggio",           "color": "#B39DDB"},
-    {"id": 4, "label": "Zona libera/Verde",    "color": "#B2DFDB"},
-    {"id": 5, "label": "arrivo AT",            "color": "#F48FB1"},
-    {"id": 6, "label": "Strada",               "color": "#F8BBD0"}
-]
-ID_TO_CLASS = {c["id"]: c for c in CVAT_CLASSES}
-PALETTE = {c["id"]: tuple(int(c["color"].lstrip("#")[i:i+2], 16) for i in (0, 2, 4)) for c in CVAT_CLASSES}
-
-# Percorsi modello e output
-MODEL_PATH = r"..\segformer\segformer_finetuned"
+from . import common
+from .batching import MicroBatcher
+from .executor import InferenceExecutor
+from .cache import ResultCache
+from . import postprocess
+from . import encodings
+from .georef import georef_params
+from .tta import parse_tta
+from mercator import latlng_to_global_px
+from .overlay_writer import OverlayWriter
+from .lifecycle import StartupState
+from .registry import ModelRegistry
+
+startup = StartupState()
+startup.record("import", time.perf_counter() - _T_IMPORT)
+
+# Percorso output
 OUTPUT_DIR = r"ai_microservice\output"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-print("Caricamento modello e feature_extractor...")
-model = SegformerForSemanticSegmentation.from_pretrained(MODEL_PATH)
-feature_extractor = SegformerFeatureExtractor.from_pretrained(MODEL_PATH)
-model.eval()
+# Overlay di debug: off | errors (richieste fallite o senza poligoni) | all, con campionamento
+OVERLAY_MODE = os.getenv("AI_OVERLAY_MODE", "all")
+OVERLAY_SAMPLE_RATE = float(os.getenv("AI_OVERLAY_SAMPLE_RATE", "1.0"))
+OVERLAY_QUEUE = int(os.getenv("AI_OVERLAY_QUEUE", "32"))
+
+# Micro-batching: finestra di raccolta (ms) e dimensione massima del batch
+BATCH_WINDOW_MS = float(os.getenv("AI_BATCH_WINDOW_MS", "10"))
+BATCH_MAX_SIZE = int(os.getenv("AI_BATCH_MAX_SIZE", "8"))
+
+# Pool di inferenza: "thread" (modello condiviso) oppure "process" (un modello per processo)
+INFERENCE_POOL = os.getenv("AI_INFERENCE_POOL", "thread")
+INFERENCE_WORKERS = int(os.getenv("AI_INFERENCE_WORKERS", "2"))
+# Modalità process: thread torch per worker (0 = core disponibili / worker) e pesi
+# memory-mapped condivisi, per scalare sui core senza moltiplicare la RSS
+TORCH_THREADS_PER_WORKER = int(os.getenv("AI_TORCH_THREADS_PER_WORKER", "0"))
+SHARED_WEIGHTS = os.getenv("AI_SHARED_WEIGHTS", "1") == "1"
+
+# Versione candidata opzionale caricata dopo l'avvio, con la quota di traffico che riceve
+CANARY_MODEL_PATH = os.getenv("AI_CANARY_MODEL_PATH", "")
+CANARY_SHARE = float(os.getenv("AI_CANARY_SHARE", "0.1"))
+
+# Warmup all'avvio: lati delle crop tipiche (px) e numero di passate
+WARMUP_SIZES = [int(v) for v in os.getenv("AI_WARMUP_SIZES", "500").split(",") if v.strip()]
+WARMUP_PASSES = int(os.getenv("AI_WARMUP_PASSES", "1"))
+
+if INFERENCE_POOL == "process":
+    torch_threads = TORCH_THREADS_PER_WORKER or max(1, (os.cpu_count() or 1) // INFERENCE_WORKERS)
+    # I processi partono al primo warmup di _load_and_warm, dopo l'eventuale conversione
+    # a safetensors; ognuno importa il motore e carica il suo modello
+    executor = InferenceExecutor(
+        "process",
+        INFERENCE_WORKERS,
+        initializer=common.init_pool_worker,
+        initargs=(torch_threads, SHARED_WEIGHTS),
+        info={"torch_threads_per_worker": torch_threads, "shared_weights": SHARED_WEIGHTS},
+    )
+else:
+    # Il modello si carica in background all'avvio (vedi _bootstrap), non all'import
+    executor = InferenceExecutor("thread", INFERENCE_WORKERS)
+
+# Cache dei risultati: voci e MB massimi in memoria (0 voci = disattivata), cartella
+# opzionale per la persistenza su disco tra un riavvio e l'altro
+CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "512"))
+CACHE_MAX_MB = float(os.getenv("AI_CACHE_MAX_MB", "64"))
+CACHE_DIR = os.getenv("AI_CACHE_DIR", "")
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model.to(device)
-# Usa FP16 su GPU per inferenza più veloce/leggera
-if device.type == "cuda":
-    model.half()
+result_cache = ResultCache(CACHE_MAX_ENTRIES, int(CACHE_MAX_MB * 1024 * 1024), persist_dir=CACHE_DIR)
+
+overlay_writer = OverlayWriter(OUTPUT_DIR, OVERLAY_MODE, OVERLAY_SAMPLE_RATE, OVERLAY_QUEUE)
 
 app = FastAPI()
 
 class SegmentRequest(BaseModel):
     image: str  # base64-encoded JPEG/PNG
+    lat: Optional[float] = None
+    lng: Optional[float] = None
+    zoom: Optional[float] = None
+    bearing: Optional[float] = None
+    crop_width: Optional[int] = None
+    crop_height: Optional[int] = None
+    format: Optional[str] = None  # json | delta | varint | rle | png | geo, separati da virgola
+    tta: Optional[str] = None  # flip | rot | d4 o elenco di trasformazioni (vedi tta.py)
+    session: Optional[str] = None  # iterazioni sulla stessa zona: logits riusati (vedi incremental.py)
+
+class ModelLoadRequest(BaseModel):
+    path: str
+    backend: Optional[str] = None
+    role: str = "candidate"  # candidate | active
+    canary_share: Optional[float] = None
+
+class CanaryRequest(BaseModel):
+    share: float
+
+async def _run_batch(items):
+    # Ogni elemento è (spec del modello, immagine, tta): un forward pass per versione e TTA
+    groups = {}
+    for i, (spec, _, tta) in enumerate(items):
+        groups.setdefault((spec, tta), []).append(i)
+    preds = [None] * len(items)
+    for (spec, tta), idx in groups.items():
+        out = await executor.run(engine.infer_batch, [items[i][1] for i in idx], spec, tta)
+        for i, pred in zip(idx, out):
+            preds[i] = pred
+    return preds
+
+batcher = MicroBatcher(
+    _run_batch,
+    max_batch_size=BATCH_MAX_SIZE,
+    window_ms=BATCH_WINDOW_MS,
+    max_inflight=INFERENCE_WORKERS,
+)
+
+# Motore (torch, transformers, modello): importato in background da _bootstrap, così il
+# processo risponde a /healthz prima dell'import. Le rotte di inferenza lo usano solo a
+# servizio pronto.
+engine = None
+
+def _import_engine():
+    global engine
+    if engine is None:
+        from . import engine as _engine
+        engine = _engine
+    return engine
+
+async def _load_and_warm(spec):
+    """Carica e scalda una versione del modello senza fermare quella che sta servendo."""
+    await asyncio.to_thread(_import_engine)
+    if INFERENCE_POOL == "process":
+        if SHARED_WEIGHTS:
+            from .weights import ensure_safetensors
+            await asyncio.to_thread(ensure_safetensors, spec[1])
+        # Un warmup per worker: ogni processo carica la versione al primo uso
+        timings = await executor.run_all(engine.warmup, WARMUP_SIZES, WARMUP_PASSES, spec)
+        return {k: max(t[k] for t in timings) for k in ("model_load", "warmup")}
+    return await asyncio.to_thread(engine.warmup, WARMUP_SIZES, WARMUP_PASSES, spec)
 
-def overlay_mask_on_image(image, pred, alpha=0.45):
-    image = np.array(image.convert("RGB"))
-    mask_rgb = np.zeros_like(image)
-    for k, rgb in PALETTE.items():
-        mask_rgb[pred == k] = rgb
-    overlay = (image * (1 - alpha) + mask_rgb * alpha).astype(np.uint8)
-    return overlay
+async def _unload(version):
+    # In modalità process i worker scaricano comunque le versioni in eccesso (LRU)
+    if INFERENCE_POOL != "process":
+        await asyncio.to_thread(engine.unload_model, version)
+
+registry = ModelRegistry(_load_and_warm, _unload, canary_share=CANARY_SHARE)
+
+async def _load_candidate(path, backend_name=None, role="candidate", canary_share=None):
+    try:
+        await registry.load(common.model_spec(path, backend_name or common.INFERENCE_BACKEND), role, canary_share)
+    except Exception as e:
+        print("ERRORE caricamento modello:", e)
+
+async def _bootstrap():
+    """Caricamento modello e warmup in background: il servizio risponde subito a /healthz."""
+    try:
+        with startup.phase("engine_import"):
+            await asyncio.to_thread(_import_engine)
+        # "model": caricamento più warmup, in modalità process di tutti i worker
+        with startup.phase("model"):
+            await registry.load(common.model_spec(), role="active")
+        info = registry.snapshot()["versions"][registry.active]
+        startup.record("model_load", info["model_load_s"])
+        startup.record("warmup", info["warmup_s"])
+        startup.mark_ready()
+    except Exception as e:
+        startup.mark_failed(e)
+        return
+    if CANARY_MODEL_PATH:
+        await _load_candidate(CANARY_MODEL_PATH)
+
+_bootstrap_task = None
+
+async def start_service():
+    """Avvio del motore: usato dalla FastAPI qui sotto e dal backend in modalità embedded."""
+    global _bootstrap_task
+    batcher.start()
+    overlay_writer.start()
+    _bootstrap_task = asyncio.create_task(_bootstrap())
+
+async def stop_service():
+    await batcher.stop()
+    executor.shutdown()
+    overlay_writer.stop()
+
+@app.on_event("startup")
+async def _start_batcher():
+    await start_service()
+
+@app.on_event("shutdown")
+async def _stop_batcher():
+    await stop_service()
+
+@app.get("/healthz")
+async def healthz():
+    # Liveness: il processo risponde, qualunque sia la fase di avvio
+    return {"status": "ok", "startup": startup.snapshot()}
+
+@app.get("/readyz")
+async def readyz():
+    # Readiness: modello caricato e warmup completato
+    if not startup.ready:
+        return JSONResponse(status_code=503, content={"ready": False, "startup": startup.snapshot()})
+    return {"ready": True, "startup": startup.snapshot()}
+
+def _not_ready():
+    return JSONResponse(
+        status_code=503,
+        headers={"Retry-After": "5"},
+        content={"errore": "Modello in caricamento", "startup": startup.snapshot()},
+    )
+
+async def _session_stats():
+    # In modalità process le sessioni vivono nei worker: statistiche sommate su tutti
+    if engine is None:
+        return None
+    if INFERENCE_POOL != "process":
+        return engine.sessions.stats()
+    try:
+        per_worker = await asyncio.wait_for(executor.run_all(engine.session_stats), timeout=2.0)
+    except asyncio.TimeoutError:
+        return {"errore": "worker occupati"}
+    hits = sum(s["hits"] for s in per_worker)
+    requests = hits + sum(s["misses"] for s in per_worker)
+    weighted = sum(s["mean_inferred_fraction"] * (s["hits"] + s["misses"])
+                   for s in per_worker if s["mean_inferred_fraction"] is not None)
+    return {
+        "sessions": sum(s["sessions"] for s in per_worker),
+        "hits": hits,
+        "misses": requests - hits,
+        "mean_inferred_fraction": round(weighted / requests, 3) if requests else None,
+        "per_worker": per_worker,
+    }
 
-def save_overlay(img, pred, out_dir: str = OUTPUT_DIR):
+@app.get("/status")
+async def status():
+    return {
+        "startup": startup.snapshot(),
+        "backend": common.INFERENCE_BACKEND,
+        "batching": batcher.stats(),
+        "executor": executor.stats(),
+        "cache": result_cache.stats(),
+        "sessions": await _session_stats(),
+        # Soglia della finestra scorrevole: il backend ci allarga i mosaici di area.py
+        "tiling": {"min_side": engine.tiling.TILE_MIN_SIDE, "tile_size": engine.tiling.TILE_SIZE}
+        if engine is not None else None,
+        "overlay": overlay_writer.stats(),
+        "model_version": registry.active,
+        "models": registry.snapshot(),
+    }
+
+@app.get("/models")
+async def models():
+    return registry.snapshot()
+
+@app.post("/models/load", status_code=202)
+async def models_load(req: ModelLoadRequest):
+    # Caricamento e warmup in background; lo stato si segue su GET /models
+    if not os.path.isdir(req.path):
+        return JSONResponse(status_code=400, content={"errore": f"Cartella modello inesistente: {req.path}"})
+    if req.role not in ("active", "candidate"):
+        return JSONResponse(status_code=400, content={"errore": f"Ruolo non valido: {req.role}"})
+    spec = common.model_spec(req.path, req.backend or common.INFERENCE_BACKEND)
+    asyncio.create_task(_load_candidate(req.path, req.backend, req.role, req.canary_share))
+    return {"version": spec[0], "role": req.role, "status": "loading"}
+
+@app.post("/models/promote")
+async def models_promote(version: Optional[str] = None):
+    try:
+        return await registry.promote(version)
+    except ValueError as e:
+        return JSONResponse(status_code=409, content={"errore": str(e)})
+
+@app.post("/models/rollback")
+async def models_rollback():
+    try:
+        return await registry.rollback()
+    except ValueError as e:
+        return JSONResponse(status_code=409, content={"errore": str(e)})
+
+@app.post("/models/canary")
+async def models_canary(req: CanaryRequest):
+    return registry.set_canary(req.share)
+
+def _float_or_none(v):
+    try:
+        return float(v) if v is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def _session_window(session, img):
+    """(angolo, dimensione) della crop in pixel globali se la richiesta può usare i logits della sessione."""
+    if session is None or None in (session["lat"], session["lng"], session["zoom"]):
+        return None
+    if session["bearing"] or engine.tiling.use_tiling(img):
+        return None  # crop ruotata o finestra scorrevole: forward completo
+    extent = (session["crop_width"] or img.width, session["crop_height"] or img.height)
+    cx, cy = latlng_to_global_px(session["lat"], session["lng"], session["zoom"])
+    return (float(cx) - extent[0] / 2, float(cy) - extent[1] / 2), extent
+
+async def _run_cpu(fn, *args):
     """
-    Scrive l'overlay su disco. Funzione 'stateless' così può essere lanciata in background
-    senza interferenze con la risposta HTTP.
+    Decodifica e codifica della risposta: nel pool in modalità thread, in un thread di
+    questo processo in modalità process. Così l'immagine passa ai worker una volta sola
+    (per l'inferenza) e torna indietro solo la mappa di classi.
     """
-    base_name = datetime.now().strftime("%Y%m%d")
-    prog = 1
-    while True:
-        out_name = f"{base_name}_{prog}.jpg"
-        out_path = os.path.join(out_dir, out_name)
-        if not os.path.exists(out_path):
-            break
-        prog += 1
-    overlay_img = overlay_mask_on_image(img, pred)
-    Image.fromarray(overlay_img).save(out_path)
-    print(f"[SALVATO] Overlay maschera: {out_path}")
+    if INFERENCE_POOL == "process":
+        return await asyncio.to_thread(fn, *args)
+    return await executor.run(fn, *args)
 
-@app.post("/segmenta_ai")
-async def segmenta_ai(req: SegmentRequest, background_tasks: BackgroundTasks):
+async def _segmenta(decode, payload, background_tasks: BackgroundTasks, zoom=None, lat=None, formats=None, geo=None, tta=None, session=None):
+    img = None
+    # Versione del modello scelta all'ingresso: la richiesta la usa fino in fondo anche se
+    # nel frattempo avviene uno scambio
+    spec = registry.pick()
+    version = spec[0]
     try:
-        print("\n--- DEBUG ---\nRicevuta immagine base64 di lunghezza:", len(req.image))
-        header, encoded = req.image.split(',', 1)
-        img = Image.open(BytesIO(base64.b64decode(encoded))).convert("RGB")
-        print("Immagine decodificata, shape:", img.size)
-
-        # Preprocessing
-        inputs = feature_extractor(images=img, return_tensors="pt")
-        inputs = {k: v.to(device) for k, v in inputs.items()}
-
-        # Inferenza no-grad; se GPU, usa mixed precision (autocast)
-        with torch.no_grad():
-            if device.type == "cuda":
-                from torch.cuda.amp import autocast
-                with autocast():
-                    outputs = model(**inputs)
-            else:
-                outputs = model(**inputs)
-
-        pred = outputs.logits.argmax(dim=1).squeeze().detach().to("cpu").numpy()
-
-        # Resize predizione alla shape dell'immagine originale
-        pred = np.array(
-            Image.fromarray(pred.astype(np.uint8)).resize(img.size, resample=Image.NEAREST)
-        )
-
-        # Salva overlay in background per non bloccare la risposta
-        background_tasks.add_task(save_overlay, img, pred)
-
-        uniq, counts = np.unique(pred, return_counts=True)
-        print("Classi pixel predetti e conteggi:", dict(zip(uniq, counts)))
-
-        results = []
-        for class_id in uniq:
-            if class_id == 0:
-                continue
-            mask = (pred == class_id).astype(np.uint8)
-            n_pixels = int(mask.sum())
-            print(f"Classe {class_id} ({ID_TO_CLASS[class_id]['label']}): {n_pixels} pixel da segmentare")
-            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            print(f"  -> {len(contours)} poligoni trovati per classe {class_id}")
-            for cnt in contours:
-                if len(cnt) > 2:
-                    poly = cnt.squeeze().tolist()
-                    if isinstance(poly[0], int):
-                        poly = [poly]
-                    class_info = ID_TO_CLASS.get(int(class_id), {"label": str(class_id), "color": "#222"})
-                    results.append({
-                        "points": poly,
-                        "label": class_info["label"],
-                        "color": class_info["color"],
-                        "tipo": class_info["label"]
-                    })
-
-        print("Restituisco", len(results), "poligoni totali\n--- DEBUG FINE ---")
-        return {"poligoni": results}
+        # Tutto il lavoro CPU-bound gira fuori dall'event loop, che resta libero
+        img = await _run_cpu(decode, payload)
+        params = dict(postprocess.postprocess_params(zoom, lat), formats=formats or ["json"])
+        if geo is not None:
+            params["geo"] = geo  # la georeferenziazione dipende dalla posizione: entra nella chiave
+        if tta:
+            params["tta"] = list(tta)
+
+        # Cache per contenuto: stessi pixel + stesso modello + stessi parametri = stesso risultato
+        key = None
+        if result_cache.enabled:
+            key = await asyncio.to_thread(ResultCache.make_key, img, version, params)
+            cached = result_cache.get(key)
+            if cached is None and result_cache.persist_dir:
+                cached = await asyncio.to_thread(result_cache.load, key)
+            if cached is not None:
+                print("[CACHE] hit\n--- DEBUG FINE ---")
+                return dict(cached, cache="hit", model_version=version)
+
+        # Inferenza: la richiesta entra nella coda di micro-batching e condivide
+        # il forward pass con le altre richieste arrivate nella stessa finestra
+        window = _session_window(session, img)
+        fraction = None
+        if window is not None:
+            # Crop spostata della stessa sessione: solo le strisce nuove passano nel modello.
+            # key: in modalità process la sessione resta sul worker che ne ha i logits
+            pred, fraction = await executor.run(
+                engine.infer_session, img, spec, tta, session["id"], session["zoom"], *window,
+                key=session["id"],
+            )
+        else:
+            pred = await batcher.submit((spec, img, tta))
+
+        # Poligoni e/o maschera nei formati richiesti
+        body, n_polygons = await _run_cpu(encodings.encode_result, pred, img.size, params)
+        empty = n_polygons == 0 if n_polygons is not None else not pred.any()
+
+        # Overlay di debug: accodato al writer in background, scartato se la coda è piena
+        overlay_writer.submit(img, pred, error=empty)
+
+        if fraction is not None and fraction < 1:
+            # Logits in parte ricuciti dalla crop precedente: non vanno nella cache per contenuto
+            key = None
+            body = dict(body, incremental={"session": session["id"], "inferred_fraction": round(fraction, 3)})
+        if key is not None:
+            result_cache.put(key, body)
+            background_tasks.add_task(result_cache.persist, key, body)
+
+        print("Restituisco", n_polygons, "poligoni totali, formati", ",".join(params["formats"]), "\n--- DEBUG FINE ---")
+        return dict(body, cache="miss" if key is not None else "off", model_version=version)
 
     except Exception as e:
         print("ERRORE backtrace:", e)
+        if img is not None:
+            overlay_writer.submit(img, None, error=True)
+        return {"errore": str(e), "model_version": version}
+
+async def read_image_bytes(request: Request):
+    """
+    Corpo binario grezzo (Content-Type image/*) oppure campo 'image' di un multipart.
+    Restituisce (byte, metadati): query string più gli eventuali campi del form.
+    """
+    meta = dict(request.query_params)
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("image") or form.get("file")
+        if upload is None or isinstance(upload, str):
+            raise ValueError("Campo multipart 'image' mancante")
+        meta.update({k: v for k, v in form.items() if isinstance(v, str)})
+        return await upload.read(), meta
+    return await request.body(), meta
+
+async def segmenta_request(decode, payload, meta: dict, background_tasks: BackgroundTasks):
+    """
+    Segmentazione di un'immagine (payload da passare a decode) con i metadati della
+    richiesta (lat, lng, zoom, bearing, crop_width, crop_height, format, tta, session; numeri anche come
+    stringhe, come arrivano in query string). Restituisce (status HTTP, corpo): è il percorso
+    comune alle rotte qui sotto e al backend in modalità embedded (vedi backend/ai_client.py).
+    """
+    if not startup.ready:
+        return 503, {"errore": "Modello in caricamento", "startup": startup.snapshot()}
+    lat, lng, zoom = (_float_or_none(meta.get(k)) for k in ("lat", "lng", "zoom"))
+    bearing, crop_width, crop_height = (_float_or_none(meta.get(k)) for k in ("bearing", "crop_width", "crop_height"))
+    try:
+        formats = encodings.parse_formats(meta.get("format"))
+        tta = parse_tta(meta.get("tta"))
+        geo = None
+        if "geo" in formats:
+            geo = georef_params(lat, lng, zoom, bearing, crop_width, crop_height)
+    except ValueError as e:
+        return 200, {"errore": str(e)}
+    session = None
+    if meta.get("session"):
+        session = {"id": str(meta["session"]), "lat": lat, "lng": lng, "zoom": zoom, "bearing": bearing,
+                   "crop_width": crop_width, "crop_height": crop_height}
+    body = await _segmenta(decode, payload, background_tasks, zoom=zoom, lat=lat, formats=formats, geo=geo, tta=tta,
+                           session=session)
+    return 200, body
+
+def _route_response(status, body):
+    return _not_ready() if status == 503 else body
+
+@app.post("/segmenta_ai")
+async def segmenta_ai(req: SegmentRequest, background_tasks: BackgroundTasks):
+    # Percorso storico: data URL base64 dentro il JSON
+    status, body = await segmenta_request(
+        common.decode_image, req.image, req.model_dump(exclude={"image"}), background_tasks
+    )
+    return _route_response(status, body)
+
+@app.post("/segmenta_ai_bin")
+async def segmenta_ai_bin(request: Request, background_tasks: BackgroundTasks):
+    # Percorso binario: i byte JPEG/PNG arrivano così come sono, niente base64 né JSON
+    if not startup.ready:
+        return _not_ready()
+    try:
+        data, meta = await read_image_bytes(request)
+    except Exception as e:
         return {"errore": str(e)}
+    status, body = await segmenta_request(common.decode_image_bytes, data, meta, background_tasks)
+    return _route_response(status, body)
@@ -0,0 +1,104 @@
+# backend/ai_microservice/backends.py
+#
+# Backend di inferenza intercambiabili. Tutti ricevono pixel_values (B, 3, H, W) già
+# normalizzati dal feature_extractor e restituiscono i logits (B, n_classi, H/4, W/4)
+# come tensore torch float32 su CPU (o sul device del modello per il backend torch).
+#
+#   torch            modello HuggingFace (fp32 su CPU, fp16 + autocast su GPU)
+#   onnx             ONNX Runtime, fp32
+#   onnx_int8        ONNX Runtime, pesi quantizzati INT8 (quantizzazione dinamica)
+#   torchscript_bf16 TorchScript congelato, pesi bf16 e layout channels_last
+#
+# I file dei backend CPU si generano con `python -m ai_microservice.export_backends`.
+
+import os
+import torch
+
+BACKENDS = ("torch", "onnx", "onnx_int8", "torchscript_bf16")
+
+ONNX_NAME = "model.onnx"
+ONNX_INT8_NAME = "model_int8.onnx"
+TORCHSCRIPT_BF16_NAME = "model_bf16_cl.pt"
+
+
+def export_dir(model_path: str) -> str:
+    return os.path.join(model_path, "cpu_backends")
+
+
+class LogitsOnly(torch.nn.Module):
+    """Wrapper per export/tracing: pixel_values -> logits, senza il dict di output HF."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values).logits
+
+
+class TorchBackend:
+    name = "torch"
+
+    def __init__(self, model, device):
+        self.model = model
+        self.device = device
+
+    def __call__(self, pixel_values):
+        pixel_values = pixel_values.to(self.device)
+        # Inferenza no-grad; se GPU, usa mixed precision (autocast)
+        with torch.no_grad():
+            if self.device.type == "cuda":
+                from torch.cuda.amp import autocast
+                with autocast():
+                    return self.model(pixel_values=pixel_values).logits
+            return self.model(pixel_values=pixel_values).logits
+
+
+class OnnxBackend:
+    def __init__(self, path: str, name: str = "onnx", threads: int = 0):
+        import onnxruntime as ort
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            opts.intra_op_num_threads = threads
+        self.name = name
+        self.session = ort.InferenceSession(path, sess_options=opts, providers=["CPUExecutionProvider"])
+
+    def __call__(self, pixel_values):
+        (logits,) = self.session.run(["logits"], {"pixel_values": pixel_values.cpu().numpy()})
+        return torch.from_numpy(logits)
+
+
+class TorchScriptBf16Backend:
+    name = "torchscript_bf16"
+
+    def __init__(self, path: str):
+        self.module = torch.jit.load(path, map_location="cpu")
+        self.module.eval()
+
+    def __call__(self, pixel_values):
+        with torch.no_grad():
+            x = pixel_values.to(torch.bfloat16).contiguous(memory_format=torch.channels_last)
+            return self.module(x).float()
+
+
+def create_backend(name: str, model_path: str, device, load_torch_model):
+    """
+    Istanzia il backend richiesto. `load_torch_model` serve solo per il backend torch,
+    così i backend esportati non caricano anche i pesi HuggingFace.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Backend di inferenza sconosciuto: {name} (validi: {', '.join(BACKENDS)})")
+    if name == "torch":
+        return TorchBackend(load_torch_model(), device)
+
+    base = export_dir(model_path)
+    files = {"onnx": ONNX_NAME, "onnx_int8": ONNX_INT8_NAME, "torchscript_bf16": TORCHSCRIPT_BF16_NAME}
+    path = os.path.join(base, files[name])
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"{path} non trovato: eseguire prima `python -m ai_microservice.export_backends`"
+        )
+    if name == "torchscript_bf16":
+        return TorchScriptBf16Backend(path)
+    return OnnxBackend(path, name=name, threads=torch.get_num_threads())
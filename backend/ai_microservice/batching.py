@@ -0,0 +1,136 @@
+# backend/ai_microservice/batching.py
+
+import asyncio
+import time
+from collections import Counter, deque
+
+
+class MicroBatcher:
+    """
+    Coda di richieste con micro-batching dinamico: raccoglie le richieste concorrenti
+    per una finestra breve (o finché non si raggiunge max_batch_size) e le passa tutte
+    insieme a `run_batch`, che deve restituire un risultato per ogni elemento, in ordine.
+    Fino a `max_inflight` batch possono essere in esecuzione contemporaneamente (uno per
+    worker del pool di inferenza); mentre i worker sono tutti occupati la coda si riempie
+    e il batch successivo parte più grande.
+    """
+
+    def __init__(self, run_batch, max_batch_size: int = 8, window_ms: float = 10.0,
+                 max_inflight: int = 1, stats_window: int = 2000):
+        self._run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.window_ms = max(0.0, float(window_ms))
+        self.max_inflight = max(1, int(max_inflight))
+        self._queue = None
+        self._worker = None
+        self._slots = None
+        self._inflight = set()
+        # Statistiche per tarare la finestra rispetto alla latenza p99
+        self._batch_sizes = Counter()
+        self._waits_ms = deque(maxlen=stats_window)
+        self._n_requests = 0
+        self._n_batches = 0
+
+    def start(self):
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_inflight)
+            self._worker = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        for task in list(self._inflight):
+            task.cancel()
+        await asyncio.gather(self._worker, *self._inflight, return_exceptions=True)
+        self._worker = None
+        # Chi è ancora in coda riceve un errore invece di restare appeso
+        while not self._queue.empty():
+            _, fut, _ = self._queue.get_nowait()
+            if not fut.done():
+                fut.set_exception(RuntimeError("Servizio in arresto"))
+
+    async def submit(self, item):
+        self.start()
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, fut, time.perf_counter()))
+        return await fut
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.window_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        # Quello che è già in coda parte comunque con questo batch
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _loop(self):
+        while True:
+            # Si raccoglie un nuovo batch solo quando c'è un worker libero
+            await self._slots.acquire()
+            batch = await self._collect()
+            # Le richieste annullate (client disconnesso) non occupano posto nel forward pass
+            batch = [b for b in batch if not b[1].cancelled()]
+            if not batch:
+                self._slots.release()
+                continue
+
+            t_start = time.perf_counter()
+            self._waits_ms.extend((t_start - t_in) * 1000.0 for _, _, t_in in batch)
+            self._batch_sizes[len(batch)] += 1
+            self._n_requests += len(batch)
+            self._n_batches += 1
+
+            task = asyncio.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _dispatch(self, batch):
+        try:
+            results = await self._run_batch([item for item, _, _ in batch])
+        except asyncio.CancelledError:
+            for _, fut, _ in batch:
+                if not fut.done():
+                    fut.set_exception(RuntimeError("Servizio in arresto"))
+            raise
+        except Exception as e:
+            for _, fut, _ in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+
+        for (_, fut, _), res in zip(batch, results):
+            if not fut.done():
+                fut.set_result(res)
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits_ms)
+
+        def pct(p):
+            if not waits:
+                return 0.0
+            return round(waits[min(len(waits) - 1, int(p / 100.0 * len(waits)))], 2)
+
+        return {
+            "max_batch_size": self.max_batch_size,
+            "window_ms": self.window_ms,
+            "max_inflight": self.max_inflight,
+            "inflight": len(self._inflight),
+            "requests": self._n_requests,
+            "batches": self._n_batches,
+            "mean_batch_size": round(self._n_requests / self._n_batches, 2) if self._n_batches else 0.0,
+            "batch_size_hist": {str(k): v for k, v in sorted(self._batch_sizes.items())},
+            "queue_wait_ms": {"p50": pct(50), "p95": pct(95), "p99": pct(99), "max": pct(100)},
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        }
@@ -0,0 +1,144 @@
+# backend/ai_microservice/cache.py
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    Cache LRU dei risultati di segmentazione, indirizzata per contenuto: la chiave è
+    l'hash dei pixel decodificati + versione del modello + parametri di post-processing,
+    quindi una crop identica (retry di ottimizza_coordinata, batch ripetuti) costa
+    solo un lookup. Limiti su numero di voci e byte; persistenza su disco opzionale
+    (un file JSON per chiave) per sopravvivere ai riavvii.
+    """
+
+    def __init__(self, max_entries: int = 512, max_bytes: int = 64 * 1024 * 1024,
+                 persist_dir: str = None, max_disk_entries: int = 20000):
+        self.max_entries = max(0, int(max_entries))
+        self.max_bytes = max(0, int(max_bytes))
+        self.persist_dir = persist_dir or None
+        self.max_disk_entries = max_disk_entries
+        self._data = OrderedDict()  # chiave -> (valore, byte)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.persist_dir:
+            os.makedirs(self.persist_dir, exist_ok=True)
+            self._prune_disk()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @staticmethod
+    def make_key(img, model_version: str, params: dict) -> str:
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f"{img.mode}:{img.size[0]}x{img.size[1]}|{model_version}|".encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        h.update(img.tobytes())
+        return h.hexdigest()
+
+    def get(self, key: str):
+        """Lookup in memoria (non tocca il disco: si può chiamare dall'event loop)."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def load(self, key: str):
+        """Lookup sul disco dopo un miss in memoria; se trovato, la voce torna in memoria."""
+        if not self.persist_dir:
+            return None
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                raw = f.read()
+        except (OSError, ValueError):
+            return None
+        value = json.loads(raw)
+        with self._lock:
+            # Era stato contato come miss dal lookup in memoria
+            self.misses -= 1
+            self.hits += 1
+            self.disk_hits += 1
+        self._insert(key, value, len(raw))
+        return value
+
+    def put(self, key: str, value):
+        if not self.enabled:
+            return
+        self._insert(key, value, len(json.dumps(value, separators=(",", ":"))))
+
+    def persist(self, key: str, value):
+        """Scrittura atomica su disco; pensata per girare in background dopo la risposta."""
+        if not self.persist_dir:
+            return
+        path = self._path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(value, f, separators=(",", ":"))
+        os.replace(tmp, path)
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % 256 == 0
+        if prune:
+            self._prune_disk()
+
+    def _insert(self, key, value, size):
+        if not self.enabled or size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._data[key] = (value, size)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, s) = self._data.popitem(last=False)
+                self._bytes -= s
+                self.evictions += 1
+
+    def _path(self, key):
+        return os.path.join(self.persist_dir, f"{key}.json")
+
+    def _prune_disk(self):
+        # Tiene solo le voci più recenti (per mtime) oltre il limite su disco
+        try:
+            files = [e for e in os.scandir(self.persist_dir) if e.name.endswith(".json")]
+        except OSError:
+            return
+        if len(files) <= self.max_disk_entries:
+            return
+        files.sort(key=lambda e: e.stat().st_mtime)
+        for e in files[: len(files) - self.max_disk_entries]:
+            try:
+                os.remove(e.path)
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "persist_dir": self.persist_dir,
+            }
@@ -0,0 +1,84 @@
+# backend/ai_microservice/common.py
+#
+# Parti del motore che non richiedono torch né transformers: classi CVAT, configurazione
+# e versione del modello, decodifica delle immagini, riscalamento delle mappe di classi.
+# ai_api importa solo questo modulo all'avvio, così /healthz risponde subito; engine.py
+# (torch, transformers, backend di inferenza) si importa in background (vedi ai_api._bootstrap).
+
+from io import BytesIO
+import base64
+import hashlib
+import os
+from PIL import Image
+import numpy as np
+import cv2
+
+# ======= MAPPING CLASSI CVAT =======
+CVAT_CLASSES = [
+    {"id": 0, "label": "background",           "color": "#000000"},
+    {"id": 1, "label": "Stalli AT",            "color": "#FFA07A"},
+    {"id": 2, "label": "Locale AT/MT",         "color": "#FFE082"},
+    {"id": 3, "label": "Parcheggio",           "color": "#B39DDB"},
+    {"id": 4, "label": "Zona libera/Verde",    "color": "#B2DFDB"},
+    {"id": 5, "label": "arrivo AT",            "color": "#F48FB1"},
+    {"id": 6, "label": "Strada",               "color": "#F8BBD0"}
+]
+ID_TO_CLASS = {c["id"]: c for c in CVAT_CLASSES}
+PALETTE = {c["id"]: tuple(int(c["color"].lstrip("#")[i:i+2], 16) for i in (0, 2, 4)) for c in CVAT_CLASSES}
+
+# Percorso modello (default; altre versioni si caricano a caldo dal registry)
+MODEL_PATH = os.getenv("AI_MODEL_PATH", r"..\segformer\segformer_finetuned")
+
+# Backend di inferenza: torch | onnx | onnx_int8 | torchscript_bf16 (vedi backends.py)
+INFERENCE_BACKEND = os.getenv("AI_INFERENCE_BACKEND", "torch")
+
+def model_version(model_path: str = MODEL_PATH, backend_name: str = INFERENCE_BACKEND) -> str:
+    """
+    Identificativo della versione del modello, senza caricarlo: nome della cartella,
+    impronta di config/pesi (dimensione + mtime) e backend di inferenza.
+    """
+    h = hashlib.sha1()
+    for name in ("config.json", "model.safetensors", "pytorch_model.bin"):
+        p = os.path.join(model_path, name)
+        if os.path.exists(p):
+            st = os.stat(p)
+            h.update(f"{name}:{st.st_size}:{int(st.st_mtime)}".encode())
+    name = model_path.replace("\\", "/").rstrip("/").split("/")[-1]
+    return f"{name}@{h.hexdigest()[:10]}/{backend_name}"
+
+
+def model_spec(model_path: str = MODEL_PATH, backend_name: str = INFERENCE_BACKEND) -> tuple:
+    """(versione, percorso, backend): basta a un processo qualsiasi per caricare il modello."""
+    return (model_version(model_path, backend_name), model_path, backend_name)
+
+
+def decode_image(data_url: str) -> Image.Image:
+    print("\n--- DEBUG ---\nRicevuta immagine base64 di lunghezza:", len(data_url))
+    header, encoded = data_url.split(',', 1)
+    img = Image.open(BytesIO(base64.b64decode(encoded))).convert("RGB")
+    print("Immagine decodificata, shape:", img.size)
+    return img
+
+
+def decode_image_bytes(data) -> Image.Image:
+    """Decodifica direttamente dal buffer binario (JPEG/PNG), senza passare da base64."""
+    print("\n--- DEBUG ---\nRicevuta immagine binaria di", len(data), "byte")
+    bgr = cv2.imdecode(np.frombuffer(memoryview(data), dtype=np.uint8), cv2.IMREAD_COLOR)
+    if bgr is None:
+        raise ValueError("Immagine non decodificabile")
+    img = Image.fromarray(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB))
+    print("Immagine decodificata, shape:", img.size)
+    return img
+
+
+def upsample_pred(pred, size):
+    """Mappa di classi riportata alla shape (larghezza, altezza) dell'immagine originale."""
+    if pred.shape == (size[1], size[0]):
+        return pred
+    return np.array(Image.fromarray(pred).resize(size, resample=Image.NEAREST))
+
+
+def init_pool_worker(torch_threads: int = 0, shared_weights: bool = False):
+    """Initializer dei processi del pool: il motore si importa solo nel processo figlio."""
+    from .engine import init_worker
+    init_worker(torch_threads, shared_weights)
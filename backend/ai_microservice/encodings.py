@@ -0,0 +1,201 @@
+# backend/ai_microservice/encodings.py
+#
+# Formati di uscita della segmentazione, scelti dal chiamante con il parametro `format`
+# (lista separata da virgole, default "json"):
+#
+#   json     "poligoni": lista di {points: [[x, y], ...], label, color, tipo} (storico)
+#   delta    "poligoni_delta": come json ma con i punti piatti e a differenze,
+#            d = [x0, y0, x1-x0, y1-y0, ...]
+#   varint   "poligoni_varint": tutti i poligoni in un buffer base64; per ogni poligono
+#            id classe, numero di punti e poi le differenze x/y in zigzag-varint
+#            (vedi decode_varint_polygons), più la tabella "classi"
+#   rle      "maschera_rle": maschera di classi in RLE stile COCO (ordine per colonne,
+#            counts compressi come pycocotools), una voce per classe presente
+#   png      "maschera_png": maschera di classi come PNG a palette (data URL base64)
+#   geo      "poligoni_geo": poligoni in [lat, lng] con area "mq" (vedi georef.py);
+#            richiede lat, lng e zoom della crop
+#
+# Le maschere sono alla risoluzione della crop, i poligoni in pixel della crop.
+
+import base64
+from io import BytesIO
+import numpy as np
+from PIL import Image
+from .common import CVAT_CLASSES, ID_TO_CLASS, PALETTE, upsample_pred
+from .postprocess import estrai_poligoni
+from .georef import georeference
+
+FORMATS = ("json", "delta", "varint", "rle", "png", "geo")
+POLYGON_FORMATS = ("json", "delta", "varint", "geo")
+
+_LABEL_TO_ID = {c["label"]: c["id"] for c in CVAT_CLASSES}
+
+_PNG_PALETTE = [0] * 768
+for _k, _rgb in PALETTE.items():
+    _PNG_PALETTE[3 * _k:3 * _k + 3] = _rgb
+
+
+def parse_formats(value) -> list:
+    """'rle,varint' -> ['rle', 'varint'] (ordinati, senza duplicati); vuoto = ['json']."""
+    if not value:
+        return ["json"]
+    formats = sorted({f.strip().lower() for f in str(value).split(",") if f.strip()})
+    invalid = [f for f in formats if f not in FORMATS]
+    if invalid:
+        raise ValueError(f"Formato non valido: {', '.join(invalid)} (validi: {', '.join(FORMATS)})")
+    return formats or ["json"]
+
+
+# ---------- RLE stile COCO ----------
+
+def rle_counts(mask: np.ndarray) -> np.ndarray:
+    """Lunghezze delle sequenze 0/1 in ordine per colonne, la prima è sempre di zeri."""
+    flat = np.asarray(mask, dtype=bool).ravel(order="F")
+    if flat.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], change, [flat.size])))
+    if flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.astype(np.int64)
+
+
+def rle_to_string(counts) -> str:
+    """Compressione dei counts come rleToString di pycocotools (differenze, 5 bit per carattere)."""
+    out = []
+    for i, x in enumerate(int(c) for c in counts):
+        if i > 2:
+            x -= int(counts[i - 2])
+        more = True
+        while more:
+            c = x & 0x1F
+            x >>= 5
+            more = (x != -1) if (c & 0x10) else (x != 0)
+            if more:
+                c |= 0x20
+            out.append(chr(c + 48))
+    return "".join(out)
+
+
+def encode_rle(mask: np.ndarray) -> dict:
+    h, w = mask.shape
+    classes = []
+    for class_id in np.unique(mask):
+        if class_id == 0:
+            continue
+        classes.append({
+            "id": int(class_id),
+            "label": ID_TO_CLASS.get(int(class_id), {"label": str(class_id)})["label"],
+            "counts": rle_to_string(rle_counts(mask == class_id)),
+        })
+    return {"size": [h, w], "classes": classes}
+
+
+# ---------- PNG a palette ----------
+
+def encode_png(mask: np.ndarray) -> str:
+    im = Image.fromarray(np.ascontiguousarray(mask, dtype=np.uint8))
+    im.putpalette(_PNG_PALETTE)  # L -> P: i valori restano gli id di classe
+    buf = BytesIO()
+    im.save(buf, format="PNG", optimize=False)
+    return "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+# ---------- Poligoni a differenze / varint ----------
+
+def _deltas(points) -> np.ndarray:
+    pts = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    d = pts.copy()
+    d[1:] -= pts[:-1]
+    return d.ravel()
+
+
+def encode_delta(results: list) -> list:
+    return [
+        {"d": _deltas(p["points"]).tolist(), "label": p["label"], "color": p["color"], "tipo": p["tipo"]}
+        for p in results
+    ]
+
+
+def _uvarint(values: np.ndarray) -> bytes:
+    """LEB128 senza segno, vettorizzato: 7 bit per byte, bit alto = continua."""
+    v = np.asarray(values, dtype=np.uint64)
+    if v.size == 0:
+        return b""
+    nbytes = np.ones(v.size, dtype=np.int64)
+    t = v >> np.uint64(7)
+    while t.any():
+        nbytes += t > 0
+        t >>= np.uint64(7)
+    pos = np.concatenate(([0], np.cumsum(nbytes)[:-1]))
+    out = np.empty(int(nbytes.sum()), dtype=np.uint8)
+    for k in range(int(nbytes.max())):
+        sel = nbytes > k
+        byte = (v[sel] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        cont = (nbytes[sel] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[pos[sel] + k] = (byte | cont).astype(np.uint8)
+    return out.tobytes()
+
+
+def encode_varint(results: list) -> str:
+    parts = []
+    for p in results:
+        d = _deltas(p["points"])
+        zigzag = (d << 1) ^ (d >> 63)  # interi con segno -> senza segno, piccoli restano piccoli
+        parts.append(np.array([_LABEL_TO_ID.get(p["label"], 0), len(d) // 2], dtype=np.int64))
+        parts.append(zigzag)
+    data = _uvarint(np.concatenate(parts)) if parts else b""
+    return base64.b64encode(data).decode("ascii")
+
+
+def decode_varint_polygons(data: str) -> list:
+    """Inverso di encode_varint: [(id classe, [[x, y], ...]), ...]."""
+    raw = base64.b64decode(data)
+    values, cur, shift = [], 0, 0
+    for b in raw:
+        cur |= (b & 0x7F) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            values.append(cur)
+            cur, shift = 0, 0
+    out, i = [], 0
+    while i < len(values):
+        class_id, n = values[i], values[i + 1]
+        i += 2
+        zz = np.array(values[i:i + 2 * n], dtype=np.int64)
+        i += 2 * n
+        d = ((zz >> 1) ^ -(zz & 1)).reshape(-1, 2)
+        out.append((class_id, np.cumsum(d, axis=0).tolist()))
+    return out
+
+
+def encode_result(pred: np.ndarray, out_size, params: dict):
+    """
+    Corpo della risposta nei formati richiesti (params["formats"]) e numero di poligoni
+    (None se non è stato chiesto nessun formato a poligoni).
+    """
+    formats = params.get("formats") or ["json"]
+    payload = {}
+    n_polygons = None
+    if any(f in POLYGON_FORMATS for f in formats):
+        results = estrai_poligoni(pred, out_size, params)
+        n_polygons = len(results)
+        if "json" in formats:
+            payload["poligoni"] = results
+        if "delta" in formats:
+            payload["poligoni_delta"] = encode_delta(results)
+        if "varint" in formats:
+            payload["poligoni_varint"] = encode_varint(results)
+            payload["classi"] = {
+                str(c["id"]): {"label": c["label"], "color": c["color"]} for c in CVAT_CLASSES if c["id"]
+            }
+        if "geo" in formats:
+            payload["poligoni_geo"] = georeference(results, out_size, params["geo"])
+    if "rle" in formats or "png" in formats:
+        mask = upsample_pred(pred, tuple(out_size))
+        if "rle" in formats:
+            payload["maschera_rle"] = encode_rle(mask)
+        if "png" in formats:
+            payload["maschera_png"] = encode_png(mask)
+    return payload, n_polygons
@@ -0,0 +1,193 @@
+# backend/ai_microservice/engine.py
+#
+# Motore di segmentazione: modello, preprocessing, inferenza e post-processing.
+# Non dipende da FastAPI, così le funzioni possono girare sia nei thread sia nei
+# processi del pool di inferenza (ogni processo carica il suo modello).
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from PIL import Image
+import torch
+import numpy as np
+from transformers import SegformerForSemanticSegmentation, SegformerFeatureExtractor
+from .backends import create_backend
+from .common import (  # parti senza torch, riesportate per chi importa da engine
+    CVAT_CLASSES, ID_TO_CLASS, PALETTE, MODEL_PATH, INFERENCE_BACKEND,
+    model_version, model_spec, decode_image, decode_image_bytes, upsample_pred,
+)
+from . import tiling
+from .tta import tta_forward
+from .incremental import SessionCache, infer_incremental
+
+# Abilita autotuning delle convoluzioni (utile quando le dimensioni input si ripetono)
+torch.backends.cudnn.benchmark = True
+
+# Versioni tenute in memoria da ogni processo (LRU): attiva + candidata + precedente
+MAX_LOADED_MODELS = int(os.getenv("AI_MAX_LOADED_MODELS", "3"))
+
+_models = OrderedDict()  # versione -> (backend, feature_extractor)
+_default_spec = None
+_shared_weights = False
+load_seconds = None
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+_load_lock = threading.Lock()
+
+
+def load_torch_model(model_path: str = MODEL_PATH, shared_weights: bool = False):
+    if shared_weights and device.type == "cpu":
+        # Pesi memory-mapped da safetensors, condivisi tra i processi del pool
+        from .weights import load_shared_model
+        m = load_shared_model(model_path)
+    else:
+        m = SegformerForSemanticSegmentation.from_pretrained(model_path)
+    m.eval()
+    m.to(device)
+    # Usa FP16 su GPU per inferenza più veloce/leggera
+    if device.type == "cuda":
+        m.half()
+    return m
+
+
+def get_model(spec: tuple = None):
+    """
+    (backend, feature_extractor) per la versione richiesta (default: MODEL_PATH),
+    caricandola al primo uso in questo processo. Oltre MAX_LOADED_MODELS si scarica
+    la versione usata meno di recente.
+    """
+    global load_seconds, _default_spec
+    if spec is None:
+        _default_spec = _default_spec or model_spec()
+        spec = _default_spec
+    version, model_path, backend_name = spec
+    loaded = _models.get(version)
+    if loaded is not None:
+        try:
+            _models.move_to_end(version)
+        except KeyError:
+            pass
+        return loaded
+    with _load_lock:
+        if version in _models:
+            return _models[version]
+        t0 = time.perf_counter()
+        print(f"Caricamento modello {version} e feature_extractor (backend {backend_name})...")
+        fe = SegformerFeatureExtractor.from_pretrained(model_path)
+        backend = create_backend(
+            backend_name, model_path, device,
+            load_torch_model=lambda: load_torch_model(model_path, _shared_weights),
+        )
+        _models[version] = (backend, fe)
+        while len(_models) > max(1, MAX_LOADED_MODELS):
+            old, _ = _models.popitem(last=False)
+            print(f"Scaricato modello {old}")
+        load_seconds = time.perf_counter() - t0
+        return _models[version]
+
+
+def load_model(model_path: str = MODEL_PATH, shared_weights: bool = False, backend_name: str = INFERENCE_BACKEND):
+    global _shared_weights
+    _shared_weights = _shared_weights or shared_weights
+    get_model(model_spec(model_path, backend_name))
+
+
+def unload_model(version: str) -> bool:
+    with _load_lock:
+        return _models.pop(version, None) is not None
+
+
+def loaded_versions() -> list:
+    return list(_models)
+
+
+def warmup(sizes=(500,), passes: int = 1, spec: tuple = None) -> dict:
+    """
+    Forward pass a vuoto sulle dimensioni tipiche delle crop, così la prima richiesta
+    reale non paga l'inizializzazione pigra dei kernel. Restituisce i tempi (s) di
+    caricamento modello e di warmup di questo processo.
+    """
+    t0 = time.perf_counter()
+    get_model(spec)
+    load_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for _ in range(max(0, passes)):
+        for size in sizes:
+            infer_batch([Image.new("RGB", (size, size), (90, 110, 80))], spec)
+    return {"model_load": load_s, "warmup": time.perf_counter() - t0}
+
+
+def init_worker(torch_threads: int = 0, shared_weights: bool = False):
+    """
+    Initializer dei processi del pool: ogni processo ha il suo numero di thread torch
+    (così N worker non si contendono gli stessi core) e carica il proprio modello.
+    """
+    if torch_threads > 0:
+        torch.set_num_threads(torch_threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass
+    load_model(shared_weights=shared_weights)
+
+
+def infer_batch(imgs, spec: tuple = None, tta: tuple = None):
+    """
+    Un solo forward pass Segformer per tutte le immagini del batch.
+    Restituisce, per ogni immagine, la mappa di classi alla risoluzione dei logits
+    (uint8); il riscalamento alla crop originale avviene nel post-processing.
+    Le immagini grandi passano dalla finestra scorrevole (le loro tile in un unico batch).
+    `spec` sceglie la versione del modello (vedi model_spec), default MODEL_PATH;
+    `tta` le trasformazioni di test-time augmentation (vedi tta.py) da fondere.
+    """
+    backend, feature_extractor = get_model(spec)
+    if tta:
+        backend = tta_forward(backend, tta)
+
+    preds = [None] * len(imgs)
+    small = []
+    for i, img in enumerate(imgs):
+        if tiling.use_tiling(img):
+            # Con TTA ogni tile si moltiplica: stesse immagini per forward che senza
+            preds[i] = tiling.infer_tiled(img, backend, feature_extractor,
+                                          tile_batch=max(1, tiling.TILE_BATCH // len(tta or ("id",))))
+        else:
+            small.append(i)
+
+    if small:
+        # Preprocessing: il feature_extractor porta tutto a 512x512, quindi le immagini si impilano
+        inputs = feature_extractor(images=[imgs[i] for i in small], return_tensors="pt")
+        logits = backend(inputs["pixel_values"])
+        out = logits.argmax(dim=1).detach().to("cpu").numpy().astype(np.uint8)
+        for i, pred in zip(small, out):
+            preds[i] = pred
+    return preds
+
+
+# Logits dell'ultima crop per sessione, per processo: in modalità process l'executor
+# manda ogni sessione sempre allo stesso worker (run(..., key=sessione))
+sessions = SessionCache()
+
+
+def session_stats() -> dict:
+    """Statistiche delle sessioni di questo processo (per executor.run_all)."""
+    return sessions.stats()
+
+
+def infer_session(img, spec: tuple, tta: tuple, session: str, zoom: float, origin, extent):
+    """
+    Inferenza di una crop di una sessione di iterazioni sulla stessa zona (vedi
+    incremental.py): la parte sovrapposta alla crop precedente riusa i suoi logits.
+    `origin` è l'angolo in alto a sinistra e `extent` (larghezza, altezza) la dimensione
+    della crop, in pixel globali allo zoom. Restituisce (mappa di classi, frazione inferita).
+    """
+    backend, feature_extractor = get_model(spec)
+    if tta:
+        backend = tta_forward(backend, tta)
+    pixel_values = feature_extractor(images=[img], return_tensors="pt")["pixel_values"]
+    _, _, H, W = pixel_values.shape
+    key = (spec, tta, zoom, img.size, tuple(extent), (H, W))
+    cell = (extent[0] / (W // tiling.LOGIT_STRIDE), extent[1] / (H // tiling.LOGIT_STRIDE))
+    logits, fraction = infer_incremental(pixel_values, backend, sessions.get(session, key), origin, cell)
+    sessions.put(session, {"key": key, "origin": tuple(origin), "logits": logits}, fraction)
+    return logits.argmax(dim=0).numpy().astype(np.uint8), fraction
@@ -0,0 +1,98 @@
+# backend/ai_microservice/executor.py
+
+import asyncio
+import multiprocessing
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class InferenceExecutor:
+    """
+    Pool dedicato al lavoro CPU-bound (decode, preprocessing, forward pass, contorni).
+    L'event loop di FastAPI si limita ad attendere i risultati.
+
+    mode="thread": un solo modello condiviso (torch rilascia il GIL durante i kernel).
+    mode="process": ogni processo carica il suo modello tramite `initializer`. Ogni worker
+    ha il suo pool di un processo, così le chiamate con la stessa `key` (es. una sessione
+    di incremental.py, con stato nel processo) finiscono sempre sullo stesso worker; le
+    altre vanno al worker con meno lavoro in corso.
+    """
+
+    def __init__(self, mode: str = "thread", workers: int = 2, initializer=None, initargs=(), info: dict = None):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Modalità pool non valida: {mode}")
+        self.mode = mode
+        self.workers = max(1, int(workers))
+        # Dettagli di configurazione da riportare nello status (thread torch, pesi condivisi...)
+        self.info = dict(info or {})
+        if mode == "process":
+            # spawn: niente fork di un processo con thread torch già attivi (e unica opzione su Windows)
+            self._pools = [
+                ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=initializer,
+                    initargs=initargs,
+                )
+                for _ in range(self.workers)
+            ]
+        else:
+            # Un solo pool: i thread condividono modello e stato, qualunque thread va bene
+            self._pools = [ThreadPoolExecutor(
+                max_workers=self.workers,
+                thread_name_prefix="inferenza",
+                initializer=initializer,
+                initargs=initargs,
+            )]
+        self._pending = [0] * len(self._pools)
+        self._completed = 0
+        self._failed = 0
+
+    def _pick(self, key=None) -> int:
+        if len(self._pools) == 1:
+            return 0
+        if key is not None:
+            # crc32 e non hash(): stabile tra processi e riavvii (PYTHONHASHSEED)
+            return zlib.crc32(str(key).encode("utf-8")) % len(self._pools)
+        return min(range(len(self._pools)), key=self._pending.__getitem__)
+
+    async def run(self, fn, *args, key=None):
+        return await self._run_on(self._pick(key), fn, *args)
+
+    async def run_all(self, fn, *args) -> list:
+        """Esegue `fn` una volta per pool (warmup, statistiche): una per worker in modalità process."""
+        return await asyncio.gather(*[self._run_on(i, fn, *args) for i in range(len(self._pools))])
+
+    async def _run_on(self, i: int, fn, *args):
+        self._pending[i] += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._pools[i], fn, *args)
+        except Exception:
+            self._failed += 1
+            raise
+        finally:
+            self._pending[i] -= 1
+        # Solo le esecuzioni riuscite: gli errori finiscono in `failed`
+        self._completed += 1
+        return result
+
+    def shutdown(self):
+        for pool in self._pools:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        if self.mode == "process":
+            busy = sum(1 for p in self._pending if p)
+            queued = sum(max(0, p - 1) for p in self._pending)
+        else:
+            busy = min(self._pending[0], self.workers)
+            queued = max(0, self._pending[0] - self.workers)
+        return {
+            "mode": self.mode,
+            "pool_size": self.workers,
+            "busy_workers": busy,
+            "queued": queued,
+            "completed": self._completed,
+            "failed": self._failed,
+            **self.info,
+        }
@@ -0,0 +1,91 @@
+# backend/ai_microservice/export_backends.py
+#
+# Genera i backend CPU del modello fine-tuned in <MODEL_PATH>/cpu_backends:
+#   model.onnx         ONNX fp32 (batch e dimensioni dinamiche)
+#   model_int8.onnx    ONNX con quantizzazione dinamica INT8 dei pesi
+#   model_bf16_cl.pt   TorchScript congelato, bf16 + channels_last
+#
+# Uso (dalla cartella backend):
+#   python -m ai_microservice.export_backends [--model-path ...] [--only onnx onnx_int8 ...]
+
+import argparse
+import inspect
+import os
+import time
+import torch
+from transformers import SegformerForSemanticSegmentation
+from .backends import LogitsOnly, ONNX_NAME, ONNX_INT8_NAME, TORCHSCRIPT_BF16_NAME, export_dir
+from .engine import MODEL_PATH
+
+IMAGE_SIZE = 512
+OPSET = 17
+
+
+def export_onnx(model, out_path):
+    dummy = torch.rand(1, 3, IMAGE_SIZE, IMAGE_SIZE)
+    kwargs = {}
+    # Le versioni recenti di torch usano di default l'exporter dynamo: qui serve quello TorchScript
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False
+    torch.onnx.export(
+        LogitsOnly(model),
+        (dummy,),
+        out_path,
+        input_names=["pixel_values"],
+        output_names=["logits"],
+        dynamic_axes={
+            "pixel_values": {0: "batch", 2: "height", 3: "width"},
+            "logits": {0: "batch", 2: "height_4", 3: "width_4"},
+        },
+        opset_version=OPSET,
+        do_constant_folding=True,
+        **kwargs,
+    )
+
+
+def export_onnx_int8(fp32_path, out_path):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    quantize_dynamic(fp32_path, out_path, weight_type=QuantType.QInt8)
+
+
+def export_torchscript_bf16(model, out_path):
+    m = LogitsOnly(model).to(torch.bfloat16).to(memory_format=torch.channels_last).eval()
+    dummy = torch.rand(1, 3, IMAGE_SIZE, IMAGE_SIZE, dtype=torch.bfloat16).contiguous(memory_format=torch.channels_last)
+    with torch.no_grad():
+        traced = torch.jit.trace(m, dummy, check_trace=False)
+        traced = torch.jit.freeze(traced)
+    traced.save(out_path)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Export backend CPU (ONNX, INT8, TorchScript bf16) del Segformer")
+    ap.add_argument("--model-path", default=MODEL_PATH)
+    ap.add_argument("--only", nargs="*", choices=["onnx", "onnx_int8", "torchscript_bf16"],
+                    default=["onnx", "onnx_int8", "torchscript_bf16"])
+    args = ap.parse_args()
+
+    out_dir = export_dir(args.model_path)
+    os.makedirs(out_dir, exist_ok=True)
+    model = SegformerForSemanticSegmentation.from_pretrained(args.model_path).eval()
+
+    onnx_path = os.path.join(out_dir, ONNX_NAME)
+    if "onnx" in args.only or ("onnx_int8" in args.only and not os.path.exists(onnx_path)):
+        t0 = time.perf_counter()
+        export_onnx(model, onnx_path)
+        print(f"[EXPORT] {onnx_path} ({time.perf_counter() - t0:.1f}s)")
+    if "onnx_int8" in args.only:
+        t0 = time.perf_counter()
+        out = os.path.join(out_dir, ONNX_INT8_NAME)
+        export_onnx_int8(onnx_path, out)
+        print(f"[EXPORT] {out} ({time.perf_counter() - t0:.1f}s)")
+    if "torchscript_bf16" in args.only:
+        t0 = time.perf_counter()
+        out = os.path.join(out_dir, TORCHSCRIPT_BF16_NAME)
+        export_torchscript_bf16(model, out)
+        print(f"[EXPORT] {out} ({time.perf_counter() - t0:.1f}s)")
+
+    print("Verificare la parità con: python -m ai_microservice.parity_check --backend <nome> --images <cartella>")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# backend/ai_microservice/georef.py
+#
+# Georeferenziazione dei poligoni: da pixel della crop a [lat, lng] (Web Mercator di
+# mercator.py, stessa convenzione di frontend/src/utils/geo.js) e area in m² come turf.area.
+# Tutti i vertici di tutti i poligoni passano in un'unica operazione NumPy.
+
+import numpy as np
+from mercator import crop_px_to_latlng
+
+EARTH_RADIUS_M = 6378137.0  # raggio usato da @turf/area
+
+
+def ring_areas_m2(lat, lng, lengths) -> np.ndarray:
+    """
+    Area sferica (m², come turf.area) di più anelli concatenati: `lengths` è il numero di
+    vertici di ciascun anello (non chiusi, almeno 3).
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if lengths.size == 0:
+        return np.zeros(0)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    first = np.repeat(starts, lengths)
+    local = np.arange(int(lengths.sum())) - first
+    n = np.repeat(lengths, lengths)
+    prev = first + (local - 1) % n
+    nxt = first + (local + 1) % n
+    lam = np.radians(np.asarray(lng, dtype=np.float64))
+    phi = np.radians(np.asarray(lat, dtype=np.float64))
+    terms = (lam[nxt] - lam[prev]) * np.sin(phi)
+    return np.abs(np.add.reduceat(terms, starts)) * EARTH_RADIUS_M ** 2 / 2
+
+
+def georef_params(lat, lng, zoom, bearing=None, crop_width=None, crop_height=None) -> dict:
+    if lat is None or lng is None or zoom is None:
+        raise ValueError("Il formato 'geo' richiede lat, lng e zoom")
+    return {
+        "lat": float(lat),
+        "lng": float(lng),
+        "zoom": float(zoom),
+        "bearing": float(bearing or 0.0),
+        "crop_width": int(crop_width) if crop_width else None,
+        "crop_height": int(crop_height) if crop_height else None,
+    }
+
+
+def georeference(results: list, out_size, geo: dict) -> list:
+    """
+    Poligoni in pixel (output di estrai_poligoni) -> poligoni in [lat, lng] con "mq",
+    nel formato di schemas.PolygonZone.
+    """
+    if not results:
+        return []
+    W, H = out_size
+    crop_w = geo["crop_width"] or W
+    crop_h = geo["crop_height"] or round(H * crop_w / W)
+    lengths = [len(p["points"]) for p in results]
+    pts = np.concatenate([np.asarray(p["points"], dtype=np.float64).reshape(-1, 2) for p in results])
+    lat, lng = crop_px_to_latlng(
+        pts[:, 0], pts[:, 1], geo["lat"], geo["lng"], geo["zoom"],
+        crop_w, crop_h, bearing=geo["bearing"], scale=crop_w / W,
+    )
+    areas = ring_areas_m2(lat, lng, lengths)
+    latlng = np.stack([lat, lng], axis=1)
+    out = []
+    start = 0
+    for p, n, mq in zip(results, lengths, areas):
+        out.append({
+            "points": latlng[start:start + n].tolist(),
+            "mq": round(float(mq)),
+            "label": p["label"],
+            "color": p["color"],
+            "tipo": p["tipo"],
+        })
+        start += n
+    return out
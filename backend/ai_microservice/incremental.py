@@ -0,0 +1,128 @@
+# backend/ai_microservice/incremental.py
+#
+# Risegmentazione incrementale delle crop spostate: le iterazioni di armonizzazione della
+# stessa cabina inviano crop sovrapposte all'80-95% (il centro si muove di poche decine di
+# pixel). Per ogni sessione (parametro `session` della richiesta) resta in memoria, per
+# AI_SESSION_TTL_S secondi, la griglia di logits dell'ultima crop con la sua estensione
+# georeferenziata (pixel globali Web Mercator allo zoom). Alla crop successiva:
+#   - lo spostamento si converte in celle di logits (1 cella = 4 pixel di input del modello)
+#   - le celle già coperte si copiano, tranne una fascia di AI_INCR_BORDER_CELLS lungo il
+#     vecchio bordo, dove il modello aveva poco contesto
+#   - nel modello passano solo le strisce scoperte, allargate di AI_INCR_CONTEXT_PX di contesto
+# Se le strisce superano AI_INCR_MAX_FRACTION dell'immagine si rifà il forward completo.
+# Vale per crop senza finestra scorrevole e senza bearing; lo spostamento è arrotondato
+# alla cella (errore massimo mezza cella, circa 1 px mappa per una crop da 300).
+
+import os
+import threading
+import time
+from collections import OrderedDict
+import torch
+
+SESSION_TTL_S = float(os.getenv("AI_SESSION_TTL_S", "120"))
+SESSION_MAX = int(os.getenv("AI_SESSION_MAX", "64"))
+INCR_CONTEXT_PX = int(os.getenv("AI_INCR_CONTEXT_PX", "32"))
+INCR_BORDER_CELLS = int(os.getenv("AI_INCR_BORDER_CELLS", "8"))
+INCR_MAX_FRACTION = float(os.getenv("AI_INCR_MAX_FRACTION", "0.7"))
+
+LOGIT_STRIDE = 4  # i logits Segformer sono a 1/4 della risoluzione di input
+ALIGN = 32  # regioni con lati multipli del fattore di riduzione dell'encoder
+
+
+class SessionCache:
+    """Ultima griglia di logits per sessione, con scadenza e limite di sessioni (LRU)."""
+
+    def __init__(self, ttl_s: float = SESSION_TTL_S, max_sessions: int = SESSION_MAX):
+        self.ttl_s = ttl_s
+        self.max_sessions = max(1, max_sessions)
+        self._entries = OrderedDict()  # sessione -> {key, origin, logits, t}
+        self._lock = threading.Lock()  # usata dai thread del pool di inferenza
+        self.hits = 0
+        self.misses = 0
+        self.inferred_fraction = 0.0  # somma delle frazioni di immagine passate nel modello
+
+    def get(self, session: str, key):
+        with self._lock:
+            entry = self._entries.get(session)
+            if entry is None or entry["key"] != key or time.monotonic() - entry["t"] > self.ttl_s:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry
+
+    def put(self, session: str, entry: dict, fraction: float):
+        with self._lock:
+            self._entries.pop(session, None)
+            self._entries[session] = dict(entry, t=time.monotonic())
+            self.inferred_fraction += fraction
+            now = time.monotonic()
+            for s in [s for s, e in self._entries.items() if now - e["t"] > self.ttl_s]:
+                del self._entries[s]
+            while len(self._entries) > self.max_sessions:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "sessions": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "mean_inferred_fraction": round(self.inferred_fraction / requests, 3) if requests else None,
+        }
+
+
+def _band(shift: int, n: int, border: int):
+    """Celle [a, b) da ricalcolare lungo un asse dopo uno spostamento di `shift` celle."""
+    if shift == 0:
+        return None
+    width = abs(shift) + border
+    if width >= n:
+        return 0, n
+    return (n - width, n) if shift > 0 else (0, width)
+
+
+def _context(a: int, b: int, n_px: int):
+    """Celle [a, b) -> pixel di input con il contesto, allineati ad ALIGN e dentro l'immagine."""
+    p0 = max(0, a * LOGIT_STRIDE - INCR_CONTEXT_PX) // ALIGN * ALIGN
+    p1 = min(n_px, -(-(b * LOGIT_STRIDE + INCR_CONTEXT_PX) // ALIGN) * ALIGN)
+    return p0, p1
+
+
+def infer_incremental(pixel_values, forward, prev, origin, cell):
+    """
+    Logits (C, h, w) di pixel_values (1, 3, H, W), riusando la voce di sessione `prev`
+    (None = forward completo). `origin` è l'angolo in alto a sinistra della crop e `cell`
+    il lato di una cella di logits, entrambi in pixel globali allo zoom.
+    Restituisce (logits, frazione dell'immagine passata nel modello).
+    """
+    _, _, H, W = pixel_values.shape
+    h, w = H // LOGIT_STRIDE, W // LOGIT_STRIDE
+    if prev is not None:
+        sx = round((origin[0] - prev["origin"][0]) / cell[0])
+        sy = round((origin[1] - prev["origin"][1]) / cell[1])
+        cols = _band(sx, w, INCR_BORDER_CELLS)
+        rows = _band(sy, h, INCR_BORDER_CELLS)
+        regions = []  # (riga0, riga1, col0, col1) in celle
+        if cols is not None:
+            regions.append((0, h) + cols)
+        if rows is not None:
+            # La striscia orizzontale salta le colonne già nella striscia verticale
+            c0, c1 = (0, w) if cols is None else ((0, cols[0]) if cols[0] > 0 else (cols[1], w))
+            if c1 > c0:
+                regions.append(rows + (c0, c1))
+        windows = [(_context(r0, r1, H), _context(c0, c1, W)) for r0, r1, c0, c1 in regions]
+        fraction = sum((y1 - y0) * (x1 - x0) for (y0, y1), (x0, x1) in windows) / (H * W)
+        if fraction <= INCR_MAX_FRACTION:
+            old = prev["logits"]
+            logits = torch.empty_like(old)
+            # Cella (i, j) nuova = cella (i + sy, j + sx) della crop precedente
+            y0, y1 = max(0, -sy), min(h, h - sy)
+            x0, x1 = max(0, -sx), min(w, w - sx)
+            if y1 > y0 and x1 > x0:
+                logits[:, y0:y1, x0:x1] = old[:, y0 + sy:y1 + sy, x0 + sx:x1 + sx]
+            for (r0, r1, c0, c1), ((py0, py1), (px0, px1)) in zip(regions, windows):
+                out = forward(pixel_values[:, :, py0:py1, px0:px1]).float().cpu()[0]
+                oy, ox = py0 // LOGIT_STRIDE, px0 // LOGIT_STRIDE
+                logits[:, r0:r1, c0:c1] = out[:, r0 - oy:r1 - oy, c0 - ox:c1 - ox]
+            return logits, fraction
+    return forward(pixel_values).float().cpu()[0], 1.0
@@ -0,0 +1,51 @@
+# backend/ai_microservice/lifecycle.py
+
+import time
+from contextlib import contextmanager
+
+
+class StartupState:
+    """
+    Stato di avvio del microservizio, per /healthz e /readyz: fase corrente, durata
+    di ogni fase (import, import del motore, caricamento modello, warmup) ed eventuale errore.
+    """
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.status = "starting"
+        self.phases = {}
+        self.error = None
+
+    @property
+    def ready(self) -> bool:
+        return self.status == "ready"
+
+    @contextmanager
+    def phase(self, name: str):
+        self.status = name
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t)
+
+    def record(self, name: str, seconds: float):
+        self.phases[name] = round(seconds, 3)
+        print(f"[AVVIO] fase '{name}': {seconds:.2f}s")
+
+    def mark_ready(self):
+        self.record("totale", time.perf_counter() - self.t0)
+        self.status = "ready"
+
+    def mark_failed(self, e: Exception):
+        print(f"[AVVIO] fallito nella fase '{self.status}': {e}")
+        self.status = "failed"
+        self.error = str(e)
+
+    def snapshot(self) -> dict:
+        return {
+            "status": self.status,
+            "uptime_s": round(time.perf_counter() - self.t0, 1),
+            "phases_s": dict(self.phases),
+            "error": self.error,
+        }
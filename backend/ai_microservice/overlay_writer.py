@@ -0,0 +1,128 @@
+# backend/ai_microservice/overlay_writer.py
+
+import itertools
+import os
+import queue
+import random
+import re
+import threading
+from datetime import datetime
+import cv2
+import numpy as np
+from PIL import Image
+from .common import PALETTE, upsample_pred
+
+MODES = ("off", "errors", "all")
+
+# LUT classe -> colore: l'overlay diventa un'indicizzazione uint8 invece di un loop per classe
+_LUT = np.zeros((256, 3), dtype=np.uint8)
+for _k, _rgb in PALETTE.items():
+    _LUT[_k] = _rgb
+
+
+def overlay_mask_on_image(image, pred, alpha=0.45):
+    image = np.asarray(image.convert("RGB"))
+    mask_rgb = _LUT[pred]
+    return cv2.addWeighted(image, 1 - alpha, mask_rgb, alpha, 0)
+
+
+class OverlayWriter:
+    """
+    Scrittura degli overlay di debug su un thread dedicato con coda limitata.
+    - mode "off": niente su disco; "errors": solo richieste fallite o senza poligoni;
+      "all": tutte (con campionamento `sample_rate`).
+    - se la coda è piena l'overlay viene scartato: il debug non aggiunge mai latenza.
+    - i nomi YYYYMMDD_n.jpg vengono da un contatore in memoria: la cartella si scansiona
+      una volta sola per giorno invece di provare os.path.exists a ogni scrittura.
+    """
+
+    def __init__(self, out_dir: str, mode: str = "all", sample_rate: float = 1.0, max_queue: int = 32):
+        if mode not in MODES:
+            raise ValueError(f"Modalità overlay non valida: {mode} (valide: {', '.join(MODES)})")
+        self.out_dir = out_dir
+        self.mode = mode
+        self.sample_rate = min(1.0, max(0.0, float(sample_rate)))
+        self._queue = queue.Queue(maxsize=max(1, int(max_queue)))
+        self._thread = None
+        self._day = None
+        self._seq = None
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.failed = 0
+
+    def start(self):
+        if self.mode == "off" or self._thread is not None:
+            return
+        os.makedirs(self.out_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="overlay-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, img, pred=None, error: bool = False) -> bool:
+        """Accoda un overlay (pred=None salva solo l'immagine). Non blocca mai."""
+        if self._thread is None or (self.mode == "errors" and not error):
+            return False
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return False
+        try:
+            self._queue.put_nowait((img, pred, error))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _next_name(self):
+        day = datetime.now().strftime("%Y%m%d")
+        if day != self._day:
+            # Riparte dal progressivo più alto già presente per il giorno (una scansione sola)
+            pattern = re.compile(rf"^{day}_(\d+)(?:_err)?\.jpg$")
+            last = 0
+            for name in os.listdir(self.out_dir):
+                m = pattern.match(name)
+                if m:
+                    last = max(last, int(m.group(1)))
+            self._day = day
+            self._seq = itertools.count(last + 1)
+        return f"{day}_{next(self._seq)}"
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            img, pred, error = item
+            try:
+                name = self._next_name() + ("_err" if error else "")
+                out_path = os.path.join(self.out_dir, f"{name}.jpg")
+                if pred is None:
+                    img.convert("RGB").save(out_path)
+                else:
+                    overlay_img = overlay_mask_on_image(img, upsample_pred(pred, img.size))
+                    Image.fromarray(overlay_img).save(out_path)
+                self.written += 1
+                print(f"[SALVATO] Overlay maschera: {out_path}")
+            except Exception as e:
+                self.failed += 1
+                print("[OVERLAY] scrittura fallita:", e)
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "sample_rate": self.sample_rate,
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "failed": self.failed,
+        }
@@ -0,0 +1,116 @@
+# backend/ai_microservice/parity_check.py
+#
+# Confronta un backend di inferenza con il modello PyTorch fp32 di riferimento:
+# per ogni classe calcola l'IoU tra le maschere predette dai due backend (accumulata
+# su tutte le immagini) e la deriva (1 - IoU), più accordo pixel e latenza media.
+#
+# Uso (dalla cartella backend):
+#   python -m ai_microservice.parity_check --backend onnx_int8 --images ..\segformer\images
+
+import argparse
+import glob
+import json
+import os
+import time
+import numpy as np
+import torch
+from PIL import Image
+from transformers import SegformerForSemanticSegmentation, SegformerFeatureExtractor
+from .backends import BACKENDS, TorchBackend, create_backend
+from .engine import CVAT_CLASSES, MODEL_PATH
+
+N_CLASSES = len(CVAT_CLASSES)
+
+
+def _preds(backend, pixel_values):
+    t0 = time.perf_counter()
+    logits = backend(pixel_values)
+    dt = time.perf_counter() - t0
+    return logits.argmax(dim=1).cpu().numpy(), dt
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Deriva IoU per classe di un backend rispetto al fp32 PyTorch")
+    ap.add_argument("--backend", required=True, choices=[b for b in BACKENDS if b != "torch"])
+    ap.add_argument("--images", required=True, help="cartella con immagini .jpg/.png")
+    ap.add_argument("--model-path", default=MODEL_PATH)
+    ap.add_argument("--limit", type=int, default=200)
+    ap.add_argument("--batch-size", type=int, default=4)
+    ap.add_argument("--max-drift", type=float, default=0.02, help="deriva IoU massima accettata per classe")
+    ap.add_argument("--json", help="salva il report anche in JSON")
+    args = ap.parse_args()
+
+    paths = sorted(
+        p for ext in ("*.jpg", "*.jpeg", "*.png") for p in glob.glob(os.path.join(args.images, ext))
+    )[: args.limit]
+    if not paths:
+        raise SystemExit(f"Nessuna immagine trovata in {args.images}")
+
+    cpu = torch.device("cpu")
+    feature_extractor = SegformerFeatureExtractor.from_pretrained(args.model_path)
+    reference = TorchBackend(SegformerForSemanticSegmentation.from_pretrained(args.model_path).eval(), cpu)
+    candidate = create_backend(args.backend, args.model_path, cpu, load_torch_model=None)
+
+    inter = np.zeros(N_CLASSES, dtype=np.int64)
+    union = np.zeros(N_CLASSES, dtype=np.int64)
+    ref_px = np.zeros(N_CLASSES, dtype=np.int64)
+    same_px = 0
+    tot_px = 0
+    t_ref = t_cand = 0.0
+
+    for i in range(0, len(paths), args.batch_size):
+        imgs = [Image.open(p).convert("RGB") for p in paths[i:i + args.batch_size]]
+        pixel_values = feature_extractor(images=imgs, return_tensors="pt")["pixel_values"]
+        ref, dt_r = _preds(reference, pixel_values)
+        cand, dt_c = _preds(candidate, pixel_values)
+        t_ref += dt_r
+        t_cand += dt_c
+        for k in range(N_CLASSES):
+            r, c = ref == k, cand == k
+            inter[k] += np.count_nonzero(r & c)
+            union[k] += np.count_nonzero(r | c)
+            ref_px[k] += np.count_nonzero(r)
+        same_px += np.count_nonzero(ref == cand)
+        tot_px += ref.size
+
+    report = {
+        "backend": args.backend,
+        "images": len(paths),
+        "pixel_agreement": round(same_px / tot_px, 5),
+        "ms_per_image": {
+            "torch_fp32": round(t_ref * 1000 / len(paths), 2),
+            args.backend: round(t_cand * 1000 / len(paths), 2),
+        },
+        "classes": [],
+    }
+    for c in CVAT_CLASSES:
+        k = c["id"]
+        # Classe assente in entrambe le predizioni: nessuna deriva misurabile
+        iou = inter[k] / union[k] if union[k] else 1.0
+        report["classes"].append({
+            "id": k,
+            "label": c["label"],
+            "ref_pixels": int(ref_px[k]),
+            "iou_vs_fp32": round(float(iou), 5),
+            "drift": round(float(1.0 - iou), 5),
+        })
+    worst = max(c["drift"] for c in report["classes"])
+    report["max_drift"] = worst
+    report["accepted"] = worst <= args.max_drift
+
+    print(f"\nBackend {args.backend} vs torch fp32 su {len(paths)} immagini")
+    print(f"Accordo pixel: {report['pixel_agreement']:.4%}")
+    print(f"Latenza media: fp32 {report['ms_per_image']['torch_fp32']} ms/img, "
+          f"{args.backend} {report['ms_per_image'][args.backend]} ms/img")
+    print(f"{'classe':<22}{'pixel rif.':>12}{'IoU':>10}{'deriva':>10}")
+    for c in report["classes"]:
+        print(f"{c['label']:<22}{c['ref_pixels']:>12}{c['iou_vs_fp32']:>10.4f}{c['drift']:>10.4f}")
+    print(f"Deriva massima {worst:.4f} -> {'ACCETTATO' if report['accepted'] else 'RIFIUTATO'} (soglia {args.max_drift})")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
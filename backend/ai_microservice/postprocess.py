@@ -0,0 +1,95 @@
+# backend/ai_microservice/postprocess.py
+#
+# Post-processing della predizione: dalla mappa di classi (tipicamente alla risoluzione
+# dei logits, 1/4 dell'input del modello) ai poligoni in pixel della crop originale.
+# Niente upsampling della maschera: i contorni si estraggono sulla mappa piccola e si
+# riscalano; componenti troppo piccole vengono scartate e i poligoni semplificati con
+# una tolleranza in metri convertita in pixel in base allo zoom.
+
+import os
+import cv2
+import numpy as np
+import mercator
+from .common import ID_TO_CLASS
+
+# Area minima di una componente, in pixel della crop originale
+MIN_AREA_PX = float(os.getenv("AI_MIN_AREA_PX", "16"))
+# Tolleranza di semplificazione (Douglas-Peucker): in metri se la richiesta ha lo zoom,
+# altrimenti in pixel della crop
+SIMPLIFY_M = float(os.getenv("AI_SIMPLIFY_M", "0.3"))
+SIMPLIFY_PX = float(os.getenv("AI_SIMPLIFY_PX", "1.0"))
+# 1 = contorni alla risoluzione dei logits e riscalati, 0 = maschera upsamplata (comportamento storico)
+CONTOURS_AT_LOGITS = os.getenv("AI_CONTOURS_AT_LOGITS", "1") == "1"
+
+DEFAULT_LAT = 42.0  # centro Italia, se la richiesta non ha la latitudine
+
+
+def meters_per_pixel(zoom: float, lat: float = None) -> float:
+    lat = DEFAULT_LAT if lat is None else lat
+    return float(mercator.meters_per_pixel(zoom, lat))
+
+
+def postprocess_params(zoom: float = None, lat: float = None) -> dict:
+    """Parametri effettivi per una richiesta (entrano anche nella chiave della cache)."""
+    if zoom is not None and SIMPLIFY_M > 0:
+        simplify_px = SIMPLIFY_M / meters_per_pixel(zoom, lat)
+    else:
+        simplify_px = SIMPLIFY_PX
+    return {
+        "min_area_px": MIN_AREA_PX,
+        "simplify_px": round(simplify_px, 3),
+        "at_logits": CONTOURS_AT_LOGITS,
+    }
+
+
+def estrai_poligoni(pred: np.ndarray, out_size, params: dict):
+    """
+    Poligoni per tutte le classi (escluso il background) in pixel della crop di
+    dimensione out_size=(larghezza, altezza). `pred` può avere una risoluzione minore.
+    """
+    W, H = out_size
+    pred = np.ascontiguousarray(pred, dtype=np.uint8)
+    if not params["at_logits"] and pred.shape != (H, W):
+        pred = cv2.resize(pred, (W, H), interpolation=cv2.INTER_NEAREST)
+    h, w = pred.shape
+    sx, sy = W / w, H / h
+    min_area = params["min_area_px"] / (sx * sy)  # in pixel della mappa di classi
+    eps = params["simplify_px"]
+
+    counts = np.bincount(pred.ravel(), minlength=len(ID_TO_CLASS))
+    print("Classi pixel predetti e conteggi:", {k: int(v) for k, v in enumerate(counts) if v})
+
+    results = []
+    for class_id in np.nonzero(counts)[0]:
+        if class_id == 0:
+            continue
+        class_info = ID_TO_CLASS.get(int(class_id), {"label": str(class_id), "color": "#222"})
+        # Tutte le componenti connesse della classe con le loro statistiche in un colpo solo
+        mask = (pred == class_id).view(np.uint8)
+        n, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        keep = np.nonzero(stats[1:, cv2.CC_STAT_AREA] >= min_area)[0] + 1
+        print(f"Classe {class_id} ({class_info['label']}): {n - 1} componenti, {len(keep)} sopra l'area minima")
+        for i in keep:
+            x, y, bw, bh = (int(v) for v in stats[i, :4])
+            # Contorno calcolato solo sul bounding box della componente
+            roi = (labels[y:y + bh, x:x + bw] == i).view(np.uint8)
+            contours, _ = cv2.findContours(roi, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x, y))
+            if not contours:
+                continue
+            pts = max(contours, key=len).reshape(-1, 2).astype(np.float32)
+            # Da centro pixel della mappa piccola a coordinate della crop
+            pts[:, 0] = (pts[:, 0] + 0.5) * sx - 0.5
+            pts[:, 1] = (pts[:, 1] + 0.5) * sy - 0.5
+            if eps > 0 and len(pts) > 3:
+                pts = cv2.approxPolyDP(pts.reshape(-1, 1, 2), eps, True).reshape(-1, 2)
+            if len(pts) < 3:
+                continue
+            pts[:, 0] = np.clip(pts[:, 0], 0, W - 1)
+            pts[:, 1] = np.clip(pts[:, 1], 0, H - 1)
+            results.append({
+                "points": np.rint(pts).astype(np.int32).tolist(),
+                "label": class_info["label"],
+                "color": class_info["color"],
+                "tipo": class_info["label"]
+            })
+    return results
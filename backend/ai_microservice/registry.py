@@ -0,0 +1,142 @@
+# backend/ai_microservice/registry.py
+
+import asyncio
+import random
+import time
+
+
+class ModelRegistry:
+    """
+    Versioni del modello note al servizio e instradamento delle richieste.
+    - "active": versione che serve il traffico; "candidate": versione in prova che riceve
+      una quota `canary_share` delle richieste (0..1).
+    - una nuova versione si carica e si scalda in background (via `loader`) mentre la
+      versione attiva continua a servire; lo scambio è una sola assegnazione, quindi
+      le richieste in corso finiscono con il modello con cui sono partite.
+    - la versione attiva precedente resta caricata come "previous" per il rollback.
+    Le versioni sono le spec (versione, percorso, backend) di engine.model_spec.
+    """
+
+    def __init__(self, loader, unloader=None, canary_share: float = 0.0):
+        self._loader = loader        # async (spec) -> {"model_load": s, "warmup": s}
+        self._unloader = unloader    # async (versione) -> None
+        self._lock = asyncio.Lock()  # un caricamento/scambio alla volta
+        self._versions = {}          # versione -> info
+        self.active = None
+        self.candidate = None
+        self.previous = None
+        self.canary_share = self._clamp(canary_share)
+
+    @staticmethod
+    def _clamp(share) -> float:
+        return min(1.0, max(0.0, float(share)))
+
+    def spec(self, version: str) -> tuple:
+        info = self._versions.get(version)
+        if info is None:
+            raise KeyError(f"Versione del modello sconosciuta: {version}")
+        return info["spec"]
+
+    def pick(self) -> tuple:
+        """Spec della versione che deve servire la richiesta (canary compreso)."""
+        active, candidate = self.active, self.candidate
+        if candidate is not None and self.canary_share > 0 and random.random() < self.canary_share:
+            version = candidate
+        else:
+            version = active
+        info = self._versions[version]
+        info["requests"] += 1
+        return info["spec"]
+
+    async def load(self, spec: tuple, role: str = "candidate", canary_share: float = None) -> dict:
+        """
+        Carica e scalda `spec`, poi la installa come "active" o "candidate".
+        Una versione già pronta non viene ricaricata.
+        """
+        if role not in ("active", "candidate"):
+            raise ValueError(f"Ruolo non valido: {role} (validi: active, candidate)")
+        version = spec[0]
+        async with self._lock:
+            info = self._versions.get(version)
+            if info is None or info["status"] != "ready":
+                info = {
+                    "spec": spec, "status": "loading", "error": None, "requests": 0,
+                    "model_load_s": None, "warmup_s": None, "loaded_at": None,
+                }
+                self._versions[version] = info
+                print(f"[REGISTRY] caricamento {version} ({role})")
+                try:
+                    timings = await self._loader(spec)
+                except Exception as e:
+                    info["status"] = "failed"
+                    info["error"] = str(e)
+                    print(f"[REGISTRY] caricamento {version} fallito: {e}")
+                    raise
+                info.update(
+                    status="ready",
+                    model_load_s=round(timings["model_load"], 3),
+                    warmup_s=round(timings["warmup"], 3),
+                    loaded_at=time.time(),
+                )
+            if role == "active":
+                await self._promote(version)
+            else:
+                self.candidate = version
+                if canary_share is not None:
+                    self.canary_share = self._clamp(canary_share)
+                print(f"[REGISTRY] candidata {version}, quota canary {self.canary_share:.2f}")
+            return self.snapshot()
+
+    async def promote(self, version: str = None) -> dict:
+        """La candidata (o `version`, già pronta) diventa attiva."""
+        async with self._lock:
+            version = version or self.candidate
+            if version is None:
+                raise ValueError("Nessuna versione candidata da promuovere")
+            if self._versions.get(version, {}).get("status") != "ready":
+                raise ValueError(f"Versione non pronta: {version}")
+            await self._promote(version)
+            return self.snapshot()
+
+    async def rollback(self) -> dict:
+        """Torna alla versione attiva precedente, se ancora caricata."""
+        if self.previous is None:
+            raise ValueError("Nessuna versione precedente")
+        return await self.promote(self.previous)
+
+    def set_canary(self, share: float) -> dict:
+        self.canary_share = self._clamp(share)
+        return self.snapshot()
+
+    async def _promote(self, version):
+        old = self.active
+        self.active = version  # scambio atomico: le nuove richieste usano subito la nuova versione
+        if self.candidate == version:
+            self.candidate = None
+        if old is not None and old != version:
+            retired, self.previous = self.previous, old
+            if retired not in (None, self.active, self.candidate, self.previous):
+                await self._retire(retired)
+        print(f"[REGISTRY] attiva {version} (precedente {self.previous})")
+
+    async def _retire(self, version):
+        self._versions[version]["status"] = "retired"
+        if self._unloader is not None:
+            try:
+                await self._unloader(version)
+            except Exception as e:
+                print(f"[REGISTRY] scaricamento {version} fallito: {e}")
+        print(f"[REGISTRY] ritirata {version}")
+
+    def snapshot(self) -> dict:
+        return {
+            "active": self.active,
+            "candidate": self.candidate,
+            "previous": self.previous,
+            "canary_share": self.canary_share,
+            "versions": {
+                v: dict({k: val for k, val in info.items() if k != "spec"},
+                        path=info["spec"][1], backend=info["spec"][2])
+                for v, info in self._versions.items()
+            },
+        }
@@ -0,0 +1,105 @@
+# backend/ai_microservice/tiling.py
+#
+# Inferenza a finestra scorrevole per crop grandi: invece di schiacciare tutto a 512x512
+# col feature_extractor, l'immagine viene tagliata in tile della dimensione nativa del
+# modello (con sovrapposizione), le tile di un'immagine passano insieme nel forward
+# (a blocchi di TILE_BATCH per limitare la memoria) e i logits vengono fusi con una
+# finestra di pesi. Il costo cresce con l'area e il dettaglio resta quello originale.
+
+import math
+import os
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# Lato della tile (multiplo di 32, il fattore di riduzione dell'encoder Segformer)
+TILE_SIZE = int(os.getenv("AI_TILE_SIZE", "512"))
+TILE_OVERLAP = int(os.getenv("AI_TILE_OVERLAP", "128"))
+# Fusione dei logits nelle zone sovrapposte: gaussian | linear | mean
+TILE_BLEND = os.getenv("AI_TILE_BLEND", "gaussian")
+# Tile per singolo forward pass
+TILE_BATCH = int(os.getenv("AI_TILE_BATCH", "8"))
+# Le immagini con lato maggiore oltre questa soglia usano la finestra scorrevole (0 = mai)
+TILE_MIN_SIDE = int(os.getenv("AI_TILE_MIN_SIDE", "768"))
+
+LOGIT_STRIDE = 4  # i logits Segformer sono a 1/4 della risoluzione di input
+
+
+def use_tiling(img) -> bool:
+    return TILE_MIN_SIDE > 0 and max(img.size) > TILE_MIN_SIDE
+
+
+def positions(length: int, tile: int, stride: int):
+    """Origini delle tile lungo un asse: passo fisso più un'ultima tile allineata al bordo."""
+    if length <= tile:
+        return [0]
+    pos = list(range(0, length - tile, stride))
+    pos.append(length - tile)
+    return pos
+
+
+def blend_window(size: int, mode: str = TILE_BLEND) -> torch.Tensor:
+    """Pesi 2D (size x size) alla risoluzione dei logits: alti al centro, bassi ai bordi."""
+    idx = torch.arange(size, dtype=torch.float32)
+    if mode == "gaussian":
+        center = (size - 1) / 2.0
+        sigma = size / 4.0
+        w1 = torch.exp(-((idx - center) ** 2) / (2 * sigma ** 2))
+    elif mode == "linear":
+        w1 = torch.minimum(idx + 1, size - idx) / math.ceil(size / 2)
+    elif mode == "mean":
+        w1 = torch.ones(size)
+    else:
+        raise ValueError(f"Fusione tile non valida: {mode}")
+    return torch.outer(w1, w1).clamp_min(1e-3)
+
+
+def normalize(img, feature_extractor) -> torch.Tensor:
+    """Stessa normalizzazione del feature_extractor, ma senza resize: (3, H, W) float32."""
+    arr = np.asarray(img, dtype=np.float32) * float(feature_extractor.rescale_factor)
+    mean = np.asarray(feature_extractor.image_mean, dtype=np.float32)
+    std = np.asarray(feature_extractor.image_std, dtype=np.float32)
+    arr = (arr - mean) / std
+    return torch.from_numpy(np.ascontiguousarray(arr.transpose(2, 0, 1)))
+
+
+def infer_tiled(img, forward, feature_extractor, tile: int = TILE_SIZE, overlap: int = TILE_OVERLAP,
+                blend: str = TILE_BLEND, tile_batch: int = TILE_BATCH) -> np.ndarray:
+    """
+    Mappa di classi (uint8) a 1/4 della risoluzione dell'immagine, ottenuta fondendo
+    i logits delle tile. `forward` è il backend: pixel_values (B,3,t,t) -> logits (B,C,t/4,t/4).
+    """
+    if tile % 32:
+        raise ValueError("AI_TILE_SIZE deve essere multiplo di 32")
+    x = normalize(img, feature_extractor)
+    _, H, W = x.shape
+    # Padding (replica del bordo) fino a multipli di 4 e almeno una tile per lato
+    Hp = max(tile, -(-H // LOGIT_STRIDE) * LOGIT_STRIDE)
+    Wp = max(tile, -(-W // LOGIT_STRIDE) * LOGIT_STRIDE)
+    if (Hp, Wp) != (H, W):
+        x = F.pad(x[None], (0, Wp - W, 0, Hp - H), mode="replicate")[0]
+
+    stride = max(LOGIT_STRIDE, (tile - overlap) // LOGIT_STRIDE * LOGIT_STRIDE)
+    coords = [(y, x0) for y in positions(Hp, tile, stride) for x0 in positions(Wp, tile, stride)]
+
+    t4 = tile // LOGIT_STRIDE
+    weights = blend_window(t4, blend)
+    acc = None
+    wsum = torch.zeros(Hp // LOGIT_STRIDE, Wp // LOGIT_STRIDE)
+
+    for i in range(0, len(coords), max(1, tile_batch)):
+        chunk = coords[i:i + tile_batch]
+        batch = torch.stack([x[:, y:y + tile, x0:x0 + tile] for y, x0 in chunk])
+        logits = forward(batch).float().cpu()
+        if acc is None:
+            acc = torch.zeros(logits.shape[1], Hp // LOGIT_STRIDE, Wp // LOGIT_STRIDE)
+        for (y, x0), lg in zip(chunk, logits):
+            ys, xs = y // LOGIT_STRIDE, x0 // LOGIT_STRIDE
+            acc[:, ys:ys + t4, xs:xs + t4] += lg * weights
+            wsum[ys:ys + t4, xs:xs + t4] += weights
+
+    pred = (acc / wsum).argmax(dim=0)
+    # Si scarta il padding: restano ceil(H/4) x ceil(W/4) celle
+    pred = pred[: -(-H // LOGIT_STRIDE), : -(-W // LOGIT_STRIDE)]
+    print(f"[TILING] {W}x{H}: {len(coords)} tile {tile}px (overlap {overlap}, fusione {blend})")
+    return pred.numpy().astype(np.uint8)
@@ -0,0 +1,76 @@
+# backend/ai_microservice/tta.py
+#
+# Test-time augmentation: la crop passa nel modello insieme alle sue versioni ribaltate
+# e ruotate di 90° in un unico forward pass (il batch si moltiplica per il numero di
+# trasformazioni), le probabilità vengono riportate nel sistema di riferimento originale
+# con la trasformazione inversa e mediate. Utile quando una sola passata non trova
+# le classi cercate: stesso costo di latenza di un batch più grande, non di N chiamate.
+#
+# Modalità (parametro `tta` della richiesta): flip | rot | d4, oppure un elenco di
+# trasformazioni separate da virgola (l'identità è sempre inclusa).
+
+import os
+
+# Immagini massime per forward (batch x trasformazioni): oltre si spezza in più passate
+# per limitare la memoria; una crop anche in d4 (8 immagini) resta un solo forward
+TTA_MAX_BATCH = int(os.getenv("AI_TTA_MAX_BATCH", "8"))
+
+TRANSFORMS = {
+    # nome: (diretta, inversa) su tensori (B, C, H, W)
+    "id": (lambda x: x, lambda x: x),
+    "hflip": (lambda x: x.flip(3), lambda x: x.flip(3)),
+    "vflip": (lambda x: x.flip(2), lambda x: x.flip(2)),
+    "rot90": (lambda x: x.rot90(1, (2, 3)), lambda x: x.rot90(-1, (2, 3))),
+    "rot180": (lambda x: x.rot90(2, (2, 3)), lambda x: x.rot90(2, (2, 3))),
+    "rot270": (lambda x: x.rot90(3, (2, 3)), lambda x: x.rot90(-3, (2, 3))),
+    "transpose": (lambda x: x.transpose(2, 3), lambda x: x.transpose(2, 3)),
+    "antitranspose": (lambda x: x.rot90(2, (2, 3)).transpose(2, 3), lambda x: x.rot90(2, (2, 3)).transpose(2, 3)),
+}
+# Trasformazioni che scambiano gli assi: solo per input quadrati (512x512, tile)
+_SWAP_AXES = {"rot90", "rot270", "transpose", "antitranspose"}
+
+TTA_MODES = {
+    "flip": ("id", "hflip", "vflip"),
+    "rot": ("id", "rot90", "rot180", "rot270"),
+    "d4": tuple(TRANSFORMS),  # tutte le simmetrie del quadrato
+}
+
+
+def parse_tta(value):
+    """'flip' / 'hflip,rot90' / vuoto -> tupla ordinata di trasformazioni (None = niente TTA)."""
+    if not value or str(value).strip().lower() in ("0", "none", "off", "false"):
+        return None
+    value = str(value).strip().lower()
+    if value in TTA_MODES:
+        return TTA_MODES[value]
+    names = {v.strip() for v in value.split(",") if v.strip()} | {"id"}
+    invalid = sorted(names - TRANSFORMS.keys())
+    if invalid:
+        raise ValueError(
+            f"TTA non valida: {', '.join(invalid)} (modalità: {', '.join(TTA_MODES)}; "
+            f"trasformazioni: {', '.join(TRANSFORMS)})"
+        )
+    return tuple(t for t in TRANSFORMS if t in names)
+
+
+def tta_forward(forward, transforms, max_batch: int = TTA_MAX_BATCH):
+    """
+    Avvolge un backend (pixel_values -> logits) in modo che ogni immagine del batch passi
+    con tutte le trasformazioni nello stesso forward; restituisce le probabilità medie
+    (B, C, h, w) nel riferimento originale, utilizzabili al posto dei logits (argmax, fusione tile).
+    """
+    import torch  # solo qui: parse_tta serve ad ai_api prima che il motore sia importato
+
+    def run(pixel_values):
+        B, _, H, W = pixel_values.shape
+        names = [t for t in transforms if H == W or t not in _SWAP_AXES]
+        batch = torch.cat([TRANSFORMS[t][0](pixel_values) for t in names])
+        step = max(1, max_batch)
+        probs = torch.cat([forward(batch[i:i + step]).float().softmax(dim=1) for i in range(0, len(batch), step)])
+        acc = None
+        for i, t in enumerate(names):
+            p = TRANSFORMS[t][1](probs[i * B:(i + 1) * B])
+            acc = p if acc is None else acc + p
+        return acc / len(names)
+
+    return run
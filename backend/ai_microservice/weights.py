@@ -0,0 +1,41 @@
+# backend/ai_microservice/weights.py
+#
+# Caricamento dei pesi Segformer memory-mapped da safetensors: i processi del pool
+# mappano lo stesso file in sola lettura, quindi il sistema operativo tiene in RAM
+# una sola copia dei pesi (page cache) invece di una per worker.
+
+import os
+from safetensors.torch import load_file, save_file
+from transformers import SegformerConfig, SegformerForSemanticSegmentation
+
+SAFETENSORS_NAME = "model.safetensors"
+
+
+def ensure_safetensors(model_path: str) -> str:
+    """
+    Restituisce il percorso del file safetensors del modello. Se il checkpoint ha solo
+    pytorch_model.bin lo converte una volta sola (nel processo principale, prima di
+    avviare i worker).
+    """
+    path = os.path.join(model_path, SAFETENSORS_NAME)
+    if os.path.exists(path):
+        return path
+    print(f"[PESI] {SAFETENSORS_NAME} assente, conversione da checkpoint in {model_path}...")
+    m = SegformerForSemanticSegmentation.from_pretrained(model_path)
+    save_file({k: v.contiguous() for k, v in m.state_dict().items()}, path)
+    return path
+
+
+def load_shared_model(model_path: str):
+    """
+    Costruisce il modello e sostituisce i suoi pesi (assign=True, nessuna copia) con i
+    tensori di safetensors, viste sul file mappato; i pesi inizializzati dal costruttore
+    vengono liberati subito. La mappatura appartiene ai tensori: si chiude quando il
+    modello viene scaricato (LRU delle versioni in engine.py). Solo per inferenza CPU.
+    """
+    config = SegformerConfig.from_pretrained(model_path)
+    state = load_file(ensure_safetensors(model_path), device="cpu")
+    model = SegformerForSemanticSegmentation(config)
+    model.load_state_dict(state, strict=True, assign=True)
+    model.eval()
+    return model
@@ -0,0 +1,171 @@
+#backend/armonizzazione_batch/area.py
+#
+# Armonizzazione per aree: le cabine vicine (spesso a grappolo nel raggio di pochi km)
+# vengono raggruppate su una griglia in pixel globali, e per ogni gruppo si costruisce un
+# solo mosaico dalle tile che le contiene tutte, più il margine di mezza crop attorno a
+# ciascuna. Il mosaico è segmentato una volta: oltre AI_TILE_MIN_SIDE il motore usa la
+# finestra scorrevole. Ogni cabina riceve lo "Stalli AT" che la contiene o il più vicino,
+# entro la mezza crop che avrebbe visto da sola. Immagini e inferenza sono quindi pagate
+# una volta per gruppo invece che per cabina e per iterazione.
+#
+# Il mosaico è alla stessa scala che il modello vede nelle crop singole (crop_size pixel
+# mappa portati a 512 dal feature_extractor): lo zoom del mosaico è zoom + log2(512 / crop_size),
+# quindi dalle tile a risoluzione più alta invece di ingrandire quelle allo zoom della mappa.
+
+import math
+import os
+import time
+from collections import defaultdict
+import numpy as np
+from shapely.geometry import Point, Polygon
+from ai_client import ai
+from mercator import crop_px_to_latlng, global_px_to_latlng, latlng_to_crop_px, latlng_to_global_px
+from armonizzazione_single_cabin.coord_optimizer import AI_SEMAPHORE, punto_centrale
+from armonizzazione_single_cabin.router import salva_geom_centered
+from armonizzazione_single_cabin.tile_source import build_crop_jpeg, get_tile_provider
+
+MODEL_INPUT_PX = 512  # lato a cui il feature_extractor porta le crop singole
+# Lato massimo del mosaico (px immagine): limita memoria e tempo di un'inferenza
+AREA_MAX_PX = int(os.getenv("AREA_MAX_PX", "2048"))
+AREA_EDGE_PX = 8  # poligono più vicino di così al bordo del mosaico: probabilmente tagliato
+
+
+# Soglia AI_TILE_MIN_SIDE del motore letta dal suo /status (vedi lato_tiled): riletta dopo
+# AREA_TILING_TTL_S secondi (riavvii del motore) o quando una risposta arriva da un'altra
+# versione del modello
+AREA_TILING_TTL_S = float(os.getenv("AREA_TILING_TTL_S", "300"))
+_tiling = None  # {"min_side", "model_version", "t"}
+
+
+async def lato_tiled() -> int:
+    """
+    Lato minimo (px) da cui il motore segmenta a finestra scorrevole, come riportato da
+    /status (tiling.min_side): i mosaici più grandi di una crop si allargano fin qui, così
+    non vengono rimpiccioliti a 512. 0 se il motore ha la finestra scorrevole disattivata.
+    """
+    global _tiling
+    if _tiling is None or time.monotonic() - _tiling["t"] > AREA_TILING_TTL_S:
+        res = await ai.status()
+        if res.status_code == 503:
+            raise RuntimeError("Motore AI in avvio, riprovare tra poco")
+        res.raise_for_status()
+        status = res.json()
+        if status.get("tiling") is None:
+            raise RuntimeError("Motore AI in avvio, riprovare tra poco")
+        min_side = int(status["tiling"]["min_side"])
+        if _tiling is None or _tiling["min_side"] != min_side:
+            print(f"[AREA] finestra scorrevole del motore oltre {min_side} px")
+            if min_side <= 0:
+                print("[AREA] ATTENZIONE: finestra scorrevole disattivata nel motore (AI_TILE_MIN_SIDE=0), "
+                      "i mosaici oltre 512 px saranno rimpiccioliti")
+        _tiling = {"min_side": min_side, "model_version": status.get("model_version"), "t": time.monotonic()}
+    min_side = _tiling["min_side"]
+    return min_side + 1 if min_side > 0 else 0
+
+
+def _versione_risposta(model_version):
+    """Risposta da un'altra versione del modello: la soglia si rilegge al prossimo mosaico."""
+    global _tiling
+    if _tiling is not None and model_version and model_version != _tiling["model_version"]:
+        _tiling = None
+
+
+def scala_mosaico(crop_size: int) -> float:
+    """Pixel del mosaico per pixel mappa allo zoom delle crop singole."""
+    return MODEL_INPUT_PX / crop_size
+
+
+def raggruppa_cabine(cabine: list, zoom: float, crop_size: int, max_px: int = AREA_MAX_PX) -> list:
+    """
+    Gruppi di cabine (dict con chk, lat, lng) che stanno in un mosaico di al più max_px
+    di lato: celle di una griglia in pixel globali, meno il margine di mezza crop per lato.
+    """
+    if not cabine:
+        return []
+    cell = max(1.0, max_px / scala_mosaico(crop_size) - crop_size)
+    x, y = latlng_to_global_px([c["lat"] for c in cabine], [c["lng"] for c in cabine], zoom)
+    gruppi = defaultdict(list)
+    for c, gx, gy in zip(cabine, np.floor(x / cell).astype(np.int64), np.floor(y / cell).astype(np.int64)):
+        gruppi[(int(gy), int(gx))].append(c)
+    # Gruppi nell'ordine della loro prima cabina: con l'elenco già lungo la curva di Hilbert
+    # (vedi jobs.ordina_cabine) mosaici vicini si susseguono e riusano le tile in cache
+    return list(gruppi.values())
+
+
+async def armonizza_area(gruppo: list, zoom: float, crop_size: int) -> dict:
+    """
+    Un mosaico e una segmentazione per il gruppo. Restituisce {chk: risultato} con status
+    done (coordinata salvata), not_found (nessuno Stalli AT abbastanza vicino) o edge
+    (Stalli AT tagliato dal bordo del mosaico).
+    """
+    t0 = time.perf_counter()
+    provider = get_tile_provider()
+    if provider is None:
+        raise RuntimeError("L'armonizzazione per aree richiede un provider di tile (TILE_URL o TILE_MBTILES)")
+    f = scala_mosaico(crop_size)
+    mz = zoom + math.log2(f)
+    lat = np.array([c["lat"] for c in gruppo], dtype=np.float64)
+    lng = np.array([c["lng"] for c in gruppo], dtype=np.float64)
+
+    # Estensione: tutte le cabine più mezza crop per lato, in pixel del mosaico
+    gx, gy = latlng_to_global_px(lat, lng, mz)
+    margin = crop_size / 2 * f
+    x0, x1 = float(gx.min()) - margin, float(gx.max()) + margin
+    y0, y1 = float(gy.min()) - margin, float(gy.max()) + margin
+    W, H = math.ceil(x1 - x0), math.ceil(y1 - y0)
+    tiled_px = await lato_tiled()
+    if max(W, H) > MODEL_INPUT_PX + 1 and max(W, H) < tiled_px:
+        if W >= H:
+            W = tiled_px
+        else:
+            H = tiled_px
+    clat, clng = (float(v) for v in global_px_to_latlng((x0 + x1) / 2, (y0 + y1) / 2, mz))
+
+    jpeg = await build_crop_jpeg(provider, clat, clng, mz, W, height=H)
+    meta = {"lat": clat, "lng": clng, "zoom": mz, "crop_width": W, "crop_height": H}
+    async with AI_SEMAPHORE:
+        res = await ai.segmenta_bin(jpeg, meta, "image/jpeg")
+    if res.status_code == 503:
+        raise RuntimeError("Motore AI in avvio, riprovare tra poco")
+    res.raise_for_status()
+    body = res.json()
+    _versione_risposta(body.get("model_version"))
+    if "errore" in body:
+        raise RuntimeError(f"Motore AI: {body['errore']}")
+    stalli = [Polygon(p["points"]) for p in body.get("poligoni", [])
+              if p.get("label") == "Stalli AT" and len(p.get("points", [])) >= 3]
+    stalli = [p if p.is_valid else p.buffer(0) for p in stalli]  # contorni auto-intersecanti
+    stalli = [p for p in stalli if not p.is_empty and p.area > 0]
+
+    px, py = latlng_to_crop_px(lat, lng, clat, clng, mz, W, H)
+    results = {}
+    for c, cx, cy in zip(gruppo, px, py):
+        punto = Point(float(cx), float(cy))
+        # Lo Stalli AT che contiene la cabina, altrimenti il più vicino entro la mezza crop
+        distanze = [p.distance(punto) for p in stalli]
+        idx = [i for i, d in enumerate(distanze) if d <= margin]
+        out = {"new_lat": c["lat"], "new_lng": c["lng"], "iterations": 1, "final_distance_px": None, "ai_calls": 0}
+        if not idx:
+            results[c["chk"]] = dict(out, status="not_found", message="Nessuno 'Stalli AT' vicino nel mosaico")
+            continue
+        poligono = stalli[min(idx, key=lambda i: (distanze[i], -stalli[i].area))]
+        bx0, by0, bx1, by1 = poligono.bounds
+        if min(bx0, by0, W - 1 - bx1, H - 1 - by1) < AREA_EDGE_PX:
+            results[c["chk"]] = dict(out, status="edge", message="'Stalli AT' tagliato dal bordo del mosaico")
+            continue
+        centro = punto_centrale(poligono)
+        new_lat, new_lng = (float(v) for v in crop_px_to_latlng(centro.x, centro.y, clat, clng, mz, W, H))
+        results[c["chk"]] = dict(
+            out, status="done", new_lat=new_lat, new_lng=new_lng,
+            final_distance_px=round(centro.distance(punto) / f, 2),  # spostamento in pixel mappa allo zoom
+            message="Stalli AT assegnato dal mosaico dell'area",
+        )
+
+    # Coordinate nel buffer di scrittura, senza aspettare il commit (vedi centered_writer.py)
+    done = [(chk, r) for chk, r in results.items() if r["status"] == "done"]
+    for chk, r in done:
+        await salva_geom_centered(chk, r["new_lat"], r["new_lng"], wait=False)
+    seconds = time.perf_counter() - t0
+    print(f"[AREA] mosaico {W}x{H} (zoom {mz:.2f}) per {len(gruppo)} cabine: {len(stalli)} Stalli AT, "
+          f"{len(done)} assegnate in {seconds:.1f} s")
+    return results
@@ -0,0 +1,88 @@
+# backend/armonizzazione_batch/bench_ordine.py
+#
+# Effetto dell'ordine di lavorazione (jobs.ordina_cabine) sulla cache LRU delle tile:
+# ripete per ogni cabina alcune crop leggermente spostate attraverso build_crop e la
+# _TileCache vera di tile_source, con tile finte (niente rete né database), e confronta
+# hit rate e tile mancate tra l'ordine per id e la curva di Hilbert.
+#
+# Le cabine sono grappoli sparsi sull'Italia centro-meridionale, con id in ordine
+# casuale rispetto alla posizione (come per cabine importate da fonti diverse).
+# --sigma-m è la dispersione di ogni grappolo: ~110 m per grappoli fitti, ~550 m sparsi.
+#
+# Uso (dalla cartella backend):
+#   python -m armonizzazione_batch.bench_ordine --sigma-m 110
+#   python -m armonizzazione_batch.bench_ordine --sigma-m 550
+
+import argparse
+import asyncio
+import numpy as np
+from armonizzazione_single_cabin import tile_source
+from .jobs import ordina_cabine
+
+TILE = np.full((256, 256, 3), 100, np.uint8)
+
+
+class TileFinte:
+    """Provider con la cache LRU di tile_source: ogni miss sarebbe un download."""
+
+    max_zoom = 19
+
+    def __init__(self, cache_tiles: int):
+        self._cache = tile_source._TileCache(cache_tiles)
+
+    async def get_tile(self, z, x, y):
+        tile = self._cache.get((z, x, y))
+        if tile is None:
+            tile = TILE
+            self._cache.put((z, x, y), tile)
+        return tile
+
+
+def genera_cabine(grappoli: int, per_grappolo: int, sigma_m: float, seed: int) -> list:
+    rng = np.random.default_rng(seed)
+    centri = np.c_[rng.uniform(40.5, 43.5, grappoli), rng.uniform(11.0, 15.0, grappoli)]
+    sigma_lat = sigma_m / 111_320
+    cabine = []
+    for i, (lat, lng) in enumerate(centri):
+        sigma_lng = sigma_lat / np.cos(np.radians(lat))
+        for j in range(per_grappolo):
+            cabine.append({"chk": f"{i}-{j}", "lat": lat + rng.normal(0, sigma_lat),
+                           "lng": lng + rng.normal(0, sigma_lng), "centered": bool(rng.random() < 0.3)})
+    return [cabine[k] for k in rng.permutation(len(cabine))]
+
+
+async def misura(cabine: list, args) -> dict:
+    provider = TileFinte(args.cache_tiles)
+    for c in cabine:
+        for it in range(args.iterazioni):  # iterazioni con piccoli spostamenti, come l'ottimizzatore
+            await tile_source.build_crop(provider, c["lat"] + it * 2e-5, c["lng"], args.zoom, args.crop_size)
+    hits, misses = provider._cache.hits, provider._cache.misses
+    return {"hit_rate": hits / max(1, hits + misses), "misses": misses}
+
+
+async def main():
+    ap = argparse.ArgumentParser(description="Hit rate della cache delle tile per ordine di lavorazione")
+    ap.add_argument("--sigma-m", type=float, default=110, help="dispersione dei grappoli in metri")
+    ap.add_argument("--grappoli", type=int, default=150)
+    ap.add_argument("--per-grappolo", type=int, default=20)
+    ap.add_argument("--iterazioni", type=int, default=3)
+    ap.add_argument("--zoom", type=float, default=18.8)
+    ap.add_argument("--crop-size", type=int, default=500)
+    ap.add_argument("--cache-tiles", type=int, default=tile_source.TILE_CACHE_SIZE)
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    cabine = genera_cabine(args.grappoli, args.per_grappolo, args.sigma_m, args.seed)
+    print(f"{len(cabine)} cabine, grappoli di {args.sigma_m:.0f} m, {args.iterazioni} crop per cabina, "
+          f"cache di {args.cache_tiles} tile")
+    base = None
+    for label, ordine in (("id", cabine), ("hilbert", ordina_cabine(cabine, "hilbert")),
+                          ("hilbert, centered=last", ordina_cabine(cabine, "hilbert", "last"))):
+        r = await misura(ordine, args)
+        base = base or r
+        print(f"{label:24s} hit rate {r['hit_rate']:.3f}  tile mancate {r['misses']:6d} "
+              f"({(r['misses'] / base['misses'] - 1) * 100:+.0f}%)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,349 @@
+#backend/armonizzazione_batch/jobs.py
+#
+# Job di armonizzazione massiva lato server: l'elenco di cabine (per chk o per filtri)
+# viene lavorato da un numero limitato di worker asincroni; ogni cabina ripete
+# ottimizza_coordinata (crop dalle tile, vedi tile_source.py) fino alla convergenza
+# e salva geom_centered. Stato e risultati restano in memoria e si seguono in polling
+# o con gli eventi SSE.
+
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import List, Optional
+from sqlalchemy import text
+from db import SessionLocal
+from mercator import hilbert_key
+from armonizzazione_single_cabin.coord_optimizer import CoordinateOptimizationRequest, ottimizza_coordinata
+from armonizzazione_single_cabin.router import convergente, salva_geom_centered
+from armonizzazione_single_cabin.tile_source import tile_cache_stats
+from .area import armonizza_area, raggruppa_cabine
+
+# Worker concorrenti per job (default e massimo richiedibile)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "16"))
+# Job conclusi tenuti in memoria per la consultazione
+BATCH_MAX_JOBS = int(os.getenv("BATCH_MAX_JOBS", "20"))
+# Modalità area: le cabine senza Stalli AT assegnato dal mosaico ripassano dal percorso per cabina
+AREA_FALLBACK = os.getenv("AREA_FALLBACK", "1") == "1"
+
+MODES = ("cabina", "area")
+# Ordine di lavorazione: hilbert (zone contigue: tile, cache e pagine DB ancora calde) | id
+ORDERS = ("hilbert", "id")
+# Cabine con geom_centered già salvato: include | last (in fondo) | skip
+CENTERED = ("include", "last", "skip")
+
+FINAL_STATES = ("done", "failed", "cancelled")
+
+
+def filtro_cabine_sql(chk: Optional[List[str]] = None, tipo: Optional[List[str]] = None,
+                      area_regionale: Optional[str] = None, regione: Optional[str] = None,
+                      provincia: Optional[str] = None, skip_centered: bool = False):
+    """WHERE su public.cabine con gli stessi filtri di /cabine (o elenco di chk) e i suoi parametri."""
+    where = "WHERE chk IS NOT NULL"
+    params = {}
+    if skip_centered:
+        where += " AND geom_centered IS NULL"
+    if chk:
+        where += " AND chk = ANY(:chk)"
+        params["chk"] = list(chk)
+    if tipo:
+        where += " AND COALESCE(NULLIF(tipo_cabina,''), 'e-distribuzione') = ANY(:tipo)"
+        params["tipo"] = list(tipo)
+    if area_regionale:
+        where += " AND area_regionale = :area_regionale"
+        params["area_regionale"] = area_regionale
+    if regione:
+        where += " AND regione = :regione"
+        params["regione"] = regione
+    if provincia:
+        where += " AND UPPER(provincia) LIKE UPPER(:provincia || '%')"
+        params["provincia"] = provincia
+    return where, params
+
+
+def ordina_cabine(cabine: list, order: str = "hilbert", centered: str = "include") -> list:
+    """
+    Cabine nell'ordine di lavorazione: lungo la curva di Hilbert le cabine consecutive sono
+    vicine, quindi crop e mosaici riusano le tile appena scaricate; con centered=last quelle
+    già armonizzate (campo `centered`) passano in fondo, nello stesso ordine.
+    """
+    if order == "hilbert" and cabine:
+        keys = hilbert_key([c["lat"] for c in cabine], [c["lng"] for c in cabine])
+        cabine = [c for _, c in sorted(zip(keys.tolist(), cabine), key=lambda kc: kc[0])]
+    if centered == "last":
+        cabine = sorted(cabine, key=lambda c: bool(c.get("centered")))  # sort stabile
+    return cabine
+
+
+async def seleziona_cabine(chk: Optional[List[str]] = None, tipo: Optional[List[str]] = None,
+                           area_regionale: Optional[str] = None, regione: Optional[str] = None,
+                           provincia: Optional[str] = None, limit: Optional[int] = None,
+                           order: str = "hilbert", centered: str = "include") -> list:
+    """Cabine da armonizzare (chk, lat, lng, centered): stessi filtri di /cabine oppure elenco di chk."""
+    where, params = filtro_cabine_sql(chk, tipo, area_regionale, regione, provincia, skip_centered=centered == "skip")
+    sql = f"""
+        SELECT chk, ST_Y(geom::geometry) AS lat, ST_X(geom::geometry) AS lng,
+               geom_centered IS NOT NULL AS centered
+        FROM public.cabine
+        {where}
+        ORDER BY id
+    """
+    if limit:
+        sql += " LIMIT :limit"
+        params["limit"] = int(limit)
+    async with SessionLocal() as session:
+        res = await session.execute(text(sql), params)
+        return ordina_cabine([dict(r._mapping) for r in res.fetchall()], order, centered)
+
+
+async def armonizza_cabina(chk: str, lat: float, lng: float, zoom: float, crop_size: int, max_iter: int,
+                           wait_commit: bool = False) -> dict:
+    """
+    Stessa iterazione di armonizzaSingola del frontend, senza browser. In single-shot
+    (COORD_SINGLE_SHOT) di solito basta un passo: i successivi servono solo se la stima
+    resta non convergente anche dopo la verifica. La coordinata va nel buffer di
+    centered_writer; con wait_commit=True si ritorna dopo il suo commit.
+    """
+    t0 = time.perf_counter()
+    cur_lat, cur_lng = lat, lng
+    result = None
+    step = 0
+    ai_calls = 0
+    for step in range(1, max_iter + 1):
+        result = await ottimizza_coordinata(
+            CoordinateOptimizationRequest(chk=chk, zoom=zoom, crop_size=crop_size, lat=cur_lat, lng=cur_lng)
+        )
+        ai_calls += result.iterations
+        cur_lat, cur_lng = result.new_lat, result.new_lng
+        if convergente(result):
+            break
+    if result is not None and result.density_score == 0:
+        # Nessuno "Stalli AT" riconosciuto: le coordinate non sono state verificate, non si salvano
+        status = "not_found"
+    elif result is not None and convergente(result):
+        status = "done"
+        await salva_geom_centered(chk, cur_lat, cur_lng, wait=wait_commit)
+    else:
+        status = "not_converged"
+    return {
+        "status": status,
+        "new_lat": cur_lat,
+        "new_lng": cur_lng,
+        "iterations": step,
+        "ai_calls": ai_calls,
+        "final_distance_px": result.final_distance_px if result else None,
+        "message": result.message if result else None,
+        "seconds": round(time.perf_counter() - t0, 2),
+    }
+
+
+class BatchJob:
+    def __init__(self, cabine: list, zoom: float, crop_size: int, max_iter: int, concurrency: int, filters: dict,
+                 mode: str = "cabina"):
+        if mode not in MODES:
+            raise ValueError(f"Modalità non valida: {mode} ({' | '.join(MODES)})")
+        self.id = uuid.uuid4().hex[:12]
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.status = "queued"
+        self.error = None
+        self.zoom = zoom
+        self.crop_size = crop_size
+        self.max_iter = max_iter
+        self.concurrency = concurrency
+        self.filters = filters
+        self.mode = mode
+        self.mosaics = 0
+        self._tiles_at_start = None  # contatori della cache di tile all'avvio (condivisa tra job)
+        self.cabine = list({c["chk"]: c for c in cabine}.values())  # un solo passaggio per chk
+        self.results = OrderedDict((c["chk"], {"chk": c["chk"], "lat": c["lat"], "lng": c["lng"], "status": "pending"})
+                                   for c in self.cabine)
+        self.counts = {"pending": len(self.results), "running": 0, "done": 0, "not_converged": 0, "not_found": 0, "error": 0}
+        self.ai_calls = 0  # segmentazioni AI totali (tentativi TTA e verifiche compresi)
+        self.events = []  # uno per cabina conclusa + cambi di stato del job (id evento = indice)
+        self._changed = asyncio.Condition()
+        self.task = None
+
+    async def _emit(self, event: dict):
+        async with self._changed:
+            self.events.append(event)
+            self._changed.notify_all()
+
+    def _set_item(self, chk, status, **fields):
+        item = self.results[chk]
+        self.counts[item["status"]] -= 1
+        self.counts[status] += 1
+        item.update(fields, status=status)
+        return item
+
+    async def run(self):
+        self.status = "running"
+        self.started_at = time.time()
+        self._tiles_at_start = tile_cache_stats() or {"hits": 0, "misses": 0}
+        await self._emit({"type": "job", "status": self.status})
+        queue = asyncio.Queue()
+        # Unità di lavoro: la singola cabina oppure il gruppo di cabine di un mosaico
+        units = raggruppa_cabine(self.cabine, self.zoom, self.crop_size) if self.mode == "area" else self.cabine
+        for u in units:
+            queue.put_nowait(u)
+        lavora = self._area if self.mode == "area" else self._cabina
+
+        async def worker():
+            while True:
+                try:
+                    u = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await lavora(u)
+
+        try:
+            await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+            self.status = "done"
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+        except Exception as e:
+            self.status = "failed"
+            self.error = str(e)
+        finally:
+            self.finished_at = time.time()
+            await self._emit({"type": "job", "status": self.status, "progress": self.progress()})
+            print(f"[BATCH {self.id}] {self.status}: {self.counts}")
+
+    async def _cabina(self, c):
+        chk = c["chk"]
+        self._set_item(chk, "running")
+        try:
+            out = await armonizza_cabina(chk, c["lat"], c["lng"], self.zoom, self.crop_size, self.max_iter)
+            self.ai_calls += out["ai_calls"]
+            item = self._set_item(chk, out.pop("status"), **out)
+        except asyncio.CancelledError:
+            self._set_item(chk, "pending")
+            raise
+        except Exception as e:
+            detail = getattr(e, "detail", None) or str(e)
+            print(f"[BATCH {self.id}] errore su {chk}: {detail}")
+            item = self._set_item(chk, "error", error=detail)
+        await self._emit({"type": "cabina", **item, "progress": self.progress()})
+
+    async def _area(self, gruppo):
+        for c in gruppo:
+            self._set_item(c["chk"], "running")
+        try:
+            results = await armonizza_area(gruppo, self.zoom, self.crop_size)
+            self.mosaics += 1
+            self.ai_calls += 1
+        except asyncio.CancelledError:
+            for c in gruppo:
+                self._set_item(c["chk"], "pending")
+            raise
+        except Exception as e:
+            detail = getattr(e, "detail", None) or str(e)
+            print(f"[BATCH {self.id}] errore sul mosaico di {len(gruppo)} cabine: {detail}")
+            results = {c["chk"]: {"status": "error", "error": detail} for c in gruppo}
+        for c in gruppo:
+            out = dict(results[c["chk"]])
+            status = out.pop("status")
+            if status != "done" and AREA_FALLBACK:
+                # Stalli AT non trovato o tagliato nel mosaico: iterazione classica sulla cabina
+                await self._cabina(c)
+                continue
+            item = self._set_item(c["chk"], status if status in self.counts else "not_converged", **out)
+            await self._emit({"type": "cabina", **item, "progress": self.progress()})
+
+    def tile_cache(self) -> Optional[dict]:
+        """Hit rate della cache di tile durante il job (con job paralleli include anche i loro accessi)."""
+        now = tile_cache_stats()
+        if now is None or self._tiles_at_start is None:
+            return None
+        hits = now["hits"] - self._tiles_at_start["hits"]
+        misses = now["misses"] - self._tiles_at_start["misses"]
+        return {"hits": hits, "misses": misses, "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None}
+
+    def progress(self) -> dict:
+        total = len(self.results)
+        finished = len(self.results) - self.counts["pending"] - self.counts["running"]
+        elapsed = (self.finished_at or time.time()) - (self.started_at or time.time())
+        return {
+            "total": total,
+            "finished": finished,
+            "fraction": round(finished / total, 4) if total else 1.0,
+            "per_min": round(finished / elapsed * 60, 2) if elapsed > 0 else 0.0,
+            "ai_calls_per_cabina": round(self.ai_calls / finished, 2) if finished else 0.0,
+            "mosaics": self.mosaics,
+            "tile_cache": self.tile_cache(),
+            **self.counts,
+        }
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "params": {"zoom": self.zoom, "crop_size": self.crop_size, "max_iter": self.max_iter,
+                       "concurrency": self.concurrency, "mode": self.mode, **self.filters},
+            "progress": self.progress(),
+        }
+
+    def page(self, offset: int = 0, limit: int = 100, status: Optional[str] = None) -> list:
+        items = (r for r in self.results.values() if status is None or r["status"] == status)
+        return [r for i, r in enumerate(items) if offset <= i < offset + limit]
+
+    async def stream(self, last_id: int = -1):
+        """Eventi a partire da last_id + 1, in attesa dei nuovi fino alla fine del job."""
+        idx = last_id + 1
+        while True:
+            async with self._changed:
+                while idx >= len(self.events) and self.status not in FINAL_STATES:
+                    await self._changed.wait()
+                pending = self.events[idx:]
+            for ev in pending:
+                yield idx, ev
+                idx += 1
+            if self.status in FINAL_STATES and idx >= len(self.events):
+                return
+
+
+class JobManager:
+    def __init__(self, max_jobs: int = BATCH_MAX_JOBS):
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+
+    def start(self, job: BatchJob) -> BatchJob:
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(job.run())
+        self._prune()
+        return job
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        return self.jobs.get(job_id)
+
+    async def cancel(self, job: BatchJob) -> bool:
+        if job.task is None or job.task.done():
+            return False
+        job.task.cancel()
+        if job.status == "queued":
+            # Il task non è ancora partito: run() non verrà mai eseguito
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            await job._emit({"type": "job", "status": job.status, "progress": job.progress()})
+        return True
+
+    def _prune(self):
+        finished = [j for j in self.jobs.values() if j.status in FINAL_STATES]
+        for j in finished[: max(0, len(self.jobs) - self.max_jobs)]:
+            del self.jobs[j.id]
+
+    async def shutdown(self):
+        tasks = [j.task for j in self.jobs.values() if j.task and not j.task.done()]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+manager = JobManager()
@@ -0,0 +1,472 @@
+#backend/armonizzazione_batch/queue.py
+#
+# Coda persistente di armonizzazione su Postgres, accanto a public.cabine.
+# - un job (armonizzazione_job) raccoglie parametri e stato: running | paused | cancelled
+# - ogni cabina è una riga di armonizzazione_queue con stato, tentativi e tempi
+# - i worker (anche di più processi backend) prendono le righe con
+#   SELECT ... FOR UPDATE SKIP LOCKED, quindi non si pestano i piedi
+# - una riga presa resta "running" con un lease rinnovato dal worker; se il processo
+#   muore, scaduto il lease la riga torna "pending" (o "error" finiti i tentativi)
+# Fermare un job = pausa; riprendere = resume; scalare = avviare altri backend.
+
+import asyncio
+import json
+import os
+import socket
+import time
+from typing import List, Optional
+from sqlalchemy import text
+from db import SessionLocal
+from .jobs import armonizza_cabina, filtro_cabine_sql, ordina_cabine
+
+# Worker per processo backend (0 = questo processo non lavora la coda, la alimenta soltanto)
+QUEUE_WORKERS = int(os.getenv("QUEUE_WORKERS", "2"))
+# Durata del lease di una riga presa in carico (s): rinnovato a ogni terzo di durata
+QUEUE_LEASE_S = int(os.getenv("QUEUE_LEASE_S", "300"))
+# Attesa quando la coda è vuota: cresce fino al massimo per non interrogare il DB a vuoto
+QUEUE_POLL_S = float(os.getenv("QUEUE_POLL_S", "1"))
+QUEUE_POLL_MAX_S = float(os.getenv("QUEUE_POLL_MAX_S", "15"))
+
+ITEM_STATES = ("pending", "running", "done", "not_converged", "not_found", "error", "cancelled")
+
+SCHEMA_SQL = [
+    """
+    CREATE TABLE IF NOT EXISTS public.armonizzazione_job (
+        id           BIGSERIAL PRIMARY KEY,
+        status       TEXT NOT NULL DEFAULT 'running',
+        zoom         DOUBLE PRECISION NOT NULL,
+        crop_size    INTEGER NOT NULL,
+        max_iter     INTEGER NOT NULL,
+        max_attempts INTEGER NOT NULL,
+        filters      JSONB,
+        created_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+        updated_at   TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS public.armonizzazione_queue (
+        id                BIGSERIAL PRIMARY KEY,
+        job_id            BIGINT NOT NULL REFERENCES public.armonizzazione_job(id) ON DELETE CASCADE,
+        chk               TEXT NOT NULL,
+        state             TEXT NOT NULL DEFAULT 'pending',
+        attempts          INTEGER NOT NULL DEFAULT 0,
+        lat               DOUBLE PRECISION,
+        lng               DOUBLE PRECISION,
+        new_lat           DOUBLE PRECISION,
+        new_lng           DOUBLE PRECISION,
+        iterations        INTEGER,
+        final_distance_px DOUBLE PRECISION,
+        message           TEXT,
+        error             TEXT,
+        locked_by         TEXT,
+        locked_at         TIMESTAMPTZ,
+        enqueued_at       TIMESTAMPTZ NOT NULL DEFAULT now(),
+        started_at        TIMESTAMPTZ,
+        finished_at       TIMESTAMPTZ,
+        duration_ms       INTEGER,
+        UNIQUE (job_id, chk)
+    )
+    """,
+    # Indici parziali: la presa in carico legge solo le pending, il recupero solo le running
+    """
+    CREATE INDEX IF NOT EXISTS armonizzazione_queue_pending_idx
+        ON public.armonizzazione_queue (id) WHERE state = 'pending'
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS armonizzazione_queue_running_idx
+        ON public.armonizzazione_queue (locked_at) WHERE state = 'running'
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS armonizzazione_queue_job_state_idx
+        ON public.armonizzazione_queue (job_id, state)
+    """,
+]
+
+CLAIM_SQL = """
+    UPDATE public.armonizzazione_queue q
+    SET state = 'running', attempts = q.attempts + 1, error = NULL,
+        locked_by = :worker, locked_at = now(), started_at = now()
+    FROM public.armonizzazione_job j
+    WHERE j.id = q.job_id
+      AND q.id = (
+          SELECT q2.id
+          FROM public.armonizzazione_queue q2
+          JOIN public.armonizzazione_job j2 ON j2.id = q2.job_id
+          WHERE q2.state = 'pending' AND j2.status = 'running'
+          ORDER BY q2.id
+          LIMIT 1
+          FOR UPDATE OF q2 SKIP LOCKED
+      )
+    RETURNING q.id, q.job_id, q.chk, q.lat, q.lng, q.attempts,
+              j.zoom, j.crop_size, j.max_iter, j.max_attempts
+"""
+
+HEARTBEAT_SQL = """
+    UPDATE public.armonizzazione_queue SET locked_at = now()
+    WHERE id = :id AND locked_by = :worker AND state = 'running'
+"""
+
+COMPLETE_SQL = """
+    UPDATE public.armonizzazione_queue
+    SET state = :state, new_lat = :new_lat, new_lng = :new_lng, iterations = :iterations,
+        final_distance_px = :final_distance_px, message = :message, error = :error,
+        finished_at = now(), duration_ms = :duration_ms, locked_by = NULL, locked_at = NULL
+    WHERE id = :id AND locked_by = :worker
+"""
+
+# Spegnimento: la riga torna in coda e restituisce il tentativo preso con la presa in
+# carico, così riavvii e deploy non consumano i tentativi
+RELEASE_SQL = """
+    UPDATE public.armonizzazione_queue
+    SET state = 'pending', attempts = GREATEST(attempts - 1, 0), error = 'interrotto',
+        locked_by = NULL, locked_at = NULL
+    WHERE id = :id AND locked_by = :worker AND state = 'running'
+"""
+
+REQUEUE_STALE_SQL = """
+    UPDATE public.armonizzazione_queue q
+    SET state = CASE WHEN q.attempts >= j.max_attempts THEN 'error' ELSE 'pending' END,
+        error = 'lease scaduto (' || COALESCE(q.locked_by, '?') || ')',
+        locked_by = NULL, locked_at = NULL
+    FROM public.armonizzazione_job j
+    WHERE j.id = q.job_id
+      AND q.state = 'running'
+      AND q.locked_at < now() - CAST(:lease_s AS INTEGER) * INTERVAL '1 second'
+"""
+
+
+async def ensure_schema():
+    async with SessionLocal() as session:
+        # Processi che partono insieme: un CREATE ... IF NOT EXISTS alla volta (vedi cabine_clusters.py)
+        await session.execute(text("SELECT pg_advisory_xact_lock(hashtext('public.armonizzazione_queue'))"))
+        for stmt in SCHEMA_SQL:
+            await session.execute(text(stmt))
+        await session.commit()
+
+
+async def enqueue_job(chk: Optional[List[str]], filters: dict, zoom: float, crop_size: int,
+                      max_iter: int, max_attempts: int, order: str = "hilbert",
+                      centered: str = "include") -> Optional[dict]:
+    """
+    Crea il job e accoda le cabine selezionate nell'ordine di lavorazione (vedi
+    jobs.ordina_cabine): gli id crescono lungo la curva, quindi la presa in carico per id
+    lavora una zona alla volta. None, senza creare il job, se la selezione è vuota.
+    """
+    where, params = filtro_cabine_sql(chk, *(filters.get(k) for k in ("tipo", "area_regionale", "regione", "provincia")),
+                                      skip_centered=centered == "skip")
+    limit = ""
+    if filters.get("limit"):
+        limit = "LIMIT :limit"
+        params["limit"] = int(filters["limit"])
+    async with SessionLocal() as session:
+        if order == "hilbert":
+            # Solo id e posizione passano in Python per la chiave di Hilbert; chk e
+            # coordinate delle righe si copiano da public.cabine dentro l'INSERT
+            res = await session.execute(
+                text(f"""
+                    SELECT id, ST_Y(geom::geometry) AS lat, ST_X(geom::geometry) AS lng,
+                           geom_centered IS NOT NULL AS centered
+                    FROM public.cabine
+                    {where}
+                    ORDER BY id
+                    {limit}
+                """),
+                params,
+            )
+            ids = [c["id"] for c in ordina_cabine([dict(r._mapping) for r in res.fetchall()], order, centered)]
+            if not ids:
+                return None
+            select = """
+                SELECT :job_id, c.chk, ST_Y(c.geom::geometry), ST_X(c.geom::geometry)
+                FROM unnest(CAST(:ids AS BIGINT[])) WITH ORDINALITY AS u(id, ord)
+                JOIN public.cabine c ON c.id = u.id
+                ORDER BY u.ord
+            """
+            select_params = {"ids": ids}
+        else:
+            # Ordine per id (con centered=last le già armonizzate in fondo): tutto in SQL
+            select = f"""
+                SELECT :job_id, s.chk, s.lat, s.lng
+                FROM (
+                    SELECT id, chk, ST_Y(geom::geometry) AS lat, ST_X(geom::geometry) AS lng,
+                           geom_centered IS NOT NULL AS centered
+                    FROM public.cabine
+                    {where}
+                    ORDER BY id
+                    {limit}
+                ) s
+                ORDER BY {"s.centered, " if centered == "last" else ""}s.id
+            """
+            select_params = params
+        res = await session.execute(
+            text("""
+                INSERT INTO public.armonizzazione_job (zoom, crop_size, max_iter, max_attempts, filters)
+                VALUES (:zoom, :crop_size, :max_iter, :max_attempts, CAST(:filters AS JSONB))
+                RETURNING id
+            """),
+            {"zoom": zoom, "crop_size": crop_size, "max_iter": max_iter, "max_attempts": max_attempts,
+             "filters": json.dumps(dict(filters, chk=chk, order=order, centered=centered) if chk
+                                   else dict(filters, order=order, centered=centered))},
+        )
+        job_id = res.scalar_one()
+        res = await session.execute(
+            # ORDER BY al livello dell'INSERT ... SELECT: gli id BIGSERIAL seguono l'ordine
+            text(f"""
+                INSERT INTO public.armonizzazione_queue (job_id, chk, lat, lng)
+                {select}
+                ON CONFLICT (job_id, chk) DO NOTHING
+            """),
+            dict(select_params, job_id=job_id),
+        )
+        if res.rowcount == 0:
+            await session.rollback()
+            return None
+        await session.commit()
+    return {"id": job_id, "enqueued": res.rowcount}
+
+
+async def set_job_status(job_id: int, status: str) -> bool:
+    """running | paused | cancelled; annullando, le righe ancora pending diventano cancelled."""
+    async with SessionLocal() as session:
+        res = await session.execute(
+            text("""
+                UPDATE public.armonizzazione_job SET status = :status, updated_at = now()
+                WHERE id = :id AND status <> 'cancelled'
+            """),
+            {"id": job_id, "status": status},
+        )
+        if status == "cancelled":
+            await session.execute(
+                text("UPDATE public.armonizzazione_queue SET state = 'cancelled' WHERE job_id = :id AND state = 'pending'"),
+                {"id": job_id},
+            )
+        await session.commit()
+        return res.rowcount > 0
+
+
+async def retry_job(job_id: int, states=("error", "not_converged")) -> Optional[dict]:
+    """
+    Rimette in coda le righe concluse male, con i tentativi azzerati; None se il job non
+    esiste. Un job annullato non si riprova; uno in pausa resta in pausa e le righe
+    ripartono al resume.
+    """
+    async with SessionLocal() as session:
+        # Lock sul job: un annullamento concorrente aspetta la fine di questa transazione
+        res = await session.execute(
+            text("SELECT status FROM public.armonizzazione_job WHERE id = :id FOR UPDATE"),
+            {"id": job_id},
+        )
+        status = res.scalar_one_or_none()
+        if status is None:
+            return None
+        requeued = 0
+        if status != "cancelled":
+            res = await session.execute(
+                text("""
+                    UPDATE public.armonizzazione_queue
+                    SET state = 'pending', attempts = 0, error = NULL
+                    WHERE job_id = :id AND state = ANY(:states)
+                """),
+                {"id": job_id, "states": list(states)},
+            )
+            requeued = res.rowcount
+            await session.execute(
+                text("UPDATE public.armonizzazione_job SET updated_at = now() WHERE id = :id"),
+                {"id": job_id},
+            )
+        await session.commit()
+        return {"status": status, "requeued": requeued}
+
+
+async def job_summary(job_id: Optional[int] = None) -> list:
+    """Job con conteggi per stato e tempi medi (tutti i job se job_id è None)."""
+    where = "WHERE j.id = :id" if job_id is not None else ""
+    async with SessionLocal() as session:
+        res = await session.execute(
+            text(f"""
+                SELECT j.id, j.status, j.zoom, j.crop_size, j.max_iter, j.max_attempts, j.filters,
+                       j.created_at, j.updated_at,
+                       COUNT(q.id) AS total,
+                       {", ".join(f"COUNT(*) FILTER (WHERE q.state = '{s}') AS {s}" for s in ITEM_STATES)},
+                       AVG(q.duration_ms) FILTER (WHERE q.finished_at IS NOT NULL) AS avg_ms,
+                       AVG(q.iterations) FILTER (WHERE q.finished_at IS NOT NULL) AS avg_iterations,
+                       SUM(q.attempts) AS attempts,
+                       MIN(q.started_at) AS first_started_at,
+                       MAX(q.finished_at) AS last_finished_at
+                FROM public.armonizzazione_job j
+                LEFT JOIN public.armonizzazione_queue q ON q.job_id = j.id
+                {where}
+                GROUP BY j.id
+                ORDER BY j.id DESC
+            """),
+            {"id": job_id} if job_id is not None else {},
+        )
+        out = []
+        for r in res.fetchall():
+            row = dict(r._mapping)
+            out.append({
+                "id": row["id"],
+                "status": row["status"],
+                "params": {k: row[k] for k in ("zoom", "crop_size", "max_iter", "max_attempts")},
+                "filters": row["filters"],
+                "created_at": row["created_at"],
+                "updated_at": row["updated_at"],
+                "progress": {"total": row["total"], **{s: row[s] for s in ITEM_STATES}},
+                "timing": {
+                    "avg_ms": round(float(row["avg_ms"])) if row["avg_ms"] is not None else None,
+                    "avg_iterations": round(float(row["avg_iterations"]), 2) if row["avg_iterations"] is not None else None,
+                    "attempts": row["attempts"],
+                    "first_started_at": row["first_started_at"],
+                    "last_finished_at": row["last_finished_at"],
+                },
+            })
+        return out
+
+
+async def job_items(job_id: int, state: Optional[str] = None, offset: int = 0, limit: int = 100) -> list:
+    sql = """
+        SELECT chk, state, attempts, lat, lng, new_lat, new_lng, iterations, final_distance_px,
+               message, error, locked_by, started_at, finished_at, duration_ms
+        FROM public.armonizzazione_queue
+        WHERE job_id = :id
+    """
+    params = {"id": job_id, "offset": offset, "limit": limit}
+    if state:
+        sql += " AND state = :state"
+        params["state"] = state
+    sql += " ORDER BY id OFFSET :offset LIMIT :limit"
+    async with SessionLocal() as session:
+        res = await session.execute(text(sql), params)
+        return [dict(r._mapping) for r in res.fetchall()]
+
+
+class QueueWorkerPool:
+    """N worker asincroni che svuotano la coda; più processi possono girare insieme."""
+
+    def __init__(self, workers: int = QUEUE_WORKERS, lease_s: int = QUEUE_LEASE_S):
+        self.workers = max(0, workers)
+        self.lease_s = max(30, lease_s)
+        self.prefix = f"{socket.gethostname()}:{os.getpid()}"
+        self._tasks = []
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self.processed = 0
+
+    def start(self):
+        if self.workers == 0 or self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._run(f"{self.prefix}:{i}")) for i in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._reaper()))
+        print(f"[CODA] {self.workers} worker avviati ({self.prefix})")
+
+    def wake(self):
+        # Nuovo lavoro accodato da questo processo: niente attesa del prossimo polling
+        self._wake.set()
+
+    async def stop(self):
+        self._stopping = True
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _claim(self, worker):
+        async with SessionLocal() as session:
+            res = await session.execute(text(CLAIM_SQL), {"worker": worker})
+            row = res.fetchone()
+            await session.commit()
+            return dict(row._mapping) if row else None
+
+    async def _heartbeat(self, row_id, worker):
+        while True:
+            await asyncio.sleep(self.lease_s / 3)
+            try:
+                async with SessionLocal() as session:
+                    await session.execute(text(HEARTBEAT_SQL), {"id": row_id, "worker": worker})
+                    await session.commit()
+            except Exception as e:
+                print(f"[CODA] heartbeat fallito per la riga {row_id}: {e}")
+
+    async def _complete(self, row_id, worker, state, duration_ms, out=None, error=None):
+        out = out or {}
+        async with SessionLocal() as session:
+            await session.execute(text(COMPLETE_SQL), {
+                "id": row_id, "worker": worker, "state": state, "duration_ms": duration_ms,
+                "new_lat": out.get("new_lat"), "new_lng": out.get("new_lng"),
+                "iterations": out.get("iterations"), "final_distance_px": out.get("final_distance_px"),
+                "message": out.get("message"), "error": error,
+            })
+            await session.commit()
+
+    async def _release(self, row_id, worker):
+        async with SessionLocal() as session:
+            await session.execute(text(RELEASE_SQL), {"id": row_id, "worker": worker})
+            await session.commit()
+
+    async def _process(self, row, worker):
+        t0 = time.perf_counter()
+        hb = asyncio.create_task(self._heartbeat(row["id"], worker))
+        try:
+            # wait_commit: la riga diventa "done" solo con geom_centered già scritta
+            out = await armonizza_cabina(row["chk"], row["lat"], row["lng"], row["zoom"], row["crop_size"], row["max_iter"],
+                                         wait_commit=True)
+            state, error = out.pop("status"), None
+        except asyncio.CancelledError:
+            # Spegnimento: la riga torna subito in coda invece di aspettare il lease
+            hb.cancel()
+            await asyncio.shield(self._release(row["id"], worker))
+            raise
+        except Exception as e:
+            out = None
+            error = getattr(e, "detail", None) or str(e)
+            # Errori transitori (AI in avvio, timeout): si riprova finché ci sono tentativi
+            state = "pending" if row["attempts"] < row["max_attempts"] else "error"
+            print(f"[CODA] {row['chk']} tentativo {row['attempts']}/{row['max_attempts']}: {error}")
+        finally:
+            hb.cancel()
+        await self._complete(row["id"], worker, state, round((time.perf_counter() - t0) * 1000), out, error)
+        self.processed += 1
+
+    async def _run(self, worker):
+        idle = QUEUE_POLL_S
+        while not self._stopping:
+            try:
+                row = await self._claim(worker)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[CODA] presa in carico fallita ({worker}): {e}")
+                row = None
+            if row is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=idle)
+                    idle = QUEUE_POLL_S
+                except asyncio.TimeoutError:
+                    idle = min(idle * 2, QUEUE_POLL_MAX_S)
+                continue
+            idle = QUEUE_POLL_S
+            await self._process(row, worker)
+
+    async def _reaper(self):
+        # Recupera le righe rimaste "running" con il lease scaduto (processo morto)
+        while not self._stopping:
+            try:
+                async with SessionLocal() as session:
+                    res = await session.execute(text(REQUEUE_STALE_SQL), {"lease_s": self.lease_s})
+                    await session.commit()
+                    if res.rowcount:
+                        print(f"[CODA] {res.rowcount} righe con lease scaduto rimesse in coda")
+                        self.wake()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[CODA] recupero lease fallito: {e}")
+            await asyncio.sleep(self.lease_s / 2)
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "worker_prefix": self.prefix, "lease_s": self.lease_s,
+                "processed": self.processed}
+
+
+pool = QueueWorkerPool()
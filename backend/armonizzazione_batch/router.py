@@ -0,0 +1,184 @@
+#backend/armonizzazione_batch/router.py
+import json
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from sqlalchemy.exc import SQLAlchemyError
+from typing import List, Optional
+from .jobs import (BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY, CENTERED, MODES, ORDERS, BatchJob, manager,
+                   seleziona_cabine)
+from . import queue as durable
+
+router = APIRouter(prefix="/batch")
+
+class BatchJobRequest(BaseModel):
+    # Cabine da lavorare: elenco di chk oppure filtri come /cabine (almeno uno dei due)
+    chk: Optional[List[str]] = None
+    tipo: Optional[List[str]] = None
+    area_regionale: Optional[str] = None
+    regione: Optional[str] = None
+    provincia: Optional[str] = None
+    limit: Optional[int] = None
+    # Parametri di armonizzazione (come BATCH_SETTINGS del frontend)
+    zoom: float = 18.8
+    crop_size: int = 500
+    max_iter: int = 5
+    concurrency: Optional[int] = None
+    # cabina: una crop per cabina e iterazione | area: un mosaico per gruppo di cabine vicine (vedi area.py)
+    mode: str = "cabina"
+    # Ordine di lavorazione (hilbert | id) e cabine già armonizzate (include | last | skip)
+    order: str = "hilbert"
+    centered: str = "include"
+
+def _valida_ordine(req: BatchJobRequest):
+    if req.order not in ORDERS:
+        raise HTTPException(status_code=400, detail=f"Ordine non valido: {req.order} ({' | '.join(ORDERS)})")
+    if req.centered not in CENTERED:
+        raise HTTPException(status_code=400, detail=f"centered non valido: {req.centered} ({' | '.join(CENTERED)})")
+
+@router.post("/jobs", status_code=202)
+async def crea_job(req: BatchJobRequest):
+    filters = {k: v for k, v in req.model_dump(include={"tipo", "area_regionale", "regione", "provincia", "limit"}).items() if v}
+    if not req.chk and not filters.keys() - {"limit"}:
+        raise HTTPException(status_code=400, detail="Indicare un elenco di chk o almeno un filtro")
+    if req.mode not in MODES:
+        raise HTTPException(status_code=400, detail=f"Modalità non valida: {req.mode} ({' | '.join(MODES)})")
+    _valida_ordine(req)
+    try:
+        cabine = await seleziona_cabine(req.chk, req.tipo, req.area_regionale, req.regione, req.provincia, req.limit,
+                                        req.order, req.centered)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail=f"Errore SQL: {str(e)}")
+    if not cabine:
+        raise HTTPException(status_code=404, detail="Nessuna cabina corrisponde alla selezione")
+    concurrency = max(1, min(req.concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY))
+    if req.chk:
+        filters["chk"] = len(req.chk)
+    filters.update(order=req.order, centered=req.centered)
+    job = manager.start(BatchJob(cabine, req.zoom, req.crop_size, max(1, req.max_iter), concurrency, filters, req.mode))
+    print(f"[BATCH {job.id}] avviato su {len(job.results)} cabine, concorrenza {concurrency}, modalità {req.mode}")
+    return job.summary()
+
+@router.get("/jobs")
+async def lista_job():
+    return {"jobs": [j.summary() for j in reversed(manager.jobs.values())]}
+
+def _job_or_404(job_id: str) -> BatchJob:
+    job = manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job non trovato")
+    return job
+
+@router.get("/jobs/{job_id}")
+async def stato_job(job_id: str, results: bool = False, offset: int = 0, limit: int = 100, status: Optional[str] = None):
+    # Polling: riepilogo e, a pagine, i risultati per cabina
+    job = _job_or_404(job_id)
+    out = job.summary()
+    if results:
+        out["results"] = job.page(offset, limit, status)
+    return out
+
+@router.get("/jobs/{job_id}/events")
+async def eventi_job(job_id: str, request: Request):
+    # Server-sent events: un evento per cabina conclusa e per ogni cambio di stato del job.
+    # Con Last-Event-ID (riconnessione automatica di EventSource) si riprende da dove si era rimasti.
+    job = _job_or_404(job_id)
+    try:
+        last_id = int(request.headers.get("last-event-id", "-1"))
+    except ValueError:
+        last_id = -1
+
+    async def stream():
+        yield f"event: summary\ndata: {json.dumps(job.summary())}\n\n"
+        async for idx, ev in job.stream(last_id):
+            if await request.is_disconnected():
+                return
+            yield f"id: {idx}\nevent: {ev['type']}\ndata: {json.dumps(ev)}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@router.post("/jobs/{job_id}/cancel")
+async def annulla_job(job_id: str):
+    job = _job_or_404(job_id)
+    if not await manager.cancel(job):
+        raise HTTPException(status_code=409, detail=f"Job già concluso ({job.status})")
+    return {"id": job.id, "status": "cancelling" if job.status == "running" else job.status}
+
+# ---------- Coda persistente (vedi queue.py) ----------
+
+class QueueJobRequest(BatchJobRequest):
+    # Tentativi per cabina prima di segnarla "error" (errori transitori, worker morti)
+    max_attempts: int = 3
+
+QUEUE_ACTIONS = {"pause": "paused", "resume": "running", "cancel": "cancelled"}
+
+@router.post("/queue/jobs", status_code=202)
+async def crea_job_coda(req: QueueJobRequest):
+    filters = {k: v for k, v in req.model_dump(include={"tipo", "area_regionale", "regione", "provincia", "limit"}).items() if v}
+    if not req.chk and not filters.keys() - {"limit"}:
+        raise HTTPException(status_code=400, detail="Indicare un elenco di chk o almeno un filtro")
+    if req.mode != "cabina":
+        # Le righe della coda sono per cabina (lease, tentativi): i mosaici solo in /batch/jobs
+        raise HTTPException(status_code=400, detail="La coda persistente supporta solo mode=cabina")
+    _valida_ordine(req)
+    try:
+        job = await durable.enqueue_job(req.chk, filters, req.zoom, req.crop_size,
+                                        max(1, req.max_iter), max(1, req.max_attempts), req.order, req.centered)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail=f"Errore SQL: {str(e)}")
+    if job is None:
+        raise HTTPException(status_code=404, detail="Nessuna cabina corrisponde alla selezione")
+    durable.pool.wake()
+    print(f"[CODA] job {job['id']} creato con {job['enqueued']} cabine")
+    return (await durable.job_summary(job["id"]))[0]
+
+@router.get("/queue/jobs")
+async def lista_job_coda():
+    try:
+        return {"jobs": await durable.job_summary(), "workers": durable.pool.stats()}
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail=f"Errore SQL: {str(e)}")
+
+@router.get("/queue/jobs/{job_id}")
+async def stato_job_coda(job_id: int, results: bool = False, offset: int = 0, limit: int = 100, state: Optional[str] = None):
+    try:
+        jobs = await durable.job_summary(job_id)
+        if not jobs:
+            raise HTTPException(status_code=404, detail="Job non trovato")
+        out = jobs[0]
+        if results:
+            out["results"] = await durable.job_items(job_id, state, offset, limit)
+        return out
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail=f"Errore SQL: {str(e)}")
+
+@router.post("/queue/jobs/{job_id}/retry")
+async def riprova_job_coda(job_id: int):
+    # Rimette in coda le cabine in errore o non convergenti
+    try:
+        out = await durable.retry_job(job_id)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail=f"Errore SQL: {str(e)}")
+    if out is None:
+        raise HTTPException(status_code=404, detail="Job non trovato")
+    if out["status"] == "cancelled":
+        raise HTTPException(status_code=409, detail="Job annullato: non si può riprovare")
+    if out["status"] == "running":
+        durable.pool.wake()
+    return {"id": job_id, **out}
+
+@router.post("/queue/jobs/{job_id}/{action}")
+async def azione_job_coda(job_id: int, action: str):
+    # pause: i worker finiscono le cabine in corso e non ne prendono altre; resume: riparte
+    # da dove era; cancel: definitivo, le cabine non ancora prese diventano "cancelled"
+    if action not in QUEUE_ACTIONS:
+        raise HTTPException(status_code=404, detail=f"Azione non valida: {action}")
+    try:
+        ok = await durable.set_job_status(job_id, QUEUE_ACTIONS[action])
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail=f"Errore SQL: {str(e)}")
+    if not ok:
+        raise HTTPException(status_code=409, detail="Job non trovato o già annullato")
+    if action == "resume":
+        durable.pool.wake()
+    return {"id": job_id, "status": QUEUE_ACTIONS[action]}
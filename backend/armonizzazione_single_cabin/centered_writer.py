@@ -0,0 +1,139 @@
+#backend/armonizzazione_single_cabin/centered_writer.py
+#
+# Scrittura raggruppata (write-behind) di geom_centered: le coordinate armonizzate si
+# accumulano in un buffer e un solo task le scrive con un UPDATE ... FROM unnest(...)
+# per transazione, invece di una sessione e un commit per cabina.
+# - flush quando il buffer raggiunge CENTERED_FLUSH_ROWS o ogni CENTERED_FLUSH_MS
+# - chi chiede wait=True aspetta il commit della propria riga (group commit): il flush
+#   parte dopo CENTERED_LINGER_MS, così le righe che arrivano nel frattempo vanno nella
+#   stessa transazione; quelle arrivate durante un flush finiscono nel successivo, quindi
+#   resta al più una transazione di scrittura in corso
+# - i job batch e per aree non aspettano (wait=False): le loro righe si accumulano fino
+#   alla soglia di righe o di tempo
+# - stessa cabina più volte nel buffer: vale l'ultima coordinata
+# - flush fallito: chi aspettava riceve l'errore e la sua riga viene scartata (non verrà
+#   scritta più tardi); le righe senza nessuno in attesa tornano nel buffer e si riprovano
+# - allo spegnimento il buffer viene svuotato; se il DB non risponde le righe rimaste
+#   vengono stampate per poterle recuperare
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from sqlalchemy import text
+from db import SessionLocal
+
+CENTERED_FLUSH_ROWS = int(os.getenv("CENTERED_FLUSH_ROWS", "500"))
+CENTERED_FLUSH_MS = float(os.getenv("CENTERED_FLUSH_MS", "1000"))
+CENTERED_LINGER_MS = float(os.getenv("CENTERED_LINGER_MS", "20"))
+CENTERED_SHUTDOWN_RETRIES = 3
+
+FLUSH_SQL = """
+    UPDATE public.cabine AS c
+    SET geom_centered = ST_SetSRID(ST_MakePoint(v.lng, v.lat), 4326)
+    FROM unnest(CAST(:chk AS TEXT[]), CAST(:lat AS DOUBLE PRECISION[]), CAST(:lng AS DOUBLE PRECISION[]))
+         AS v(chk, lat, lng)
+    WHERE c.chk = v.chk
+"""
+
+
+class CenteredWriter:
+    def __init__(self, max_rows: int = CENTERED_FLUSH_ROWS, interval_ms: float = CENTERED_FLUSH_MS,
+                 linger_ms: float = CENTERED_LINGER_MS):
+        self.max_rows = max(1, max_rows)
+        self.interval = max(0.01, interval_ms / 1000)
+        self.linger = max(0.0, linger_ms / 1000)
+        self._pending = OrderedDict()  # chk -> [lat, lng, futures in attesa del commit]
+        self._wake = asyncio.Event()
+        self._task = None
+        self._closing = False
+
+    async def put(self, chk: str, lat: float, lng: float, wait: bool = True):
+        entry = self._pending.pop(chk, None)
+        futures = entry[2] if entry else []
+        fut = asyncio.get_running_loop().create_future() if wait else None
+        if fut is not None:
+            futures.append(fut)
+        self._pending[chk] = [lat, lng, futures]
+        if self._task is None and not self._closing:
+            self._task = asyncio.create_task(self._run())
+        if wait or len(self._pending) >= self.max_rows:
+            self._wake.set()
+        if self._task is None:
+            # Già spento: scrittura diretta
+            await self.flush()
+        if fut is not None:
+            await fut
+
+    async def _write(self, batch: OrderedDict):
+        items = list(batch.items())
+        async with SessionLocal() as session:
+            for i in range(0, len(items), self.max_rows):
+                chunk = items[i:i + self.max_rows]
+                await session.execute(text(FLUSH_SQL), {
+                    "chk": [chk for chk, _ in chunk],
+                    "lat": [float(v[0]) for _, v in chunk],
+                    "lng": [float(v[1]) for _, v in chunk],
+                })
+            await session.commit()
+
+    async def flush(self) -> bool:
+        if not self._pending:
+            return True
+        batch, self._pending = self._pending, OrderedDict()
+        t0 = time.perf_counter()
+        try:
+            await self._write(batch)
+        except Exception as e:
+            retry = 0
+            for chk, (lat, lng, futures) in reversed(batch.items()):
+                if futures:
+                    # Chi aspettava riceve l'errore: la riga non si riprova
+                    for f in futures:
+                        if not f.done():
+                            f.set_exception(e)
+                    continue
+                # Le righe senza attese tornano nel buffer, a meno che nel frattempo sia
+                # arrivata una coordinata più recente
+                if chk not in self._pending:
+                    self._pending[chk] = [lat, lng, []]
+                    self._pending.move_to_end(chk, last=False)
+                    retry += 1
+            print(f"[GEOM] scrittura di {len(batch)} coordinate fallita, {retry} da riprovare: {e}")
+            return False
+        for _, _, futures in batch.values():
+            for f in futures:
+                if not f.done():
+                    f.set_result(None)
+        print(f"[GEOM] {len(batch)} coordinate salvate in {(time.perf_counter() - t0) * 1000:.0f} ms")
+        return True
+
+    async def _run(self):
+        while not self._closing:
+            woken = False
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+                woken = True
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if woken and self.linger and not self._closing and len(self._pending) < self.max_rows:
+                await asyncio.sleep(self.linger)  # raccoglie le righe in arrivo nello stesso commit
+            if not await self.flush():
+                await asyncio.sleep(self.interval)  # DB in errore: niente flush a raffica
+
+    async def stop(self):
+        self._closing = True
+        self._wake.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        for _ in range(CENTERED_SHUTDOWN_RETRIES):
+            if await self.flush():
+                return
+            await asyncio.sleep(self.interval)
+        for chk, (lat, lng, _) in self._pending.items():
+            print(f"[GEOM] NON SALVATA: chk={chk} lat={lat} lng={lng}")
+
+
+writer = CenteredWriter()
@@ -3,28 +3,39 @@ from fastapi import HTTPException
 from pydantic import BaseModel
 from typing import Optional
 from shapely.geometry import Polygon
-import httpx
 import math
+import os
 import asyncio
+from .tile_source import get_tile_provider, build_crop_jpeg
+from mercator import crop_px_to_latlng, latlng_to_crop_px
+from ai_client import ai
+from db import get_cabina
 
-# pool HTTPX condiviso e timeout "prod"
-limits = httpx.Limits(max_keepalive_connections=10, max_connections=20)
-timeout = httpx.Timeout(20.0)
-_ai_client = httpx.AsyncClient(limits=limits, timeout=timeout)
  # ---- Parametri configurabili
 MAX_ITER = 5
 CENTER_TOLERANCE_PX = 20
 MIN_DENSITY_IMPROVEMENT = 10
 AI_SEMAPHORE = asyncio.Semaphore(4)
+# Seconda passata se non compare nessuno "Stalli AT": stessa crop con test-time augmentation
+# (ribaltamenti e rotazioni di 90° in un solo forward, vedi ai_microservice/tta.py); vuoto = nessuna
+RETRY_TTA = os.getenv("COORD_RETRY_TTA", "flip")
+# Single-shot: la coordinata corretta si calcola in una chiamata dal poligono georeferenziato;
+# una seconda segmentazione su crop centrata solo se la confidenza è sotto soglia.
+# Disattivato per default: i chiamanti lo chiedono per richiesta con `single_shot`
+SINGLE_SHOT = os.getenv("COORD_SINGLE_SHOT", "0") == "1"
+SINGLE_SHOT_CONFIDENCE = float(os.getenv("COORD_SINGLE_SHOT_CONFIDENCE", "0.5"))
+EDGE_MARGIN_PX = 8  # poligono più vicino di così al bordo: probabilmente tagliato
+MIN_STALLO_AREA_PX = 400  # area (px crop) sotto la quale il poligono è poco affidabile
 # ---- Modelli dati
 class CoordinateOptimizationRequest(BaseModel):
     chk: str
     zoom: Optional[float] = 18.0
     crop_size: Optional[int] = 300
-    image: Optional[str] = None  # base64 invisibile catturata dal frontend
+    image: Optional[str] = None  # base64 invisibile catturata dal frontend; se assente la crop si costruisce dalle tile (tile_source.py)
     bearing: Optional[float] = 0.0
     lat: Optional[float] = None  # opzionale: lat iniziale
     lng: Optional[float] = None  # opzionale: lng iniziale
+    single_shot: Optional[bool] = None  # None = COORD_SINGLE_SHOT
 
 class CoordinateOptimizationResponse(BaseModel):
     new_lat: float
@@ -32,75 +43,126 @@ class CoordinateOptimizationResponse(BaseModel):
     iterations: int
     final_distance_px: float
     density_score: int
+    confidence: Optional[float] = None
+    converged: Optional[bool] = None  # solo in single-shot; altrimenti decide final_distance_px
     message: str
 
-# ---- Funzioni di supporto (Web Mercator pixel conversion locali crop) ----
-
-def latlng_to_local_crop_pixel(lat, lng, centerLat, centerLng, zoom, crop_size=300):
-    tile_size = 256
-    world_size = tile_size * (2 ** zoom)
-
-    def latlng_to_global_px(lat, lng):
-        x = (lng + 180.0) / 360.0 * world_size
-        sin_lat = math.sin(math.radians(lat))
-        y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * world_size
-        return x, y
-
-    center_x, center_y = latlng_to_global_px(centerLat, centerLng)
-    px, py = latlng_to_global_px(lat, lng)
-    dx = px - center_x
-    dy = py - center_y
-    local_px = crop_size / 2 + dx
-    local_py = crop_size / 2 + dy
-    return local_px, local_py
-
-def local_crop_pixel_to_latlng(px, py, centerLat, centerLng, zoom, crop_size=300):
-    tile_size = 256
-    world_size = tile_size * (2 ** zoom)
-
-    def latlng_to_global_px(lat, lng):
-        x = (lng + 180.0) / 360.0 * world_size
-        sin_lat = math.sin(math.radians(lat))
-        y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * world_size
-        return x, y
-
-    def global_px_to_latlng(x, y):
-        lng = x / world_size * 360.0 - 180.0
-        n = math.pi - 2.0 * math.pi * y / world_size
-        lat = math.degrees(math.atan(math.sinh(n)))
-        return lat, lng
-
-    center_x, center_y = latlng_to_global_px(centerLat, centerLng)
-    dx = px - (crop_size / 2)
-    dy = py - (crop_size / 2)
-    point_x = center_x + dx
-    point_y = center_y + dy
-    lat, lng = global_px_to_latlng(point_x, point_y)
-    return lat, lng
+# ---- Funzioni di supporto (proiezione Web Mercator in mercator.py) ----
 
 def distance_to_crop_center(px, py, crop_size=300):
     cx = crop_size / 2
     cy = crop_size / 2
     return math.sqrt((px - cx) ** 2 + (py - cy) ** 2)
 
-def rotate_px_about_center(x, y, angle_deg, crop_size=300):
-    cx = crop_size/2; cy = crop_size/2
-    dx = x - cx; dy = y - cy
-    rad = math.radians(angle_deg)
-    rx =  dx*math.cos(rad) - dy*math.sin(rad)
-    ry =  dx*math.sin(rad) + dy*math.cos(rad)
-    return cx+rx, cy+ry
+
+async def segmenta_stalli(lat, lng, zoom, crop_size, image=None, crop_jpeg=None, session=None):
+    """
+    Segmentazione AI della crop: (poligoni 'Stalli AT', tentativi fatti). Con `session` il
+    motore riusa i logits della crop precedente della stessa cabina per la parte sovrapposta.
+    """
+    MAX_ATTEMPTS = 2 if RETRY_TTA else 1
+    attempt = 0
+    # Microservizio o motore embedded (vedi ai_client.py): ripetere la stessa richiesta
+    # darebbe lo stesso risultato, quindi l'eventuale secondo tentativo è un'unica inferenza con TTA
+    while attempt < MAX_ATTEMPTS:
+        print(f"Tentativo segmentazione AI n.{attempt + 1}" + (f" (TTA {RETRY_TTA})" if attempt else ""))
+        payload = {
+            "lat": lat,
+            "lng": lng,
+            "zoom": zoom,
+            "crop_width": crop_size,
+            "crop_height": crop_size,
+        }
+        if attempt:
+            payload["tta"] = RETRY_TTA
+        elif session:
+            payload["session"] = session
+        # limita concorrenza verso il motore AI
+        async with AI_SEMAPHORE:
+            if crop_jpeg is not None:
+                seg_res = await ai.segmenta_bin(crop_jpeg, payload, "image/jpeg")
+            else:
+                seg_res = await ai.segmenta(image, payload)
+
+        print(f"Risposta AI status: {seg_res.status_code}")
+        if seg_res.status_code == 503:
+            raise HTTPException(status_code=503, detail="Motore AI in avvio, riprovare tra poco")
+        poligoni = seg_res.json().get("poligoni", [])
+        print(f"Poligoni ricevuti: {len(poligoni)}")
+        stalli_at = [p for p in poligoni if p.get("label") == "Stalli AT" and len(p.get("points", [])) >= 3]
+        print(f"Poligoni Stalli AT trovati: {len(stalli_at)}")
+        attempt += 1
+        if stalli_at:
+            return stalli_at, attempt
+    return [], attempt
+
+
+def punto_centrale(poligono):
+    """Punto centrale robusto: il centroide, o un punto interno se cade fuori o troppo vicino al bordo."""
+    centro = poligono.centroid
+    if not poligono.contains(centro) or centro.distance(poligono.boundary) < 3:
+        centro = poligono.representative_point()
+    return centro
+
+
+def stima_centro(stalli_at, lat, lng, zoom, crop_size, bearing=0.0) -> dict:
+    """
+    Centro dello 'Stalli AT' più grande in lat/lng, distanza (px) dal centro della crop
+    e confidenza della stima in [0, 1].
+    """
+    # Poligono più grande (per area)
+    shapely_stalli = [Polygon(p["points"]) for p in stalli_at]
+    aree = [poly.area for poly in shapely_stalli]
+    idx_max = aree.index(max(aree))
+    poligono_max = shapely_stalli[idx_max]
+    print(f"Selezionato poligono più grande, area: {poligono_max.area}")
+
+    centro = punto_centrale(poligono_max)
+    print(f"Punto scelto (crop px, ruotati): x={centro.x}, y={centro.y}")
+
+    # Converti a lat/lng (i pixel della crop ruotata vengono deruotati del bearing)
+    centro_lat, centro_lng = crop_px_to_latlng(centro.x, centro.y, lat, lng, zoom, crop_size, bearing=bearing)
+    centro_lat, centro_lng = float(centro_lat), float(centro_lng)
+    px, py = latlng_to_crop_px(centro_lat, centro_lng, lat, lng, zoom, crop_size)
+    dist = distance_to_crop_center(px, py, crop_size)
+
+    # Confidenza: poligono non tagliato dal bordo (il centroide di un poligono tagliato è
+    # spostato verso l'interno), dominante sugli altri Stalli AT, abbastanza grande e compatto
+    minx, miny, maxx, maxy = poligono_max.bounds
+    margine = min(minx, miny, crop_size - 1 - maxx, crop_size - 1 - maxy)
+    fattori = {
+        "bordo": min(1.0, max(0.0, margine / EDGE_MARGIN_PX)),
+        "dominanza": poligono_max.area / sum(aree) if sum(aree) > 0 else 0.0,
+        "area": min(1.0, poligono_max.area / MIN_STALLO_AREA_PX),
+        "compattezza": poligono_max.area / poligono_max.convex_hull.area if poligono_max.convex_hull.area > 0 else 0.0,
+    }
+    confidence = math.prod(fattori.values())
+    print(f"Confidenza stima: {confidence:.2f} " + ", ".join(f"{k}={v:.2f}" for k, v in fattori.items()))
+
+    return {
+        "lat": centro_lat,
+        "lng": centro_lng,
+        "dist": dist,
+        "density": len(stalli_at[idx_max]["points"]),  # numero di vertici del poligono
+        "confidence": round(confidence, 3),
+    }
 
 
 # ---- Funzione principale ----
 async def ottimizza_coordinata(req: CoordinateOptimizationRequest) -> CoordinateOptimizationResponse:
     try:
+        single_shot = SINGLE_SHOT if req.single_shot is None else req.single_shot
         print("\n=== Avvio ottimizzazione coordinata ===")
-        print(f"CHK: {req.chk}, Zoom: {req.zoom}, Crop: {req.crop_size}")
+        print(f"CHK: {req.chk}, Zoom: {req.zoom}, Crop: {req.crop_size}" + (", modalità single-shot" if single_shot else ""))
         print(f"Lat iniziale: {req.lat}, Lng iniziale: {req.lng}")
 
-        # 1. Validazione immagine
-        if not req.image or len(req.image) < 50:
+        # 1. Validazione immagine: senza immagine dal frontend serve un provider di tile
+        tile_provider = None
+        if not req.image:
+            tile_provider = get_tile_provider()
+            if tile_provider is None:
+                raise HTTPException(status_code=400, detail="Immagine base64 mancante e nessun provider di tile configurato")
+        elif len(req.image) < 50:
             print("Immagine non valida (vuota o troppo corta)")
             raise HTTPException(status_code=400, detail="Immagine base64 mancante o troppo corta")
 
@@ -109,95 +171,82 @@ async def ottimizza_coordinata(req: CoordinateOptimizationRequest) -> Coordinate
         if req.lat is not None and req.lng is not None:
             lat, lng = req.lat, req.lng
         else:
-            print("📡 Recupero coordinate iniziali dal backend...")
-            async with httpx.AsyncClient() as client:
-                res = await client.get(f"http://localhost:8000/cabina/{req.chk}")
-                if res.status_code != 200:
-                    raise HTTPException(status_code=404, detail="Cabina non trovata")
-                data = res.json()
-                lat, lng = data["lat"], data["lng"]
+            print("📡 Recupero coordinate iniziali dal database...")
+            data = await get_cabina(req.chk)
+            if data is None:
+                raise HTTPException(status_code=404, detail="Cabina non trovata")
+            lat, lng = data["lat"], data["lng"]
         print(f"Coordinate iniziali: lat={lat}, lng={lng}")
 
         zoom = req.zoom
         crop_size = req.crop_size
+        bearing = req.bearing or 0.0
+
+        crop_jpeg = None
+        if tile_provider is not None:
+            # Crop lato server: stesse tile, zoom, dimensione e bearing della mappa del frontend
+            crop_jpeg = await build_crop_jpeg(tile_provider, lat, lng, zoom, crop_size, bearing)
+            print(f"Crop costruita dalle tile: {len(crop_jpeg)} byte")
 
-        MAX_ATTEMPTS = 2
-        attempt = 0
-        found = False
-        stalli_at = []
-        seg_data = None
-
-        # 3. Tentativi di chiamata a /segmenta_ai (max 2 tentativi)
-        while attempt < MAX_ATTEMPTS and not found:
-            print(f"Tentativo segmentazione AI n.{attempt + 1}")
-            payload = {
-                "image": req.image,
-                "lat": lat,
-                "lng": lng,
-                "zoom": zoom,
-                "crop_width": crop_size,
-                "crop_height": crop_size,
-            }
-            # limita concorrenza verso il microservizio AI e riusa la connessione
-            async with AI_SEMAPHORE:
-                seg_res = await _ai_client.post("http://localhost:9000/segmenta_ai", json=payload)
-
-            print(f"Risposta AI status: {seg_res.status_code}")
-            seg_data = seg_res.json()
-            poligoni = seg_data.get("poligoni", [])
-            print(f"Poligoni ricevuti: {len(poligoni)}")
-            stalli_at = [p for p in poligoni if p.get("label") == "Stalli AT" and len(p.get("points", [])) >= 3]
-            print(f"Poligoni Stalli AT trovati: {len(stalli_at)}")
-            if stalli_at:
-                found = True
-                break
-            attempt += 1
-
-        if not found:
-            print("Nessun poligono 'Stalli AT' trovato anche dopo 2 tentativi, ritorno coordinate originali")
+        # 3. Segmentazione AI
+        session = f"coord-{req.chk}"
+        stalli_at, attempts = await segmenta_stalli(lat, lng, zoom, crop_size, image=req.image, crop_jpeg=crop_jpeg,
+                                                    session=session)
+
+        if not stalli_at:
+            print(f"Nessun poligono 'Stalli AT' trovato anche dopo {attempts} tentativi, ritorno coordinate originali")
             return CoordinateOptimizationResponse(
                 new_lat=lat,
                 new_lng=lng,
-                iterations=attempt,
+                iterations=attempts,
                 final_distance_px=0,
                 density_score=0,
-                message="Nessun poligono 'Stalli AT' trovato dopo 2 tentativi"
+                message=f"Nessun poligono 'Stalli AT' trovato dopo {attempts} tentativi"
             )
 
-        # 5. Trova il poligono più grande (per area)
-        shapely_stalli = [Polygon(p["points"]) for p in stalli_at]
-        aree = [poly.area for poly in shapely_stalli]
-        idx_max = aree.index(max(aree))
-        poligono_max = shapely_stalli[idx_max]
-        print(f"Selezionato poligono più grande, area: {poligono_max.area}")
-
-        # 6. Punto centrale robusto del poligono
-        centro = poligono_max.centroid
-        if not poligono_max.contains(centro) or centro.distance(poligono_max.boundary) < 3:
-            centro = poligono_max.representative_point()
-        print(f"Punto scelto (crop px, ruotati): x={centro.x}, y={centro.y}")
-
-        # 7. Deruota i pixel della crop prima della conversione
-        ux, uy = rotate_px_about_center(centro.x, centro.y, -(req.bearing or 0.0), crop_size)
-
-        # 8. Converti a lat/lng
-        centro_lat, centro_lng = local_crop_pixel_to_latlng(ux, uy, lat, lng, zoom, crop_size)
-        px, py = latlng_to_local_crop_pixel(centro_lat, centro_lng, lat, lng, zoom, crop_size)
-        dist = distance_to_crop_center(px, py, crop_size)
-        print(f"Punto scelto (crop px): x={centro.x}, y={centro.y}")
-
-        # 9. Densità pixel (numero di vertici del poligono)
-        density_prev = len(stalli_at[idx_max]["points"])
-        print(f"Density score: {density_prev}")
+        # 4. Centro dello Stalli AT più grande
+        stima = stima_centro(stalli_at, lat, lng, zoom, crop_size, bearing=req.bearing)
+        print(f"Density score: {stima['density']}")
+
+        converged = None
+        message = "Ottimizzazione basata sullo 'Stalli AT' più grande"
+        if single_shot:
+            # 5. Single-shot: il centro georeferenziato è già la coordinata finale; una crop
+            #    centrata sul nuovo punto serve solo se la stima è poco affidabile, e va presa
+            #    dalla stessa sorgente della prima passata
+            if stima["confidence"] >= SINGLE_SHOT_CONFIDENCE:
+                converged = True
+                message = f"Coordinata finale in un passaggio (confidenza {stima['confidence']:.2f})"
+            elif tile_provider is None:
+                # Immagine dal frontend: la verifica è la sua prossima cattura, centrata sul nuovo punto
+                converged = False
+                message = f"Confidenza bassa ({stima['confidence']:.2f}), serve una verifica"
+            else:
+                print(f"Confidenza bassa ({stima['confidence']:.2f}), verifica su crop centrata")
+                crop_jpeg = await build_crop_jpeg(tile_provider, stima["lat"], stima["lng"], zoom, crop_size, bearing)
+                stalli_v, attempts_v = await segmenta_stalli(stima["lat"], stima["lng"], zoom, crop_size,
+                                                             crop_jpeg=crop_jpeg, session=session)
+                attempts += attempts_v
+                if stalli_v:
+                    verifica = stima_centro(stalli_v, stima["lat"], stima["lng"], zoom, crop_size, bearing=req.bearing)
+                    converged = verifica["dist"] < CENTER_TOLERANCE_PX
+                    message = (f"Verificata su crop centrata: scarto {verifica['dist']:.1f} px "
+                               f"(confidenza {verifica['confidence']:.2f})")
+                    stima = verifica
+                else:
+                    converged = False
+                    message = "Verifica su crop centrata senza 'Stalli AT'"
 
         print("=== Ottimizzazione completata ===\n")
         return CoordinateOptimizationResponse(
-            new_lat=centro_lat,
-            new_lng=centro_lng,
-            iterations=attempt + 1,
-            final_distance_px=dist,
-            density_score=density_prev,
-            message="Ottimizzazione basata sullo 'Stalli AT' più grande"
+            new_lat=stima["lat"],
+            new_lng=stima["lng"],
+            iterations=attempts,
+            final_distance_px=stima["dist"],
+            density_score=stima["density"],
+            confidence=stima["confidence"],
+            converged=converged,
+            message=message
         )
     except HTTPException:
         raise
@@ -1,12 +1,26 @@
 #backend/armonizzazione_single_cabin/router.py
 from fastapi import APIRouter, HTTPException
-from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
-from db import SessionLocal
+from db import get_cabina
 from .coord_optimizer import CoordinateOptimizationRequest, ottimizza_coordinata
+from .centered_writer import writer as centered_writer
 
 router = APIRouter()
 
+# Distanza (px) sotto la quale il centro è considerato armonizzato
+CENTER_DONE_PX = 20
+
+def convergente(result) -> bool:
+    # In single-shot decide l'ottimizzatore (confidenza o verifica), altrimenti lo spostamento dell'ultimo passo
+    if result.converged is not None:
+        return result.converged
+    return result.final_distance_px < CENTER_DONE_PX
+
+async def salva_geom_centered(chk: str, lat: float, lng: float, wait: bool = True):
+    # Scrittura raggruppata con le altre cabine armonizzate (vedi centered_writer.py);
+    # con wait=True ritorna dopo il commit
+    await centered_writer.put(chk, lat, lng, wait=wait)
+
 @router.post("/update_centered_coord")
 async def update_centered_coord(req: CoordinateOptimizationRequest):
     try:
@@ -14,16 +28,11 @@ async def update_centered_coord(req: CoordinateOptimizationRequest):
 
         # 1. Alla PRIMA chiamata (iterazione 0): prendi SEMPRE coordinate da DB!
         if req.lat is None or req.lng is None:  # OPPURE: controlla se c'è un flag 'first_iteration'
-            async with SessionLocal() as session:
-                res = await session.execute(
-                    text("SELECT ST_Y(geom::geometry) AS lat, ST_X(geom::geometry) AS lng FROM public.cabine WHERE chk = :chk"),
-                    {"chk": req.chk}
-                )
-                row = res.fetchone()
-                if not row:
-                    raise HTTPException(status_code=404, detail="Cabina non trovata")
-                lat_db = row.lat
-                lng_db = row.lng
+            cabina = await get_cabina(req.chk)
+            if not cabina:
+                raise HTTPException(status_code=404, detail="Cabina non trovata")
+            lat_db = cabina["lat"]
+            lng_db = cabina["lng"]
         else:
             lat_db = req.lat
             lng_db = req.lng
@@ -37,27 +46,19 @@ async def update_centered_coord(req: CoordinateOptimizationRequest):
                 image=req.image,
                 lat=lat_db,
                 lng=lng_db,
-                bearing=getattr(req, "bearing", 0.0)
+                bearing=getattr(req, "bearing", 0.0),
+                single_shot=req.single_shot
             )
         )
         ...
 
         # Condizione di stop
-        done = result.final_distance_px < 20
+        done = convergente(result)
 
         if done:
             print(f"[SERVER] Armonizzazione completata")
             # Salvo nel DB solo alla fine
-            async with SessionLocal() as session:
-                await session.execute(
-                    text("""
-                        UPDATE public.cabine
-                        SET geom_centered = ST_SetSRID(ST_MakePoint(:lng, :lat), 4326)
-                        WHERE chk = :chk
-                    """),
-                    {"lat": result.new_lat, "lng": result.new_lng, "chk": req.chk}
-                )
-                await session.commit()
+            await salva_geom_centered(req.chk, result.new_lat, result.new_lng)
 
         return {
             "chk": req.chk,
@@ -65,10 +66,14 @@ async def update_centered_coord(req: CoordinateOptimizationRequest):
             "new_lng": result.new_lng,
             "final_distance_px": result.final_distance_px,
             "density_score": result.density_score,
+            "confidence": result.confidence,
+            "iterations": result.iterations,
             "done": done,
             "message": "Ottimizzazione completata" if done else "Step completato, continuare"
         }
 
+    except HTTPException:
+        raise
     except SQLAlchemyError as e:
         raise HTTPException(status_code=500, detail=f"Errore SQL: {str(e)}")
     except Exception as e:
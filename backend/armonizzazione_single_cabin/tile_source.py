@@ -0,0 +1,233 @@
+#backend/armonizzazione_single_cabin/tile_source.py
+#
+# Crop satellitari costruite lato server dalle tile XYZ (stesso layer Esri del frontend),
+# senza browser: si scaricano le tile che coprono la crop, si cuciono e con un'unica
+# trasformazione affine (traslazione + scala per lo zoom frazionario + rotazione del
+# bearing) si ottiene l'immagine che il frontend avrebbe catturato con html2canvas.
+# Il provider è intercambiabile: server XYZ via HTTP oppure file MBTiles locale (test).
+
+import asyncio
+import math
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+import cv2
+import httpx
+import numpy as np
+from mercator import TILE_SIZE, latlng_to_global_px
+
+# Sorgente tile: URL XYZ ({z}/{x}/{y}) oppure file .mbtiles (ha la precedenza se impostato).
+# Nessuna sorgente per default: il server scarica tile solo se configurato
+TILE_URL = os.getenv("TILE_URL", "")
+TILE_MBTILES = os.getenv("TILE_MBTILES", "")
+# Zoom massimo servito dal provider: oltre si ingrandiscono le tile di questo livello
+TILE_MAX_ZOOM = int(os.getenv("TILE_MAX_ZOOM", "19"))
+TILE_CONCURRENCY = int(os.getenv("TILE_CONCURRENCY", "8"))
+TILE_CACHE_SIZE = int(os.getenv("TILE_CACHE_SIZE", "512"))  # tile decodificate in memoria
+
+_EMPTY_RGB = (128, 128, 128)
+
+
+class _TileCache:
+    """LRU delle tile decodificate (RGB), condivisa tra richieste e iterazioni vicine."""
+
+    def __init__(self, max_tiles: int):
+        self.max_tiles = max_tiles
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            tile = self._data.get(key)
+            if tile is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def put(self, key, tile):
+        if self.max_tiles <= 0:
+            return
+        with self._lock:
+            self._data[key] = tile
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_tiles:
+                self._data.popitem(last=False)
+
+
+def _decode_tile(data):
+    if not data:
+        return None
+    bgr = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if bgr is None:
+        return None
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+
+class XYZTileProvider:
+    """Tile da un server XYZ/TMS via HTTP, con concorrenza limitata e cache in memoria."""
+
+    def __init__(self, url_template: str, max_zoom: int = TILE_MAX_ZOOM,
+                 concurrency: int = TILE_CONCURRENCY, cache_size: int = TILE_CACHE_SIZE):
+        self.url_template = url_template
+        self.max_zoom = max_zoom
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=concurrency, max_connections=concurrency),
+            timeout=httpx.Timeout(10.0),
+            headers={"User-Agent": "cabina-app/armonizzazione"},
+        )
+        self._sem = asyncio.Semaphore(concurrency)
+        self._cache = _TileCache(cache_size)
+
+    async def get_tile(self, z: int, x: int, y: int):
+        key = (z, x, y)
+        tile = self._cache.get(key)
+        if tile is not None:
+            return tile
+        url = self.url_template.format(z=z, x=x, y=y)
+        async with self._sem:
+            res = await self._client.get(url)
+        if res.status_code == 404:
+            return None
+        res.raise_for_status()
+        tile = _decode_tile(res.content)
+        if tile is not None:
+            self._cache.put(key, tile)
+        return tile
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+class MBTilesProvider:
+    """Tile da un file MBTiles (SQLite, righe in schema TMS): per test e uso offline."""
+
+    def __init__(self, path: str, cache_size: int = TILE_CACHE_SIZE):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"MBTiles non trovato: {path}")
+        self.path = path
+        self._local = threading.local()
+        self._cache = _TileCache(cache_size)
+        with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as conn:
+            row = conn.execute("SELECT MAX(zoom_level) FROM tiles").fetchone()
+        self.max_zoom = int(row[0]) if row and row[0] is not None else TILE_MAX_ZOOM
+
+    def _conn(self):
+        # Una connessione per thread (sqlite3 non condivide le connessioni tra thread)
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    def _read(self, z, x, y):
+        row = self._conn().execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, (1 << z) - 1 - y),
+        ).fetchone()
+        return _decode_tile(row[0]) if row else None
+
+    async def get_tile(self, z: int, x: int, y: int):
+        key = (z, x, y)
+        tile = self._cache.get(key)
+        if tile is not None:
+            return tile
+        tile = await asyncio.to_thread(self._read, z, x, y)
+        if tile is not None:
+            self._cache.put(key, tile)
+        return tile
+
+    async def aclose(self):
+        pass
+
+
+_provider = None
+
+
+def get_tile_provider():
+    """Provider configurato (TILE_MBTILES oppure TILE_URL), creato al primo uso; None se disattivato."""
+    global _provider
+    if _provider is None:
+        if TILE_MBTILES:
+            _provider = MBTilesProvider(TILE_MBTILES)
+        elif TILE_URL:
+            _provider = XYZTileProvider(TILE_URL)
+    return _provider
+
+
+def tile_cache_stats():
+    """Hit e miss della cache di tile del provider (None se non ancora creato o disattivato)."""
+    if _provider is None:
+        return None
+    return {"hits": _provider._cache.hits, "misses": _provider._cache.misses}
+
+
+async def close_tile_provider():
+    global _provider
+    if _provider is not None:
+        await _provider.aclose()
+        _provider = None
+
+
+async def build_crop(provider, lat: float, lng: float, zoom: float, size: int = 300,
+                     bearing: float = 0.0, height: int = None) -> np.ndarray:
+    """
+    Crop RGB size x size (size x height se indicata) centrata su (lat, lng) allo zoom
+    (anche frazionario) richiesto, ruotata come la mappa con il bearing: 1 pixel = 1 pixel
+    mappa allo zoom dato, come le crop del frontend.
+    """
+    height = size if height is None else height
+    z = min(provider.max_zoom, max(0, math.ceil(zoom)))
+    scale = 2.0 ** (zoom - z)  # pixel crop per pixel tile
+    cx, cy = (float(v) for v in latlng_to_global_px(lat, lng, z))
+
+    # Metà lati della crop in pixel tile (semidiagonale se ruotata)
+    if bearing:
+        half_x = half_y = math.hypot(size, height) / 2 / scale + 1
+    else:
+        half_x, half_y = size / 2 / scale + 1, height / 2 / scale + 1
+    n = 1 << z
+    tx0, tx1 = int((cx - half_x) // TILE_SIZE), int((cx + half_x) // TILE_SIZE)
+    ty0, ty1 = max(0, int((cy - half_y) // TILE_SIZE)), min(n - 1, int((cy + half_y) // TILE_SIZE))
+
+    coords = [(tx, ty) for ty in range(ty0, ty1 + 1) for tx in range(tx0, tx1 + 1)]
+    tiles = await asyncio.gather(*[provider.get_tile(z, tx % n, ty) for tx, ty in coords])
+
+    mosaic = np.empty(((ty1 - ty0 + 1) * TILE_SIZE, (tx1 - tx0 + 1) * TILE_SIZE, 3), dtype=np.uint8)
+    mosaic[:] = _EMPTY_RGB
+    for (tx, ty), tile in zip(coords, tiles):
+        if tile is None:
+            continue
+        if tile.shape[:2] != (TILE_SIZE, TILE_SIZE):
+            tile = cv2.resize(tile, (TILE_SIZE, TILE_SIZE), interpolation=cv2.INTER_AREA)
+        oy, ox = (ty - ty0) * TILE_SIZE, (tx - tx0) * TILE_SIZE
+        mosaic[oy:oy + TILE_SIZE, ox:ox + TILE_SIZE] = tile
+
+    # Mappa inversa crop -> mosaico: src = R(-bearing) * (dst - centro crop) / scale + centro mosaico
+    rad = math.radians(-(bearing or 0.0))
+    c, s = math.cos(rad) / scale, math.sin(rad) / scale
+    mx, my = cx - tx0 * TILE_SIZE, cy - ty0 * TILE_SIZE
+    hw, hh = size / 2, height / 2
+    M = np.array([
+        [c, -s, mx - (c * hw - s * hh)],
+        [s, c, my - (s * hw + c * hh)],
+    ])
+    return cv2.warpAffine(
+        mosaic, M, (size, height), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+        borderMode=cv2.BORDER_CONSTANT, borderValue=_EMPTY_RGB,
+    )
+
+
+async def build_crop_jpeg(provider, lat: float, lng: float, zoom: float, size: int = 300,
+                          bearing: float = 0.0, quality: int = 90, height: int = None) -> bytes:
+    crop = await build_crop(provider, lat, lng, zoom, size, bearing, height)
+    ok, buf = await asyncio.to_thread(
+        cv2.imencode, ".jpg", cv2.cvtColor(crop, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, quality]
+    )
+    if not ok:
+        raise RuntimeError("Codifica JPEG della crop fallita")
+    return buf.tobytes()
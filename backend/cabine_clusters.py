@@ -0,0 +1,330 @@
+# backend/cabine_clusters.py
+#
+# Indice gerarchico in memoria delle cabine per la mappa (stile supercluster), usato da
+# GET /cabine/clusters: invece di tutta la tabella il frontend riceve solo ciò che si vede.
+#
+# Per ogni zoom intero da 0 a CLUSTER_MAX_ZOOM le cabine sono raggruppate in celle di
+# CLUSTER_RADIUS_PX pixel schermo (pixel globali Web Mercator, vedi mercator.py); ogni
+# cluster ha il centroide (media delle posizioni in pixel globali) e il numero di cabine.
+# Le celle di uno zoom sono esattamente 2x2 celle dello zoom successivo, quindi i cluster
+# sono annidati: un cluster allo zoom z è l'unione dei suoi figli a z+1, e `expansion_zoom`
+# è il primo zoom a cui si divide (quello a cui portare la mappa al click).
+# Oltre CLUSTER_MAX_ZOOM, e per i cluster di una sola cabina, si restituiscono le cabine
+# con gli stessi campi di GET /cabine. Con i filtri di /cabine (tipo, area, regione,
+# provincia) si usa un indice costruito sul sottoinsieme, tenuto in una piccola LRU. Una vista contiene al più
+# (larghezza / raggio + 1) x (altezza / raggio + 1) celle: la risposta resta di poche
+# centinaia di elementi qualunque sia il numero di cabine caricate.
+#
+# L'indice si costruisce all'avvio da public.cabine e si ricostruisce quando cambia la
+# versione della tabella, controllata ogni CLUSTER_REFRESH_S secondi con la lettura di una
+# sola riga (vedi VERSION_SCHEMA_SQL). La costruzione è vettoriale e gira in un thread; le
+# query usano l'indice precedente finché quello nuovo non è pronto.
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+import numpy as np
+from sqlalchemy import text
+from db import SessionLocal
+from mercator import global_px_to_latlng, latlng_to_global_px, world_size
+
+CLUSTER_RADIUS_PX = int(os.getenv("CLUSTER_RADIUS_PX", "60"))
+CLUSTER_MAX_ZOOM = int(os.getenv("CLUSTER_MAX_ZOOM", "16"))  # oltre: cabine singole
+CLUSTER_REFRESH_S = float(os.getenv("CLUSTER_REFRESH_S", "30"))
+# Indici per combinazione di filtri (tipo, area, regione, provincia) tenuti in memoria
+CLUSTER_FILTER_CACHE = int(os.getenv("CLUSTER_FILTER_CACHE", "16"))
+MAX_LAT = 85.05112878  # limite della proiezione Web Mercator
+
+ROWS_SQL = """
+    SELECT id, id_cab, denom, tipo_nodo, chk,
+           COALESCE(NULLIF(tipo_cabina, ''), 'e-distribuzione') AS tipo_cabina,
+           area_regionale, regione, provincia,
+           ST_X(geom::geometry) AS lng,
+           ST_Y(geom::geometry) AS lat
+    FROM public.cabine
+    WHERE geom IS NOT NULL
+    ORDER BY id
+"""
+
+# Versione di public.cabine: un contatore in una tabella di una riga, incrementato da un
+# trigger per istruzione (non per riga) su inserimenti, cancellazioni, TRUNCATE e modifiche
+# dei campi dell'indice. Le scritture di geom_centered non lo toccano. Creato all'avvio se
+# manca, come lo schema della coda; il lock advisory serializza i processi che partono insieme.
+VERSION_SCHEMA_SQL = [
+    "SELECT pg_advisory_xact_lock(hashtext('public.cabine_versione'))",
+    """
+    CREATE TABLE IF NOT EXISTS public.cabine_versione (
+        id       BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+        versione BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    "INSERT INTO public.cabine_versione (id) VALUES (TRUE) ON CONFLICT (id) DO NOTHING",
+    """
+    CREATE OR REPLACE FUNCTION public.cabine_versione_incr() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE public.cabine_versione SET versione = versione + 1;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                       WHERE tgname = 'cabine_versione_trg' AND tgrelid = 'public.cabine'::regclass) THEN
+            CREATE TRIGGER cabine_versione_trg
+            AFTER INSERT OR DELETE OR TRUNCATE
+                OR UPDATE OF id, id_cab, denom, tipo_nodo, chk, tipo_cabina, area_regionale, regione, provincia, geom
+            ON public.cabine
+            FOR EACH STATEMENT EXECUTE FUNCTION public.cabine_versione_incr();
+        END IF;
+    END
+    $$
+    """,
+]
+
+VERSION_SQL = "SELECT versione FROM public.cabine_versione"
+
+# Senza permessi per il trigger: contatori di pg_stat_user_tables, senza scansione ma
+# cambiano anche con geom_centered (ricostruzioni in più, al massimo una per giro)
+STAT_VERSION_SQL = """
+    SELECT n_tup_ins, n_tup_upd, n_tup_del
+    FROM pg_stat_user_tables
+    WHERE relid = 'public.cabine'::regclass
+"""
+
+
+def parse_bbox(value: str) -> tuple:
+    """'ovest,sud,est,nord' in gradi -> tupla di float; ValueError se non valido."""
+    parts = [p.strip() for p in str(value).split(",")]
+    if len(parts) != 4:
+        raise ValueError("bbox deve essere 'ovest,sud,est,nord'")
+    west, south, east, north = (float(p) for p in parts)
+    if not all(np.isfinite([west, south, east, north])) or south > north:
+        raise ValueError("bbox non valido")
+    return west, south, east, north
+
+
+def filtra_righe(rows: list, tipo=None, area_regionale=None, regione=None, provincia=None) -> list:
+    """Stessi filtri di GET /cabine (provincia: prefisso senza distinzione di maiuscole)."""
+    tipi = set(tipo) if tipo else None
+    prefisso = provincia.upper() if provincia else None
+    return [r for r in rows
+            if (tipi is None or r["tipo_cabina"] in tipi)
+            and (not area_regionale or r["area_regionale"] == area_regionale)
+            and (not regione or r["regione"] == regione)
+            and (prefisso is None or (r["provincia"] or "").upper().startswith(prefisso))]
+
+
+def _in_bbox(lat, lng, west, south, east, north):
+    lat_ok = (lat >= south) & (lat <= north)
+    if east - west >= 360:
+        return lat_ok
+    # Longitudini riportate in [-180, 180): un bbox che attraversa l'antimeridiano ha ovest > est
+    west = (west + 180) % 360 - 180
+    east = (east + 180) % 360 - 180
+    if west <= east:
+        return lat_ok & (lng >= west) & (lng <= east)
+    return lat_ok & ((lng >= west) | (lng <= east))
+
+
+def _pad_bbox(west, south, east, north, zoom, pad_px):
+    """Bbox allargato di `pad_px` pixel schermo allo zoom dato (in y lungo la proiezione)."""
+    size = float(world_size(zoom))
+    _, y_south = latlng_to_global_px(max(south, -MAX_LAT), 0.0, zoom)
+    _, y_north = latlng_to_global_px(min(north, MAX_LAT), 0.0, zoom)
+    south = float(global_px_to_latlng(0.0, min(size, y_south + pad_px), zoom)[0]) if south > -MAX_LAT else south
+    north = float(global_px_to_latlng(0.0, max(0.0, y_north - pad_px), zoom)[0]) if north < MAX_LAT else north
+    pad_lng = pad_px * 360.0 / size
+    if east - west >= 360 or (east - west) % 360 + 2 * pad_lng >= 360:
+        return -180.0, south, 180.0, north
+    return west - pad_lng, south, east + pad_lng, north
+
+
+class ClusterIndex:
+    """Cluster annidati per zoom 0..max_zoom di un elenco di cabine (dict con lat, lng)."""
+
+    def __init__(self, rows: list, radius_px: int = CLUSTER_RADIUS_PX, max_zoom: int = CLUSTER_MAX_ZOOM):
+        self.rows = rows
+        self.radius_px = max(1, radius_px)
+        self.max_zoom = max(0, max_zoom)
+        self.lat = np.array([r["lat"] for r in rows], dtype=np.float64)
+        self.lng = np.array([r["lng"] for r in rows], dtype=np.float64)
+        # Per zoom: centroidi lat/lng, conteggi, prima cabina di ogni cluster, expansion_zoom
+        self.levels = [None] * (self.max_zoom + 1)
+
+        gx, gy = latlng_to_global_px(np.clip(self.lat, -MAX_LAT, MAX_LAT), self.lng, self.max_zoom)
+        cx = np.floor(gx / self.radius_px).astype(np.int64)
+        cy = np.floor(gy / self.radius_px).astype(np.int64)
+        inverse = [None] * (self.max_zoom + 1)  # per zoom: cluster di ogni cabina
+        for z in range(self.max_zoom, -1, -1):
+            shift = self.max_zoom - z  # una cella a z = 2^shift x 2^shift celle a max_zoom
+            key = ((cy >> shift) << 32) | (cx >> shift)
+            _, first, inv = np.unique(key, return_index=True, return_inverse=True)
+            inv = inv.reshape(-1)
+            count = np.bincount(inv, minlength=len(first))
+            lat, lng = global_px_to_latlng(np.bincount(inv, weights=gx) / np.maximum(count, 1),
+                                           np.bincount(inv, weights=gy) / np.maximum(count, 1), self.max_zoom)
+            inverse[z] = inv
+            self.levels[z] = {"lat": lat, "lng": lng, "count": count, "first": first}
+
+        # expansion_zoom: a max_zoom i cluster rimasti (cabine quasi sovrapposte) si aprono
+        # solo mostrando le cabine singole; sotto, il cluster si divide a z+1 se ha più figli,
+        # altrimenti coincide con il suo unico figlio
+        top = self.levels[self.max_zoom]
+        top["expansion"] = np.full(len(top["count"]), self.max_zoom + 1, dtype=np.int64)
+        for z in range(self.max_zoom - 1, -1, -1):
+            level, child = self.levels[z], self.levels[z + 1]
+            children = np.bincount(inverse[z][child["first"]], minlength=len(level["count"]))
+            only_child = inverse[z + 1][level["first"]]
+            level["expansion"] = np.where(children > 1, z + 1, child["expansion"][only_child])
+
+    def stats(self) -> dict:
+        return {
+            "cabine": len(self.rows),
+            "max_zoom": self.max_zoom,
+            "radius_px": self.radius_px,
+            "clusters_per_zoom": [len(level["count"]) for level in self.levels],
+        }
+
+    def query(self, west: float, south: float, east: float, north: float, zoom: float) -> dict:
+        """
+        Cluster e cabine singole il cui centroide cade nel bbox, allo zoom intero della mappa.
+        Il bbox si allarga del raggio dei cluster allo zoom della mappa: un cluster con il
+        centroide appena fuori dalla vista ha cabine (e il marker) dentro.
+        """
+        z = max(0, int(np.floor(zoom)))
+        west, south, east, north = _pad_bbox(west, south, east, north, max(0.0, zoom), self.radius_px)
+        data = []
+        if z > self.max_zoom:
+            for i in np.flatnonzero(_in_bbox(self.lat, self.lng, west, south, east, north)):
+                data.append(self.rows[i])
+            return {"zoom": z, "data": data}
+        level = self.levels[z]
+        for i in np.flatnonzero(_in_bbox(level["lat"], level["lng"], west, south, east, north)):
+            count = int(level["count"][i])
+            if count == 1:
+                data.append(self.rows[level["first"][i]])
+                continue
+            data.append({
+                "cluster": True,
+                "count": count,
+                "lat": float(level["lat"][i]),
+                "lng": float(level["lng"][i]),
+                "expansion_zoom": int(level["expansion"][i]),
+            })
+        return {"zoom": z, "data": data}
+
+
+class ClusterService:
+    """Indice corrente, costruito all'avvio e ricostruito quando public.cabine cambia."""
+
+    def __init__(self, refresh_s: float = CLUSTER_REFRESH_S):
+        self.refresh_s = refresh_s
+        self.index = None
+        self.version = None
+        self._version_sql = None  # VERSION_SQL o STAT_VERSION_SQL, scelta al primo refresh
+        self.built_at = None
+        self.build_seconds = None
+        self._lock = asyncio.Lock()
+        self._task = None
+        # Filtri -> indice sul sottoinsieme di cabine, LRU; svuotata a ogni ricostruzione
+        self._filtered = OrderedDict()
+
+    async def _ensure_version(self):
+        try:
+            async with SessionLocal() as session:
+                for stmt in VERSION_SCHEMA_SQL:
+                    await session.execute(text(stmt))
+                await session.commit()
+            self._version_sql = VERSION_SQL
+        except Exception as e:
+            print(f"[CLUSTER] trigger di versione non creato, uso pg_stat_user_tables: {e}")
+            self._version_sql = STAT_VERSION_SQL
+
+    async def refresh(self, force: bool = False) -> bool:
+        """Ricostruisce l'indice se la versione della tabella è cambiata; True se ricostruito."""
+        async with self._lock:
+            if self._version_sql is None:
+                await self._ensure_version()
+            async with SessionLocal() as session:
+                try:
+                    row = (await session.execute(text(self._version_sql))).fetchone()
+                except Exception:
+                    self._version_sql = None  # database non raggiungibile: al prossimo giro si riprova il trigger
+                    raise
+                version = tuple(row) if row is not None else None
+                if not force and self.index is not None and version == self.version:
+                    return False
+                result = await session.execute(text(ROWS_SQL))
+                rows = [dict(row._mapping) for row in result.fetchall()]
+            t0 = time.perf_counter()
+            self.index = await asyncio.to_thread(ClusterIndex, rows)
+            self._filtered.clear()
+            self.version = version
+            self.built_at = time.time()
+            self.build_seconds = time.perf_counter() - t0
+            print(f"[CLUSTER] indice costruito: {len(rows)} cabine, zoom 0-{self.index.max_zoom} "
+                  f"in {self.build_seconds:.2f} s")
+            return True
+
+    async def _index_for(self, tipo=None, area_regionale=None, regione=None, provincia=None) -> ClusterIndex:
+        if not (tipo or area_regionale or regione or provincia):
+            return self.index
+        key = (tuple(sorted(set(tipo))) if tipo else None, area_regionale or None, regione or None,
+               provincia.upper() if provincia else None)
+        index = self._filtered.get(key)
+        if index is None:
+            base = self.index
+            index = await asyncio.to_thread(
+                lambda: ClusterIndex(filtra_righe(base.rows, tipo, area_regionale, regione, provincia),
+                                     base.radius_px, base.max_zoom))
+            if base is not self.index:
+                return index  # indice ricostruito nel frattempo: risultato non riusabile
+            self._filtered[key] = index
+            while len(self._filtered) > max(0, CLUSTER_FILTER_CACHE):
+                self._filtered.popitem(last=False)
+        else:
+            self._filtered.move_to_end(key)
+        return index
+
+    async def query(self, west: float, south: float, east: float, north: float, zoom: float,
+                    tipo=None, area_regionale=None, regione=None, provincia=None) -> dict:
+        if self.index is None:
+            await self.refresh()
+        index = await self._index_for(tipo, area_regionale, regione, provincia)
+        return index.query(west, south, east, north, zoom)
+
+    def start(self):
+        if self._task is None and self.refresh_s > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        # Il primo giro costruisce l'indice, i successivi controllano solo la versione
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[CLUSTER] aggiornamento indice fallito: {e}")
+            await asyncio.sleep(self.refresh_s)
+
+    def stats(self) -> dict:
+        out = {"built": self.index is not None, "refresh_s": self.refresh_s,
+               "build_seconds": round(self.build_seconds, 3) if self.build_seconds is not None else None}
+        if self.index is not None:
+            out.update(self.index.stats())
+            out["filtered_indexes"] = len(self._filtered)
+        return out
+
+
+clusters = ClusterService()
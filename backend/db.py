@@ -1,4 +1,5 @@
 # backend/db.py
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 
@@ -13,4 +14,18 @@ SessionLocal = sessionmaker(
     bind=engine,
     expire_on_commit=False,
     class_=AsyncSession
-)
\ No newline at end of file
+)
+
+
+async def get_cabina(chk: str):
+    """Posizione (geom originale) e denominazione di una cabina per chk, None se assente."""
+    async with SessionLocal() as session:
+        result = await session.execute(text("""
+            SELECT ST_Y(geom::geometry) AS lat,
+                   ST_X(geom::geometry) AS lng,
+                   denom, chk
+            FROM public.cabine
+            WHERE chk = :chk
+        """), {"chk": chk})
+        row = result.fetchone()
+        return dict(row._mapping) if row else None
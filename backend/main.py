@@ -1,20 +1,24 @@
 # backend/main.py
 
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import text
 from armonizzazione_single_cabin import router as armonizzazione_router
+from armonizzazione_single_cabin.tile_source import close_tile_provider
+from armonizzazione_single_cabin.centered_writer import writer as centered_writer
+from armonizzazione_batch import router as batch_router
+from armonizzazione_batch.jobs import manager as batch_manager
+from armonizzazione_batch import queue as batch_queue
 from schemas import AIRequest
-from db import SessionLocal
+from db import SessionLocal, get_cabina
+from cabine_clusters import clusters as cabine_clusters, parse_bbox
+from ai_client import ai
 import httpx
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from typing import List, Optional
 import asyncio
 
 app = FastAPI()
-limits = httpx.Limits(max_keepalive_connections=5, max_connections=8)
-timeout = httpx.Timeout(60.0)
-ai_client = httpx.AsyncClient(limits=limits, timeout=timeout)
 ai_semaphore = asyncio.Semaphore(4)  # max 4 richieste AI contemporanee
 
 FAKE_CABINE = [
@@ -50,6 +54,7 @@ app.add_middleware(
 )
 
 app.include_router(armonizzazione_router.router)
+app.include_router(batch_router.router)
 
 def _tipo_expr():
     return "COALESCE(NULLIF(tipo_cabina,''), 'e-distribuzione')"
@@ -180,6 +185,29 @@ async def get_cabine(
         print("[WARN] Errore /cabine:", e)
         return {"data": []}
 
+@app.get("/cabine/clusters")
+async def get_cabine_clusters(
+    bbox: str,
+    zoom: float,
+    tipo: List[str] | None = Query(default=None),
+    area_regionale: Optional[str] = None,
+    regione: Optional[str] = None,
+    provincia: Optional[str] = None,
+):
+    # Vista della mappa: cluster con conteggio a zoom bassi, cabine singole a zoom alti
+    # (indice in memoria, vedi cabine_clusters.py). bbox = ovest,sud,est,nord in gradi,
+    # filtri come /cabine
+    try:
+        west, south, east, north = parse_bbox(bbox)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    try:
+        return await cabine_clusters.query(west, south, east, north, zoom,
+                                           tipo, area_regionale, regione, provincia)
+    except Exception as e:
+        print("[WARN] Errore /cabine/clusters:", e)
+        return {"zoom": max(0, int(zoom)), "data": []}
+
 @app.get("/cabina_near")
 async def get_cabina_near(lat: float, lng: float):
     try:
@@ -204,18 +232,10 @@ async def get_cabina_near(lat: float, lng: float):
 @app.get("/cabina/{chk}")
 async def get_cabina_by_chk(chk: str):
     try:
-        async with SessionLocal() as session:
-            result = await session.execute(text("""
-                SELECT ST_Y(geom::geometry) AS lat,
-                       ST_X(geom::geometry) AS lng,
-                       denom, chk
-                FROM public.cabine
-                WHERE chk = :chk
-            """), {"chk": chk})
-            row = result.fetchone()
-            if row:
-                return dict(row._mapping)
-            raise HTTPException(status_code=404, detail="Cabina non trovata")
+        row = await get_cabina(chk)
+        if row:
+            return row
+        raise HTTPException(status_code=404, detail="Cabina non trovata")
     except Exception:
         for cab in FAKE_CABINE:
             if cab["chk"] == chk:
@@ -310,28 +330,112 @@ async def get_province(tipo: list[str] = None, area: str | None = None, regione:
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def _ai_not_ready():
+    # Il microservizio AI è in avvio (modello in caricamento / warmup): meglio un 503 subito che un timeout
+    return JSONResponse(
+        status_code=503,
+        headers={"Retry-After": "5"},
+        content={"detail": "Microservizio AI in avvio, riprovare tra poco."},
+    )
+
+def _ai_passthrough(response):
+    # Il JSON del motore AI arriva al client così com'è: in modalità http senza parse e
+    # ri-serializzazione, in modalità embedded serializzato una sola volta
+    return Response(content=response.content, media_type="application/json")
+
 @app.post("/segmenta")
 async def segmenta_cabina(req: AIRequest):
     try:
         async with ai_semaphore:  # back-pressure
-            response = await ai_client.post(
-                "http://localhost:9000/segmenta_ai",
-                json={
-                    "image": req.image,
-                    "lat": req.lat,
-                    "lng": req.lng,
-                    "crop_width": getattr(req, "crop_width", None),
-                    "crop_height": getattr(req, "crop_height", None),
-                    "zoom": getattr(req, "zoom", None),
-                }
-            )
+            response = await ai.segmenta(req.image, req.model_dump(exclude={"image"}))
+            if response.status_code == 503:
+                return _ai_not_ready()
             response.raise_for_status()
-            return response.json()
+            return _ai_passthrough(response)
     except httpx.ReadTimeout:
         return JSONResponse(status_code=504, content={"detail": "Timeout: l'analisi AI è troppo lenta."})
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": f"Errore AI: {str(e)}"})
 
+# Metadati inoltrati al motore AI: solo i campi di AIRequest, l'immagine viaggia nel corpo
+BIN_META_FIELDS = tuple(k for k in AIRequest.model_fields if k != "image")
+
+def _bin_meta(items) -> dict:
+    """Metadati di /segmenta_bin dai campi noti; ValueError per valori non testuali."""
+    meta = {}
+    for k, v in items:
+        if not isinstance(v, str):
+            raise ValueError(f"Il campo '{k}' deve essere testo")
+        if k in BIN_META_FIELDS:
+            meta[k] = v
+    return meta
+
+@app.post("/segmenta_bin")
+async def segmenta_cabina_bin(request: Request):
+    """
+    Come /segmenta ma con l'immagine in binario: corpo grezzo (Content-Type image/jpeg|png)
+    con i metadati in query string, oppure multipart con campo 'image' e metadati come campi.
+    I byte vengono passati al motore AI (vedi ai_client.py) senza decodifica né ricodifica.
+    """
+    try:
+        ctype = request.headers.get("content-type", "")
+        if ctype.startswith("multipart/form-data"):
+            form = await request.form()
+            upload = form.get("image")
+            if upload is None or isinstance(upload, str):
+                return JSONResponse(status_code=400, content={"detail": "Campo multipart 'image' mancante"})
+            data = await upload.read()
+            img_type = upload.content_type or "application/octet-stream"
+            items = [(k, v) for k, v in form.multi_items() if k != "image"]
+        else:
+            data = await request.body()
+            img_type = ctype or "application/octet-stream"
+            items = request.query_params.multi_items()
+        try:
+            meta = _bin_meta(items)
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"detail": str(e)})
+        if not data:
+            return JSONResponse(status_code=400, content={"detail": "Immagine mancante"})
+
+        async with ai_semaphore:  # back-pressure
+            response = await ai.segmenta_bin(data, meta, img_type)
+            if response.status_code == 503:
+                return _ai_not_ready()
+            response.raise_for_status()
+            return _ai_passthrough(response)
+    except httpx.ReadTimeout:
+        return JSONResponse(status_code=504, content={"detail": "Timeout: l'analisi AI è troppo lenta."})
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": f"Errore AI: {str(e)}"})
+
+@app.on_event("startup")
+async def _start_ai():
+    # In modalità embedded carica il motore nel processo (in background), in http non fa nulla
+    await ai.start()
+
+@app.on_event("startup")
+async def _start_queue_workers():
+    # Tabelle della coda persistente (idempotente) e worker di questo processo. Senza
+    # schema (DB assente, dati di fallback) i worker non partono: interrogherebbero a ogni
+    # polling tabelle che non esistono
+    try:
+        await batch_queue.ensure_schema()
+    except Exception as e:
+        print(f"[CODA] schema non verificato, worker della coda non avviati in questo processo: {e}")
+        return
+    batch_queue.pool.start()
+
+@app.on_event("startup")
+async def _start_cabine_clusters():
+    # Indice dei cluster per la mappa: costruito in background e ricostruito se public.cabine cambia
+    cabine_clusters.start()
+
 @app.on_event("shutdown")
 async def _close_clients():
-    await ai_client.aclose()
+    await batch_queue.pool.stop()
+    await cabine_clusters.stop()
+    await batch_manager.shutdown()
+    await centered_writer.stop()  # dopo i job: le ultime coordinate armonizzate vanno scritte
+    await ai.aclose()
+    await close_tile_provider()
@@ -0,0 +1,133 @@
+# backend/mercator.py
+#
+# Proiezione Web Mercator condivisa da backend, microservizio AI e script segformer
+# (stessa convenzione di frontend/src/utils/geo.js e delle tile XYZ a 256 px):
+#
+#   lat/lng  <->  pixel globali allo zoom (anche frazionario)
+#   pixel globali  <->  pixel della crop (centro, dimensioni, bearing, scala immagine)
+#   pixel globali  ->  tile XYZ + offset nella tile
+#
+# Tutte le funzioni accettano scalari o array NumPy e lavorano in un'unica operazione
+# vettoriale: interi poligoni o decine di migliaia di cabine costano microsecondi a punto.
+# Con scalari restituiscono float NumPy, usabili come i float Python.
+#
+# Proprietà e accordo con i punti che la usano: backend/tests/test_mercator.py
+
+import numpy as np
+
+TILE_SIZE = 256
+EARTH_CIRCUMFERENCE_M = 40075016.68557849  # 2 * pi * 6378137
+
+
+def world_size(zoom):
+    return TILE_SIZE * np.exp2(zoom)
+
+
+def latlng_to_global_px(lat, lng, zoom):
+    world = world_size(zoom)
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    x = (lng + 180.0) / 360.0 * world
+    sin_lat = np.sin(np.radians(lat))
+    y = (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)) * world
+    return x, y
+
+
+def global_px_to_latlng(x, y, zoom):
+    world = world_size(zoom)
+    lng = np.asarray(x, dtype=np.float64) / world * 360.0 - 180.0
+    n = np.pi - 2.0 * np.pi * np.asarray(y, dtype=np.float64) / world
+    lat = np.degrees(np.arctan(np.sinh(n)))
+    return lat, lng
+
+
+def rotate_about(x, y, angle_deg, cx=0.0, cy=0.0):
+    """Rotazione di angle_deg (senso orario a schermo, y verso il basso) attorno a (cx, cy)."""
+    dx = np.asarray(x, dtype=np.float64) - cx
+    dy = np.asarray(y, dtype=np.float64) - cy
+    if angle_deg is not None and np.any(angle_deg):
+        rad = np.radians(angle_deg)
+        c, s = np.cos(rad), np.sin(rad)
+        dx, dy = dx * c - dy * s, dx * s + dy * c
+    return cx + dx, cy + dy
+
+
+def crop_px_to_latlng(px, py, center_lat, center_lng, zoom, crop_width, crop_height=None,
+                      bearing=0.0, scale=1.0):
+    """
+    Pixel della crop -> (lat, lng). `scale` = pixel mappa per pixel immagine (crop_width /
+    larghezza immagine); con `bearing` la crop è ruotata e i punti vengono prima deruotati
+    attorno al centro (come rotateAroundCenter(p, -bearing) del frontend).
+    """
+    crop_height = crop_width if crop_height is None else crop_height
+    dx = np.asarray(px, dtype=np.float64) * scale - crop_width / 2
+    dy = np.asarray(py, dtype=np.float64) * scale - crop_height / 2
+    dx, dy = rotate_about(dx, dy, None if bearing is None else -np.asarray(bearing))
+    cx, cy = latlng_to_global_px(center_lat, center_lng, zoom)
+    return global_px_to_latlng(cx + dx, cy + dy, zoom)
+
+
+def latlng_to_crop_px(lat, lng, center_lat, center_lng, zoom, crop_width, crop_height=None,
+                      bearing=0.0, scale=1.0):
+    """Inverso di crop_px_to_latlng: (lat, lng) -> pixel della crop centrata su center_lat/lng."""
+    crop_height = crop_width if crop_height is None else crop_height
+    cx, cy = latlng_to_global_px(center_lat, center_lng, zoom)
+    x, y = latlng_to_global_px(lat, lng, zoom)
+    dx, dy = rotate_about(x - cx, y - cy, bearing)
+    return (dx + crop_width / 2) / scale, (dy + crop_height / 2) / scale
+
+
+def global_px_to_tile(x, y, tile_size=TILE_SIZE):
+    """Pixel globali -> (tile x, tile y, offset x, offset y) interi, troncando al pixel."""
+    ix = np.floor(np.asarray(x, dtype=np.float64)).astype(np.int64)
+    iy = np.floor(np.asarray(y, dtype=np.float64)).astype(np.int64)
+    return ix // tile_size, iy // tile_size, ix % tile_size, iy % tile_size
+
+
+def latlng_to_tile(lat, lng, zoom, tile_size=TILE_SIZE):
+    """(lat, lng) -> tile XYZ che li contiene allo zoom intero dato e offset nella tile."""
+    x, y = latlng_to_global_px(lat, lng, zoom)
+    if tile_size != TILE_SIZE:
+        x, y = x * tile_size / TILE_SIZE, y * tile_size / TILE_SIZE
+    return global_px_to_tile(x, y, tile_size)
+
+
+def meters_per_pixel(zoom, lat):
+    """Metri a terra per pixel mappa alla latitudine data."""
+    return EARTH_CIRCUMFERENCE_M * np.cos(np.radians(np.asarray(lat, dtype=np.float64))) / world_size(zoom)
+
+
+# ---------- Ordinamento spaziale ----------
+
+HILBERT_ORDER = 16  # griglia 2^16 x 2^16 sul mondo: celle di ~600 m all'equatore, ~450 m in Italia
+
+
+def hilbert_index(x, y, order=HILBERT_ORDER):
+    """
+    Indice sulla curva di Hilbert di celle intere (x, y) in [0, 2^order): celle consecutive
+    sulla curva sono sempre adiacenti, quindi ordinare per indice visita lo spazio a zone.
+    """
+    x = np.asarray(x, dtype=np.int64).copy()
+    y = np.asarray(y, dtype=np.int64).copy()
+    d = np.zeros(np.broadcast(x, y).shape, dtype=np.int64)
+    n = 1 << order
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotazione del quadrante perché la curva resti continua
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        swap = ~ry
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s >>= 1
+    return d
+
+
+def hilbert_key(lat, lng, order=HILBERT_ORDER):
+    """Indice di Hilbert di (lat, lng) sulla griglia Web Mercator 2^order x 2^order."""
+    x, y = latlng_to_global_px(lat, lng, order - np.log2(TILE_SIZE))
+    n = (1 << order) - 1
+    return hilbert_index(np.clip(np.floor(x), 0, n), np.clip(np.floor(y), 0, n), order)
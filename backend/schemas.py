@@ -21,6 +21,10 @@ class AIRequest(BaseModel):
     crop_width: Optional[int] = None
     crop_height: Optional[int] = None
     zoom: Optional[float] = None
+    bearing: Optional[float] = None
+    format: Optional[str] = None  # json | delta | varint | rle | png | geo (vedi ai_microservice/encodings.py)
+    tta: Optional[str] = None  # flip | rot | d4 (vedi ai_microservice/tta.py)
+    session: Optional[str] = None  # crop successive della stessa zona (vedi ai_microservice/incremental.py)
 
 
 class AIResponse(BaseModel):
@@ -0,0 +1,17 @@
+# backend/tests/conftest.py
+#
+# I moduli del backend si importano come dalla cartella backend (from mercator import ...)
+
+import os
+import sys
+import numpy as np
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
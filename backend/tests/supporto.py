@@ -0,0 +1,43 @@
+# backend/tests/supporto.py
+#
+# Dati e provider finti condivisi dai test: punti casuali sull'Italia, formula di
+# riferimento della proiezione e tile che codificano nei pixel la propria posizione.
+
+import math
+import numpy as np
+from mercator import TILE_SIZE
+
+N = 2000
+
+
+def punti_italia(rng, n=N):
+    return rng.uniform(36.0, 47.5, n), rng.uniform(6.0, 19.0, n)
+
+
+def ref_global_px(lat, lng, zoom):
+    """Formula scalare indipendente (tile XYZ a 256 px)."""
+    n = 2.0 ** zoom * TILE_SIZE
+    return (lng + 180.0) / 360.0 * n, (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n
+
+
+class TileFinte:
+    """Provider di tile in cui ogni pixel vale (offset x, offset y, firma della tile)."""
+
+    def __init__(self, max_zoom=20):
+        self.max_zoom = max_zoom
+        ramp = np.arange(TILE_SIZE, dtype=np.uint8)
+        self._base = np.empty((TILE_SIZE, TILE_SIZE, 3), dtype=np.uint8)
+        self._base[..., 0] = ramp[None, :]
+        self._base[..., 1] = ramp[:, None]
+
+    @staticmethod
+    def firma(x, y):
+        return (x * 7 + y * 13) % 256
+
+    def tile(self, x, y):
+        t = self._base.copy()
+        t[..., 2] = self.firma(x, y)
+        return t
+
+    async def get_tile(self, z, x, y):
+        return self.tile(x, y)
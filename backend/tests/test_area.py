@@ -0,0 +1,65 @@
+# backend/tests/test_area.py
+#
+# Armonizzazione per area: un mosaico per gruppo di cabine, AI e scrittura finte; ogni
+# cabina riceve la posizione dello Stalli AT proiettato nel mosaico.
+
+import asyncio
+import numpy as np
+from mercator import latlng_to_crop_px
+from supporto import TileFinte, punti_italia
+
+
+def test_area_mosaico_assegna_il_punto_proiettato(rng, monkeypatch):
+    from armonizzazione_batch import area
+
+    class Risposta:
+        status_code = 200
+
+        def __init__(self, body):
+            self.body = body
+
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return self.body
+
+    class AIFinta:
+        """Un quadrato Stalli AT attorno alla posizione armonizzata attesa di ogni cabina."""
+
+        def __init__(self, attese):
+            self.attese = attese
+            self.lati = []
+
+        async def status(self):
+            return Risposta({"tiling": {"min_side": 768}})
+
+        async def segmenta_bin(self, jpeg, meta, content_type):
+            self.lati.append(max(meta["crop_width"], meta["crop_height"]))
+            px, py = latlng_to_crop_px(self.attese[:, 0], self.attese[:, 1], meta["lat"], meta["lng"],
+                                       meta["zoom"], meta["crop_width"], meta["crop_height"])
+            poligoni = [{"label": "Stalli AT", "points": [[x - 15, y - 15], [x + 15, y - 15], [x + 15, y + 15], [x - 15, y + 15]]}
+                        for x, y in zip(px, py)]
+            return Risposta({"poligoni": poligoni})
+
+    async def salva(chk, lat, lng, wait=True):
+        pass
+
+    zoom, crop = 18.0, 300
+    lat0, lng0 = (float(v[0]) for v in punti_italia(rng, 1))
+    gruppo = [{"chk": f"C{i}", "lat": lat0 + d[0], "lng": lng0 + d[1]} for i, d in enumerate(rng.normal(0, 2e-3, (6, 2)))]
+    # Spostamento di qualche metro, entro la mezza crop
+    attese = np.array([[c["lat"] + 1e-4 * s, c["lng"] - 1e-4 * s] for c, s in zip(gruppo, rng.uniform(-1, 1, 6))])
+    ai = AIFinta(attese)
+    monkeypatch.setattr(area, "ai", ai)
+    monkeypatch.setattr(area, "_tiling", None)
+    monkeypatch.setattr(area, "salva_geom_centered", salva)
+    monkeypatch.setattr(area, "get_tile_provider", lambda: TileFinte())
+
+    results = asyncio.run(area.armonizza_area(gruppo, zoom, crop))
+    # Mosaico più grande di una crop: allargato oltre la soglia della finestra scorrevole del motore
+    assert len(ai.lati) == 1 and ai.lati[0] > 768
+    for c, (la, ln) in zip(gruppo, attese):
+        r = results[c["chk"]]
+        assert r["status"] == "done"
+        assert abs(r["new_lat"] - la) < 1e-9 and abs(r["new_lng"] - ln) < 1e-9
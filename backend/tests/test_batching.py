@@ -0,0 +1,136 @@
+# backend/tests/test_batching.py
+#
+# MicroBatcher del motore AI: raggruppamento delle richieste concorrenti, limite di
+# batch e di batch in volo, errori e arresto. run_batch finte, niente modello.
+
+import asyncio
+from ai_microservice.batching import MicroBatcher
+
+
+class BatchFinti:
+    """run_batch che registra i batch ricevuti; con `gate` resta in attesa finché non si apre."""
+
+    def __init__(self, gate=None):
+        self.batches = []
+        self.gate = gate
+        self.in_volo = 0
+        self.max_in_volo = 0
+
+    async def __call__(self, items):
+        self.batches.append(list(items))
+        self.in_volo += 1
+        self.max_in_volo = max(self.max_in_volo, self.in_volo)
+        try:
+            if self.gate is not None:
+                await self.gate.wait()
+            return [x * 10 for x in items]
+        finally:
+            self.in_volo -= 1
+
+
+def test_richieste_concorrenti_in_un_batch_con_risultati_in_ordine():
+    async def main():
+        run = BatchFinti()
+        mb = MicroBatcher(run, max_batch_size=8, window_ms=50)
+        out = await asyncio.gather(*[mb.submit(i) for i in range(5)])
+        await mb.stop()
+        return run, out, mb.stats()
+
+    run, out, stats = asyncio.run(main())
+    assert out == [0, 10, 20, 30, 40]
+    assert run.batches == [[0, 1, 2, 3, 4]]
+    assert stats["requests"] == 5 and stats["batches"] == 1 and stats["batch_size_hist"] == {"5": 1}
+
+
+def test_max_batch_size_divide_la_coda():
+    async def main():
+        run = BatchFinti()
+        mb = MicroBatcher(run, max_batch_size=4, window_ms=50)
+        out = await asyncio.gather(*[mb.submit(i) for i in range(10)])
+        await mb.stop()
+        return run, out
+
+    run, out = asyncio.run(main())
+    assert out == [i * 10 for i in range(10)]
+    assert [len(b) for b in run.batches] == [4, 4, 2]
+
+
+def test_errore_di_un_batch_arriva_a_tutte_le_sue_richieste():
+    async def main():
+        chiamate = []
+
+        async def run(items):
+            chiamate.append(list(items))
+            if len(chiamate) == 1:
+                raise ValueError("forward fallito")
+            return items
+
+        mb = MicroBatcher(run, max_batch_size=8, window_ms=20)
+        primo = await asyncio.gather(*[mb.submit(i) for i in range(3)], return_exceptions=True)
+        secondo = await mb.submit(7)
+        await mb.stop()
+        return primo, secondo
+
+    primo, secondo = asyncio.run(main())
+    assert all(isinstance(e, ValueError) for e in primo)
+    # Il batcher resta in servizio dopo l'errore
+    assert secondo == 7
+
+
+def test_max_inflight_e_batch_piu_grandi_con_i_worker_occupati():
+    async def main():
+        gate = asyncio.Event()
+        run = BatchFinti(gate)
+        mb = MicroBatcher(run, max_batch_size=16, window_ms=0, max_inflight=2)
+        tasks = [asyncio.create_task(mb.submit(0))]
+        await asyncio.sleep(0.01)
+        tasks.append(asyncio.create_task(mb.submit(1)))
+        await asyncio.sleep(0.01)
+        # Due batch in volo: le richieste successive aspettano in coda e partono insieme
+        tasks += [asyncio.create_task(mb.submit(i)) for i in range(2, 8)]
+        await asyncio.sleep(0.01)
+        assert len(run.batches) == 2 and mb.stats()["queued"] == 6
+        gate.set()
+        out = await asyncio.gather(*tasks)
+        await mb.stop()
+        return run, out
+
+    run, out = asyncio.run(main())
+    assert out == [i * 10 for i in range(8)]
+    assert run.max_in_volo == 2
+    assert [len(b) for b in run.batches] == [1, 1, 6]
+
+
+def test_richieste_annullate_non_entrano_nel_batch():
+    async def main():
+        gate = asyncio.Event()
+        run = BatchFinti(gate)
+        mb = MicroBatcher(run, max_batch_size=8, window_ms=0, max_inflight=1)
+        primo = asyncio.create_task(mb.submit(0))
+        await asyncio.sleep(0.01)
+        annullata = asyncio.create_task(mb.submit(1))
+        tenuta = asyncio.create_task(mb.submit(2))
+        await asyncio.sleep(0.01)
+        annullata.cancel()
+        gate.set()
+        out = await asyncio.gather(primo, tenuta)
+        await mb.stop()
+        return run, out
+
+    run, out = asyncio.run(main())
+    assert out == [0, 20]
+    assert run.batches == [[0], [2]]
+
+
+def test_stop_sblocca_chi_e_in_coda_o_in_volo():
+    async def main():
+        run = BatchFinti(asyncio.Event())  # non si apre mai
+        mb = MicroBatcher(run, max_batch_size=1, window_ms=0, max_inflight=1)
+        tasks = [asyncio.create_task(mb.submit(i)) for i in range(3)]
+        await asyncio.sleep(0.01)
+        await mb.stop()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    out = asyncio.run(main())
+    assert len(out) == 3
+    assert all(isinstance(e, RuntimeError) and "arresto" in str(e) for e in out)
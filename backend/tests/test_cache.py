@@ -0,0 +1,85 @@
+# backend/tests/test_cache.py
+#
+# ResultCache del motore AI: chiave per contenuto, LRU con limite di voci e di byte,
+# persistenza su disco e statistiche.
+
+import json
+import os
+from PIL import Image
+from ai_microservice.cache import ResultCache
+
+
+def dim(value):
+    return len(json.dumps(value, separators=(",", ":")))
+
+
+def test_chiave_dipende_da_pixel_modello_e_parametri():
+    img = Image.new("RGB", (8, 8), (10, 20, 30))
+    key = ResultCache.make_key(img, "v1", {"a": 1, "b": 2})
+    assert key == ResultCache.make_key(img.copy(), "v1", {"b": 2, "a": 1})
+    assert key != ResultCache.make_key(img, "v2", {"a": 1, "b": 2})
+    assert key != ResultCache.make_key(img, "v1", {"a": 1, "b": 3})
+    altra = img.copy()
+    altra.putpixel((3, 3), (10, 20, 31))
+    assert key != ResultCache.make_key(altra, "v1", {"a": 1, "b": 2})
+    # Stessi byte, forma diversa
+    assert ResultCache.make_key(Image.new("RGB", (4, 16)), "v1", {}) != ResultCache.make_key(Image.new("RGB", (16, 4)), "v1", {})
+
+
+def test_lru_per_numero_di_voci():
+    cache = ResultCache(max_entries=2)
+    cache.put("a", {"n": 1})
+    cache.put("b", {"n": 2})
+    assert cache.get("a") == {"n": 1}  # "a" diventa la più recente
+    cache.put("c", {"n": 3})
+    assert cache.get("b") is None
+    assert cache.get("a") == {"n": 1} and cache.get("c") == {"n": 3}
+    s = cache.stats()
+    assert s["entries"] == 2 and s["evictions"] == 1
+    assert s["hits"] == 3 and s["misses"] == 1 and s["hit_rate"] == 0.75
+
+
+def test_lru_per_byte_e_voci_troppo_grandi():
+    valore = {"p": "x" * 90}
+    cache = ResultCache(max_entries=100, max_bytes=3 * dim(valore))
+    for k in "abcd":
+        cache.put(k, valore)
+    assert cache.get("a") is None and cache.get("d") == valore
+    assert cache.stats()["bytes"] == 3 * dim(valore)
+    # Una voce oltre il limite di byte non entra e non svuota la cache
+    cache.put("enorme", {"p": "x" * 1000})
+    assert cache.get("enorme") is None and cache.stats()["entries"] == 3
+    # Riscrivere una chiave non conta due volte i suoi byte
+    cache.put("d", valore)
+    assert cache.stats()["bytes"] == 3 * dim(valore)
+
+
+def test_disabilitata_con_zero_voci():
+    cache = ResultCache(max_entries=0)
+    assert not cache.enabled
+    cache.put("a", {"n": 1})
+    assert cache.get("a") is None and cache.stats()["entries"] == 0
+
+
+def test_persistenza_su_disco(tmp_path):
+    cache = ResultCache(max_entries=4, persist_dir=str(tmp_path))
+    cache.persist("k", {"poligoni": [1, 2]})
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
+
+    # Dopo un riavvio: miss in memoria, poi il disco; il lookup conta come hit
+    nuova = ResultCache(max_entries=4, persist_dir=str(tmp_path))
+    assert nuova.get("k") is None
+    assert nuova.load("k") == {"poligoni": [1, 2]}
+    assert nuova.get("k") == {"poligoni": [1, 2]}
+    s = nuova.stats()
+    assert s["hits"] == 2 and s["disk_hits"] == 1 and s["misses"] == 0
+    assert nuova.load("assente") is None
+
+
+def test_pulizia_del_disco_tiene_le_voci_piu_recenti(tmp_path):
+    for i in range(5):
+        path = tmp_path / f"k{i}.json"
+        path.write_text("{}")
+        os.utime(path, (1000 + i, 1000 + i))
+    ResultCache(persist_dir=str(tmp_path), max_disk_entries=3)
+    assert sorted(os.listdir(tmp_path)) == ["k2.json", "k3.json", "k4.json"]
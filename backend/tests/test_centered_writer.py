@@ -0,0 +1,136 @@
+# backend/tests/test_centered_writer.py
+#
+# CenteredWriter (scrittura raggruppata di geom_centered): commit di gruppo, soglie di
+# righe e di tempo, fallimenti e spegnimento. Sessione finta che registra le scritture.
+
+import asyncio
+import pytest
+from armonizzazione_single_cabin import centered_writer
+
+
+class DBFinto:
+    def __init__(self):
+        self.scritture = []  # una lista di (chk, lat, lng) per transazione
+        self.guasti = 0      # prossime transazioni che falliscono
+
+    def session(self):
+        db = self
+
+        class Sessione:
+            async def __aenter__(self):
+                self.righe = []
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            async def execute(self, stmt, params):
+                await asyncio.sleep(0.001)
+                if db.guasti:
+                    db.guasti -= 1
+                    raise RuntimeError("DB non raggiungibile")
+                self.righe += list(zip(params["chk"], params["lat"], params["lng"]))
+
+            async def commit(self):
+                db.scritture.append(self.righe)
+
+        return Sessione()
+
+
+@pytest.fixture
+def db(monkeypatch):
+    finto = DBFinto()
+    monkeypatch.setattr(centered_writer, "SessionLocal", finto.session)
+    return finto
+
+
+def test_attese_concorrenti_in_un_solo_commit(db):
+    async def main():
+        w = centered_writer.CenteredWriter(max_rows=100, interval_ms=1000, linger_ms=20)
+
+        async def dopo(ms, chk):
+            await asyncio.sleep(ms / 1000)
+            await w.put(chk, 41.0, 12.0)
+
+        # Le righe arrivate entro il linger vanno nella transazione della prima
+        await asyncio.gather(*[dopo(ms, f"A{ms}") for ms in (0, 2, 5, 10)])
+        await w.stop()
+
+    asyncio.run(main())
+    assert [sorted(c for c, _, _ in t) for t in db.scritture] == [["A0", "A10", "A2", "A5"]]
+
+
+def test_senza_attesa_si_scrive_alla_soglia_di_righe_o_di_tempo(db):
+    async def main():
+        w = centered_writer.CenteredWriter(max_rows=4, interval_ms=50, linger_ms=0)
+        for i in range(4):
+            await w.put(f"N{i}", 41.0, 12.0, wait=False)
+        await asyncio.sleep(0.01)
+        dopo_soglia = [len(t) for t in db.scritture]
+        for i in range(4, 6):
+            await w.put(f"N{i}", 41.0, 12.0, wait=False)
+        await asyncio.sleep(0.01)
+        assert len(db.scritture) == 1  # sotto soglia: si aspetta l'intervallo
+        await asyncio.sleep(0.1)
+        dopo_intervallo = [len(t) for t in db.scritture]
+        await w.stop()
+        return dopo_soglia, dopo_intervallo
+
+    dopo_soglia, dopo_intervallo = asyncio.run(main())
+    assert dopo_soglia == [4]
+    assert dopo_intervallo == [4, 2]
+
+
+def test_stessa_cabina_vale_l_ultima_coordinata(db):
+    async def main():
+        w = centered_writer.CenteredWriter(max_rows=100, interval_ms=1000, linger_ms=0)
+        await w.put("C", 41.0, 12.0, wait=False)
+        await w.put("C", 41.5, 12.5, wait=False)
+        await w.put("D", 40.0, 11.0, wait=False)
+        await w.stop()
+
+    asyncio.run(main())
+    assert db.scritture == [[("C", 41.5, 12.5), ("D", 40.0, 11.0)]]
+
+
+def test_flush_fallito_errore_a_chi_aspetta_e_riprova_il_resto(db):
+    async def main():
+        w = centered_writer.CenteredWriter(max_rows=100, interval_ms=30, linger_ms=0)
+        db.guasti = 1
+        await w.put("X", 41.0, 12.0, wait=False)
+        with pytest.raises(RuntimeError, match="non raggiungibile"):
+            await w.put("W", 41.0, 12.0)
+        # X è tornato nel buffer; una coordinata più recente prende il suo posto
+        await w.put("X", 42.0, 13.0, wait=False)
+        await asyncio.sleep(0.15)
+        await w.stop()
+
+    asyncio.run(main())
+    # W è stato scartato (il chiamante ha avuto l'errore), X scritto una volta
+    assert db.scritture == [[("X", 42.0, 13.0)]]
+
+
+def test_spegnimento_svuota_il_buffer_e_poi_scrive_diretto(db):
+    async def main():
+        w = centered_writer.CenteredWriter(max_rows=100, interval_ms=10000, linger_ms=0)
+        for i in range(3):
+            await w.put(f"S{i}", 41.0, 12.0, wait=False)
+        await w.stop()
+        n = len(db.scritture)
+        await w.put("dopo", 41.0, 12.0, wait=False)
+        return n
+
+    assert asyncio.run(main()) == 1
+    assert [len(t) for t in db.scritture] == [3, 1]
+
+
+def test_spegnimento_con_db_giu_stampa_le_righe_perse(db, capsys):
+    async def main():
+        w = centered_writer.CenteredWriter(max_rows=100, interval_ms=10, linger_ms=0)
+        await w.put("P", 41.25, 12.5, wait=False)
+        db.guasti = 100
+        await w.stop()
+
+    asyncio.run(main())
+    assert db.scritture == []
+    assert "NON SALVATA: chk=P lat=41.25 lng=12.5" in capsys.readouterr().out
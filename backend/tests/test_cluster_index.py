@@ -0,0 +1,111 @@
+# backend/tests/test_cluster_index.py
+#
+# ClusterIndex di cabine_clusters.py: i cluster di ogni zoom si confrontano con un
+# raggruppamento di riferimento calcolato direttamente allo zoom (celle di radius_px
+# pixel globali), poi annidamento, expansion_zoom e query per bbox.
+
+import numpy as np
+import pytest
+from mercator import latlng_to_global_px
+from cabine_clusters import ClusterIndex, filtra_righe, parse_bbox
+
+RADIUS, MAX_ZOOM = 60, 14
+
+
+def cabine(rng, n=3000):
+    # Grappoli fitti (nello stesso edificio) e cabine sparse
+    centri = np.c_[rng.uniform(38.0, 46.0, 40), rng.uniform(7.0, 18.0, 40)]
+    rows = []
+    for i in range(n):
+        if i % 3:
+            lat, lng = centri[i % 40] + rng.normal(0, 0.02, 2)
+        else:
+            lat, lng = rng.uniform(36.0, 47.5), rng.uniform(6.0, 19.0)
+        rows.append({"id": i, "chk": f"C{i}", "lat": float(lat), "lng": float(lng),
+                     "tipo_cabina": "e-distribuzione" if i % 2 else "privata",
+                     "area_regionale": "Sud" if lat < 42 else "Nord", "regione": None,
+                     "provincia": "NA" if i % 5 == 0 else "rm"})
+    return rows
+
+
+def gruppi_di_riferimento(rows, z):
+    """Cabina -> cella di RADIUS pixel globali allo zoom z."""
+    gx, gy = latlng_to_global_px(np.array([r["lat"] for r in rows]), np.array([r["lng"] for r in rows]), z)
+    return list(zip(np.floor(gx / RADIUS).astype(np.int64), np.floor(gy / RADIUS).astype(np.int64)))
+
+
+@pytest.fixture
+def indice(rng):
+    return ClusterIndex(cabine(rng), RADIUS, MAX_ZOOM)
+
+
+def test_cluster_come_il_raggruppamento_di_riferimento(indice):
+    for z in range(MAX_ZOOM + 1):
+        ref = gruppi_di_riferimento(indice.rows, z)
+        level = indice.levels[z]
+        cella = {ref[f]: i for i, f in enumerate(level["first"])}
+        assert len(cella) == len(level["count"])
+        counts = np.bincount([cella[k] for k in ref], minlength=len(cella))
+        assert np.array_equal(counts, level["count"])
+    assert indice.stats()["clusters_per_zoom"][0] <= indice.stats()["clusters_per_zoom"][-1]
+
+
+def test_annidamento_e_expansion_zoom(indice):
+    ref = [gruppi_di_riferimento(indice.rows, z) for z in range(MAX_ZOOM + 1)]
+    # I primi livelli: a zoom alti restano quasi solo cabine singole
+    for z in range(7):
+        level = indice.levels[z]
+        for i, first in enumerate(level["first"]):
+            membri = [k for k in range(len(indice.rows)) if ref[z][k] == ref[z][first]]
+            # Ogni cluster è l'unione dei suoi figli: le sue cabine stanno in un solo cluster
+            # a ogni zoom inferiore; expansion_zoom è il primo zoom a cui si divide
+            for zz in range(z):
+                assert len({ref[zz][k] for k in membri}) == 1
+            attesa = next((zz for zz in range(z + 1, MAX_ZOOM + 1) if len({ref[zz][k] for k in membri}) > 1),
+                          MAX_ZOOM + 1)
+            assert level["expansion"][i] == attesa
+
+
+def test_query_bbox_e_cabine_singole(indice):
+    out = indice.query(6.0, 36.0, 19.0, 47.5, 5.4)
+    assert out["zoom"] == 5
+    assert sum(d.get("count", 1) for d in out["data"]) == len(indice.rows)
+    for d in out["data"]:
+        if d.get("cluster"):
+            assert d["count"] > 1 and d["expansion_zoom"] > 5 and "cluster_id" not in d
+        else:
+            assert "chk" in d  # stessi campi di GET /cabine
+
+    # Oltre max_zoom solo cabine singole, quelle nel bbox
+    out = indice.query(12.0, 41.0, 13.0, 42.0, MAX_ZOOM + 2)
+    attese = {r["chk"] for r in indice.rows if 41.0 <= r["lat"] <= 42.0 and 12.0 <= r["lng"] <= 13.0}
+    assert {d["chk"] for d in out["data"]} == attese
+
+
+def test_query_include_i_cluster_appena_fuori_dalla_vista():
+    rows = [{"chk": f"C{i}", "lat": 41.9, "lng": 12.5 + i * 1e-4} for i in range(5)]
+    indice = ClusterIndex(rows, RADIUS, MAX_ZOOM)
+    # Centroide ~25 px a est del bordo a zoom 10 (un grado = ~728 px): entro il raggio
+    assert indice.query(12.0, 41.8, 12.466, 42.0, 10)["data"][0]["count"] == 5
+    # Oltre il raggio dal bordo: escluso
+    assert indice.query(12.0, 41.8, 12.3, 42.0, 10)["data"] == []
+
+
+def test_query_attraverso_l_antimeridiano():
+    rows = [{"chk": "est", "lat": 0.0, "lng": 179.5}, {"chk": "ovest", "lat": 0.0, "lng": -179.5},
+            {"chk": "lontana", "lat": 0.0, "lng": 0.0}]
+    indice = ClusterIndex(rows, RADIUS, 6)
+    out = indice.query(179.0, -1.0, -179.0, 1.0, 8)
+    assert {d["chk"] for d in out["data"]} == {"est", "ovest"}
+
+
+def test_parse_bbox_e_filtri(rng):
+    assert parse_bbox("12, 41,13,42") == (12.0, 41.0, 13.0, 42.0)
+    for valore in ("12,41,13", "12,42,13,41", "a,b,c,d", "12,41,inf,42"):
+        with pytest.raises(ValueError):
+            parse_bbox(valore)
+
+    rows = cabine(rng, 200)
+    scelte = filtra_righe(rows, tipo=["privata"], provincia="r")
+    assert scelte and all(r["tipo_cabina"] == "privata" and r["provincia"] == "rm" for r in scelte)
+    assert len(filtra_righe(rows)) == len(rows)
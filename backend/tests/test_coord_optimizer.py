@@ -0,0 +1,28 @@
+# backend/tests/test_coord_optimizer.py
+#
+# stima_centro di coord_optimizer: il centro di uno Stalli AT disegnato in una crop ruotata
+# torna alla posizione da cui è stato proiettato.
+
+import math
+import numpy as np
+import pytest
+from mercator import global_px_to_latlng, latlng_to_crop_px, latlng_to_global_px
+from supporto import punti_italia
+
+
+def test_coord_optimizer_stima_centro(rng):
+    from armonizzazione_single_cabin.coord_optimizer import stima_centro
+
+    for _ in range(50):
+        lat, lng = (float(v[0]) for v in punti_italia(rng, 1))
+        zoom, crop = float(rng.uniform(16.0, 20.0)), int(rng.integers(250, 600))
+        bearing = float(rng.uniform(-180.0, 180.0))
+        # Stalli AT centrato su un punto noto, disegnato nella crop ruotata
+        dx, dy = rng.uniform(-crop / 4, crop / 4, 2)
+        target = global_px_to_latlng(*(np.array(latlng_to_global_px(lat, lng, zoom)) + (dx, dy)), zoom)
+        px, py = latlng_to_crop_px(*target, lat, lng, zoom, crop, bearing=bearing)
+        r = 20.0
+        poly = [[px - r, py - r], [px + r, py - r], [px + r, py + r], [px - r, py + r]]
+        out = stima_centro([{"points": poly}], lat, lng, zoom, crop, bearing=bearing)
+        assert abs(out["lat"] - target[0]) < 1e-9 and abs(out["lng"] - target[1]) < 1e-9
+        assert out["dist"] == pytest.approx(math.hypot(dx, dy), abs=1e-6)
@@ -0,0 +1,123 @@
+# backend/tests/test_encodings.py
+#
+# Formati compatti della segmentazione (encodings.py): andata e ritorno di RLE, varint,
+# delta e PNG su maschere e poligoni casuali. I decoder RLE e delta sono qui, scritti
+# dalla descrizione del formato (rleFrString di pycocotools).
+
+import base64
+from io import BytesIO
+import numpy as np
+import pytest
+from PIL import Image
+from ai_microservice.common import CVAT_CLASSES
+from ai_microservice.encodings import (
+    decode_varint_polygons, encode_delta, encode_png, encode_rle, encode_varint, parse_formats,
+    rle_counts, rle_to_string,
+)
+
+LABELS = [c["label"] for c in CVAT_CLASSES if c["id"]]
+
+
+def rle_from_string(s: str) -> list:
+    counts, p = [], 0
+    while p < len(s):
+        x, k, more = 0, 0, True
+        while more:
+            c = ord(s[p]) - 48
+            x |= (c & 0x1F) << (5 * k)
+            more = bool(c & 0x20)
+            p += 1
+            k += 1
+            if not more and (c & 0x10):
+                x |= -1 << (5 * k)
+        if len(counts) > 2:
+            x += counts[-2]
+        counts.append(x)
+    return counts
+
+
+def rle_decode(counts, h, w) -> np.ndarray:
+    valori = np.arange(len(counts)) % 2
+    return np.repeat(valori, counts).astype(bool).reshape((h, w), order="F")
+
+
+def maschera_casuale(rng, h, w, classi=7):
+    # Blocchi di classi, come una segmentazione vera, più qualche pixel isolato
+    blocchi = rng.integers(0, classi, (h // 8 + 1, w // 8 + 1))
+    mask = np.kron(blocchi, np.ones((8, 8), dtype=np.int64))[:h, :w]
+    mask[rng.random((h, w)) < 0.01] = rng.integers(0, classi)
+    return mask.astype(np.uint8)
+
+
+def poligoni_casuali(rng, n):
+    out = []
+    for _ in range(n):
+        k = int(rng.integers(3, 40))
+        label = LABELS[int(rng.integers(len(LABELS)))]
+        pts = rng.integers(0, 5000, (k, 2))
+        out.append({"points": pts.tolist(), "label": label, "color": "#FFFFFF", "tipo": "x"})
+    return out
+
+
+def test_parse_formats():
+    assert parse_formats(None) == ["json"] and parse_formats("") == ["json"] and parse_formats(" , ") == ["json"]
+    assert parse_formats("RLE, varint,rle") == ["rle", "varint"]
+    with pytest.raises(ValueError, match="xml"):
+        parse_formats("json,xml")
+
+
+def test_rle_andata_e_ritorno(rng):
+    for h, w in [(1, 1), (3, 5), (64, 48), (129, 200)]:
+        mask = maschera_casuale(rng, h, w)
+        enc = encode_rle(mask)
+        assert enc["size"] == [h, w]
+        ricostruita = np.zeros((h, w), dtype=np.uint8)
+        for c in enc["classes"]:
+            m = rle_decode(rle_from_string(c["counts"]), h, w)
+            assert not (ricostruita[m] != 0).any()  # le classi non si sovrappongono
+            ricostruita[m] = c["id"]
+        assert np.array_equal(ricostruita, mask)
+        assert {c["id"] for c in enc["classes"]} == set(np.unique(mask).tolist()) - {0}
+
+
+def test_rle_counts_casi_limite():
+    assert rle_counts(np.zeros((0, 0))).size == 0
+    assert rle_counts(np.ones((2, 2))).tolist() == [0, 4]
+    assert rle_counts(np.zeros((2, 2))).tolist() == [4]
+    # Ordine per colonne: [[1, 0], [1, 1]] -> colonna 0 = 1,1; colonna 1 = 0,1
+    assert rle_counts(np.array([[1, 0], [1, 1]])).tolist() == [0, 2, 1, 1]
+    # Differenze negative e grandi valori nella compressione a 5 bit
+    counts = [0, 5, 3, 1000000, 2, 70000, 1]
+    assert rle_from_string(rle_to_string(counts)) == counts
+
+
+def test_rle_come_pycocotools(rng):
+    mask_utils = pytest.importorskip("pycocotools.mask")
+    mask = maschera_casuale(rng, 97, 61, classi=2).astype(bool)
+    ref = mask_utils.encode(np.asfortranarray(mask.astype(np.uint8)))
+    assert rle_to_string(rle_counts(mask)) == ref["counts"].decode("ascii")
+
+
+def test_varint_andata_e_ritorno(rng):
+    poligoni = poligoni_casuali(rng, 30)
+    # Coordinate negative e salti grandi (oltre i 7 bit di un byte)
+    poligoni.append({"points": [[-3, 2], [100000, -7], [0, 0]], "label": "Strada", "color": None, "tipo": "x"})
+    decoded = decode_varint_polygons(encode_varint(poligoni))
+    ids = {c["label"]: c["id"] for c in CVAT_CLASSES}
+    assert [(ids[p["label"]], p["points"]) for p in poligoni] == decoded
+    assert decode_varint_polygons(encode_varint([])) == []
+
+
+def test_delta_andata_e_ritorno(rng):
+    poligoni = poligoni_casuali(rng, 20)
+    for p, d in zip(poligoni, encode_delta(poligoni)):
+        assert np.cumsum(np.reshape(d["d"], (-1, 2)), axis=0).tolist() == p["points"]
+        assert (d["label"], d["color"], d["tipo"]) == (p["label"], p["color"], p["tipo"])
+
+
+def test_png_conserva_gli_id_di_classe(rng):
+    mask = maschera_casuale(rng, 50, 70)
+    url = encode_png(mask)
+    assert url.startswith("data:image/png;base64,")
+    im = Image.open(BytesIO(base64.b64decode(url.split(",", 1)[1])))
+    assert im.mode == "P" and np.array_equal(np.asarray(im), mask)
@@ -0,0 +1,22 @@
+# backend/tests/test_georef.py
+#
+# georeference del motore AI: i poligoni in pixel dell'immagine tornano in lat/lng con la
+# proiezione condivisa, anche con bearing e immagine riscalata.
+
+import numpy as np
+from mercator import latlng_to_crop_px
+from supporto import punti_italia
+
+
+def test_georef_poligoni_in_latlng(rng):
+    from ai_microservice.georef import georef_params, georeference
+
+    lat, lng = (float(v[0]) for v in punti_italia(rng, 1))
+    geo = georef_params(lat, lng, 18.3, bearing=37.0, crop_width=600, crop_height=400)
+    la, ln = lat + rng.normal(0, 3e-4, 20), lng + rng.normal(0, 3e-4, 20)
+    # Immagine a 512 px di larghezza: scala crop / immagine come nel motore
+    px, py = latlng_to_crop_px(la, ln, lat, lng, 18.3, 600, 400, bearing=37.0, scale=600 / 512)
+    out = georeference([{"points": np.stack([px, py], 1).tolist(), "label": "x", "color": None, "tipo": "x"}],
+                       (512, round(400 * 512 / 600)), geo)
+    pts = np.array(out[0]["points"])
+    assert np.max(np.abs(pts[:, 0] - la)) < 1e-9 and np.max(np.abs(pts[:, 1] - ln)) < 1e-9
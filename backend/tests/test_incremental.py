@@ -0,0 +1,112 @@
+# backend/tests/test_incremental.py
+#
+# Risegmentazione incrementale (ai_microservice/incremental.py) con un "modello" finto
+# invariante per traslazione (media 4x4 dei pixel, una cella di logits per blocco): la
+# griglia ricomposta da celle copiate e strisce ricalcolate deve essere quella del
+# forward completo sulla crop spostata. Più SessionCache e l'instradamento delle sessioni
+# sullo stesso worker del pool.
+
+import time
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+from ai_microservice import incremental
+from ai_microservice.executor import InferenceExecutor
+from ai_microservice.incremental import LOGIT_STRIDE, SessionCache, infer_incremental
+
+CELL = (float(LOGIT_STRIDE), float(LOGIT_STRIDE))  # un pixel della crop = un pixel globale
+
+
+class ModelloFinto:
+    def __init__(self):
+        self.finestre = []
+
+    def __call__(self, x):
+        self.finestre.append(tuple(x.shape[2:]))
+        return F.avg_pool2d(x, LOGIT_STRIDE)
+
+
+@pytest.fixture
+def mondo(rng):
+    return torch.from_numpy(rng.random((3, 1024, 1024), dtype=np.float32))
+
+
+def crop(mondo, x, y, size=512):
+    return mondo[:, y:y + size, x:x + size].unsqueeze(0)
+
+
+@pytest.mark.parametrize("dx,dy", [(8, 0), (0, -12), (-20, 16), (4, 4), (0, 0)])
+def test_griglia_incrementale_uguale_al_forward_completo(mondo, dx, dy):
+    modello = ModelloFinto()
+    x0, y0 = 400, 300
+    logits, fraction = infer_incremental(crop(mondo, x0, y0), modello, None, (x0, y0), CELL)
+    assert fraction == 1.0
+    prev = {"origin": (x0, y0), "logits": logits}
+
+    modello.finestre.clear()
+    nuovi, fraction = infer_incremental(crop(mondo, x0 + dx, y0 + dy), modello, prev, (x0 + dx, y0 + dy), CELL)
+    atteso = modello(crop(mondo, x0 + dx, y0 + dy))[0]
+    assert torch.allclose(nuovi, atteso, atol=1e-6)
+    # Nel modello passano solo le strisce scoperte (con il contesto), non tutta la crop
+    passati = sum(h * w for h, w in modello.finestre[:-1])
+    assert fraction == pytest.approx(passati / 512 ** 2)
+    assert fraction < incremental.INCR_MAX_FRACTION
+    if (dx, dy) == (0, 0):
+        assert passati == 0
+
+
+def test_spostamento_grande_rifa_il_forward_completo(mondo):
+    modello = ModelloFinto()
+    logits, _ = infer_incremental(crop(mondo, 0, 0), modello, None, (0, 0), CELL)
+    modello.finestre.clear()
+    _, fraction = infer_incremental(crop(mondo, 300, 260), modello, {"origin": (0, 0), "logits": logits},
+                                    (300, 260), CELL)
+    assert fraction == 1.0 and modello.finestre == [(512, 512)]
+
+
+def test_finestre_allineate_all_encoder(mondo):
+    modello = ModelloFinto()
+    logits, _ = infer_incremental(crop(mondo, 100, 100), modello, None, (100, 100), CELL)
+    modello.finestre.clear()
+    infer_incremental(crop(mondo, 112, 92), modello, {"origin": (100, 100), "logits": logits}, (112, 92), CELL)
+    assert modello.finestre and all(h % incremental.ALIGN == 0 and w % incremental.ALIGN == 0
+                                    for h, w in modello.finestre)
+
+
+def test_sessioni_chiave_scadenza_e_limite(monkeypatch):
+    cache = SessionCache(ttl_s=10, max_sessions=2)
+    voce = {"key": ("z18", 256), "origin": (0, 0), "logits": None}
+    cache.put("a", voce, 1.0)
+    assert cache.get("a", ("z18", 256))["origin"] == (0, 0)
+    # Altra chiave (zoom o dimensione diversi): la griglia non si riusa
+    assert cache.get("a", ("z19", 256)) is None
+
+    cache.put("b", voce, 0.25)
+    cache.put("c", voce, 0.25)
+    assert cache.get("a", voce["key"]) is None  # oltre max_sessions esce la meno recente
+    assert cache.get("c", voce["key"]) is not None
+
+    adesso = time.monotonic()
+    monkeypatch.setattr(incremental.time, "monotonic", lambda: adesso + 11)
+    assert cache.get("c", voce["key"]) is None
+    s = cache.stats()
+    assert (s["hits"], s["misses"]) == (2, 3)
+    assert s["mean_inferred_fraction"] == pytest.approx(1.5 / 5)
+
+
+def test_sessione_sempre_sullo_stesso_worker():
+    a = InferenceExecutor("process", workers=4)
+    b = InferenceExecutor("process", workers=4)
+    try:
+        sessioni = [f"cabina-{i}" for i in range(200)]
+        scelte = [a._pick(s) for s in sessioni]
+        # Stabile tra istanze (e quindi tra processi e riavvii) e distribuita su tutti i worker
+        assert scelte == [b._pick(s) for s in sessioni]
+        assert set(scelte) == {0, 1, 2, 3}
+        # Senza sessione: il worker con meno lavoro in corso
+        a._pending = [3, 1, 0, 2]
+        assert a._pick() == 2
+    finally:
+        a.shutdown()
+        b.shutdown()
@@ -0,0 +1,61 @@
+# backend/tests/test_mercator.py
+#
+# Proprietà della proiezione condivisa (mercator.py): formula, andata e ritorno tra
+# pixel globali, crop e lat/lng, tile e curva di Hilbert. Punti e zoom casuali (seed fisso).
+# I punti che la usano hanno i loro file (test_tile_source, test_coord_optimizer, ...).
+#
+#   cd backend && python -m pytest tests
+
+import numpy as np
+from mercator import (
+    crop_px_to_latlng, global_px_to_latlng, hilbert_index, latlng_to_crop_px, latlng_to_global_px,
+    latlng_to_tile,
+)
+from supporto import N, punti_italia, ref_global_px
+
+
+def test_global_px_formula_indipendente(rng):
+    lat, lng = punti_italia(rng)
+    zoom = rng.uniform(0.0, 22.0, N)
+    x, y = latlng_to_global_px(lat, lng, zoom)
+    ref = np.array([ref_global_px(a, b, z) for a, b, z in zip(lat, lng, zoom)])
+    assert np.allclose(x, ref[:, 0], rtol=0, atol=1e-6)
+    assert np.allclose(y, ref[:, 1], rtol=0, atol=1e-6)
+
+
+def test_andata_e_ritorno(rng):
+    lat, lng = rng.uniform(-85.0, 85.0, N), rng.uniform(-180.0, 180.0, N)
+    zoom = rng.uniform(0.0, 22.0, N)
+    la, ln = global_px_to_latlng(*latlng_to_global_px(lat, lng, zoom), zoom)
+    assert np.max(np.abs(la - lat)) < 1e-9 and np.max(np.abs(ln - lng)) < 1e-9
+
+    # Crop ruotata e riscalata, anche rettangolare
+    clat, clng = lat + rng.normal(0, 2e-4, N), lng + rng.normal(0, 2e-4, N)
+    zoom = rng.uniform(12.0, 21.0, N)
+    w, h = rng.integers(200, 900, N), rng.integers(200, 900, N)
+    bearing, scale = rng.uniform(-180.0, 180.0, N), rng.uniform(0.5, 2.0, N)
+    px, py = latlng_to_crop_px(lat, lng, clat, clng, zoom, w, h, bearing=bearing, scale=scale)
+    la, ln = crop_px_to_latlng(px, py, clat, clng, zoom, w, h, bearing=bearing, scale=scale)
+    assert np.max(np.abs(la - lat)) < 1e-9 and np.max(np.abs(ln - lng)) < 1e-9
+
+    # Il centro della crop è al centro dell'immagine qualunque sia il bearing
+    cx, cy = latlng_to_crop_px(clat, clng, clat, clng, zoom, w, h, bearing=bearing)
+    assert np.allclose(cx, w / 2) and np.allclose(cy, h / 2)
+
+
+def test_tile_e_offset(rng):
+    lat, lng = punti_italia(rng)
+    zoom = rng.integers(0, 21, N)
+    tx, ty, ox, oy = latlng_to_tile(lat, lng, zoom)
+    for i in range(N):
+        x, y = ref_global_px(lat[i], lng[i], int(zoom[i]))
+        assert (tx[i], ty[i], ox[i], oy[i]) == (int(x) // 256, int(y) // 256, int(x) % 256, int(y) % 256)
+
+
+def test_hilbert_permutazione_e_adiacenza():
+    g = np.arange(1 << 10)
+    hx, hy = g % 32, g // 32
+    h = hilbert_index(hx, hy, 5)
+    assert np.array_equal(np.sort(h), g)
+    by_d = np.argsort(h)
+    assert np.all(np.abs(np.diff(hx[by_d])) + np.abs(np.diff(hy[by_d])) == 1)
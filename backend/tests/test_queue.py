@@ -0,0 +1,218 @@
+# backend/tests/test_queue.py
+#
+# Coda persistente (armonizzazione_batch/queue.py) senza Postgres: le istruzioni della
+# coda girano su una tabella in memoria che riproduce il loro effetto, così si verificano
+# presa in carico, tentativi, rilascio allo spegnimento e lease scaduti dei worker.
+# La sintassi SQL si controlla con pglast, se installato.
+
+import asyncio
+import re
+import time
+import pytest
+from armonizzazione_batch import queue
+
+
+class Risultato:
+    def __init__(self, row=None, rowcount=0):
+        self._row = row
+        self.rowcount = rowcount
+
+    def fetchone(self):
+        return self._row
+
+
+class Riga:
+    def __init__(self, mapping):
+        self._mapping = mapping
+
+
+class CodaInMemoria:
+    """Righe di armonizzazione_queue e job, con l'effetto delle istruzioni di queue.py."""
+
+    def __init__(self, n, max_attempts=3):
+        self.job = {"id": 1, "status": "running", "zoom": 18.0, "crop_size": 500, "max_iter": 5,
+                    "max_attempts": max_attempts}
+        self.rows = {i: {"id": i, "job_id": 1, "chk": f"C{i}", "lat": 41.0, "lng": 12.0, "state": "pending",
+                         "attempts": 0, "error": None, "locked_by": None, "locked_at": None}
+                     for i in range(1, n + 1)}
+        self.handlers = {
+            queue.CLAIM_SQL: self.claim, queue.HEARTBEAT_SQL: self.heartbeat,
+            queue.COMPLETE_SQL: self.complete, queue.RELEASE_SQL: self.release,
+            queue.REQUEUE_STALE_SQL: self.requeue_stale,
+        }
+
+    def session(self):
+        coda = self
+
+        class Sessione:
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            async def execute(self, stmt, params=None):
+                await asyncio.sleep(0)
+                return coda.handlers[str(stmt)](**(params or {}))
+
+            async def commit(self):
+                pass
+
+        return Sessione()
+
+    def claim(self, worker):
+        if self.job["status"] != "running":
+            return Risultato()
+        for r in sorted(self.rows.values(), key=lambda r: r["id"]):
+            if r["state"] == "pending":
+                r.update(state="running", attempts=r["attempts"] + 1, error=None,
+                         locked_by=worker, locked_at=time.monotonic())
+                out = {k: r[k] for k in ("id", "job_id", "chk", "lat", "lng", "attempts")}
+                out.update({k: self.job[k] for k in ("zoom", "crop_size", "max_iter", "max_attempts")})
+                return Risultato(Riga(out), 1)
+        return Risultato()
+
+    def _owned(self, id, worker):
+        r = self.rows[id]
+        return r if r["locked_by"] == worker else None
+
+    def heartbeat(self, id, worker):
+        r = self._owned(id, worker)
+        if r is not None and r["state"] == "running":
+            r["locked_at"] = time.monotonic()
+        return Risultato(rowcount=int(r is not None))
+
+    def complete(self, id, worker, state, error, **out):
+        r = self._owned(id, worker)
+        if r is not None:
+            r.update(state=state, error=error, locked_by=None, locked_at=None, out=out)
+        return Risultato(rowcount=int(r is not None))
+
+    def release(self, id, worker):
+        r = self._owned(id, worker)
+        if r is not None and r["state"] == "running":
+            r.update(state="pending", attempts=max(r["attempts"] - 1, 0), error="interrotto",
+                     locked_by=None, locked_at=None)
+        return Risultato(rowcount=int(r is not None))
+
+    def requeue_stale(self, lease_s):
+        n = 0
+        for r in self.rows.values():
+            if r["state"] == "running" and r["locked_at"] < time.monotonic() - lease_s:
+                r.update(state="error" if r["attempts"] >= self.job["max_attempts"] else "pending",
+                         error=f"lease scaduto ({r['locked_by']})", locked_by=None, locked_at=None)
+                n += 1
+        return Risultato(rowcount=n)
+
+
+@pytest.fixture
+def coda(monkeypatch):
+    def crea(n, armonizza, max_attempts=3):
+        db = CodaInMemoria(n, max_attempts)
+        monkeypatch.setattr(queue, "SessionLocal", db.session)
+        monkeypatch.setattr(queue, "armonizza_cabina", armonizza)
+        return db
+    return crea
+
+
+def test_sql_della_coda_valido():
+    pglast = pytest.importorskip("pglast")
+    for sql in [*queue.SCHEMA_SQL, queue.CLAIM_SQL, queue.HEARTBEAT_SQL, queue.COMPLETE_SQL,
+                queue.RELEASE_SQL, queue.REQUEUE_STALE_SQL]:
+        # Parametri :nome di SQLAlchemy -> $1 di Postgres (non i cast ::tipo)
+        pglast.parse_sql(re.sub(r"(?<!:):(\w+)", "$1", sql))
+
+
+def test_worker_prendono_ogni_riga_una_volta(coda, monkeypatch):
+    chiamate = []
+
+    async def armonizza(chk, lat, lng, zoom, crop_size, max_iter, wait_commit=False):
+        chiamate.append((chk, wait_commit))
+        await asyncio.sleep(0.001)
+        return {"status": "done", "new_lat": lat + 1e-5, "new_lng": lng, "iterations": 2}
+
+    db = coda(12, armonizza)
+    monkeypatch.setattr(queue, "QUEUE_POLL_S", 0.01)
+
+    async def main():
+        pool = queue.QueueWorkerPool(workers=3, lease_s=60)
+        pool.start()
+        while any(r["state"] != "done" for r in db.rows.values()):
+            await asyncio.sleep(0.005)
+        await pool.stop()
+        return pool
+
+    pool = asyncio.run(main())
+    assert sorted(c for c, _ in chiamate) == sorted(f"C{i}" for i in range(1, 13))
+    # La riga diventa "done" solo a scrittura di geom_centered conclusa
+    assert all(wait for _, wait in chiamate)
+    assert pool.processed == 12
+    assert all(r["attempts"] == 1 and r["locked_by"] is None and r["out"]["iterations"] == 2
+               for r in db.rows.values())
+
+
+def test_errori_ripresi_fino_al_limite_di_tentativi(coda):
+    async def armonizza(*args, **kwargs):
+        raise RuntimeError("Motore AI in avvio")
+
+    db = coda(1, armonizza, max_attempts=3)
+    pool = queue.QueueWorkerPool(workers=1)
+
+    async def main():
+        stati = []
+        while (row := await pool._claim("w")) is not None:
+            await pool._process(row, "w")
+            stati.append((db.rows[1]["state"], db.rows[1]["attempts"]))
+        return stati
+
+    assert asyncio.run(main()) == [("pending", 1), ("pending", 2), ("error", 3)]
+    assert db.rows[1]["error"] == "Motore AI in avvio"
+
+
+def test_spegnimento_rimette_in_coda_e_restituisce_il_tentativo(coda):
+    partita = asyncio.Event()
+
+    async def armonizza(*args, **kwargs):
+        partita.set()
+        await asyncio.sleep(3600)
+
+    db = coda(1, armonizza)
+    pool = queue.QueueWorkerPool(workers=1)
+
+    async def main():
+        row = await pool._claim("w")
+        task = asyncio.create_task(pool._process(row, "w"))
+        await partita.wait()
+        assert db.rows[1]["state"] == "running" and db.rows[1]["attempts"] == 1
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(main())
+    r = db.rows[1]
+    assert (r["state"], r["attempts"], r["error"], r["locked_by"]) == ("pending", 0, "interrotto", None)
+    assert pool.processed == 0
+
+
+def test_lease_scaduto_torna_in_coda_o_in_errore(coda):
+    async def armonizza(*args, **kwargs):
+        return {"status": "done"}
+
+    db = coda(2, armonizza, max_attempts=2)
+    pool = queue.QueueWorkerPool(workers=1)
+
+    async def main():
+        # Processo morto con due righe prese: la seconda ha finito i tentativi
+        await pool._claim("morto")
+        await pool._claim("morto")
+        db.rows[2]["attempts"] = 2
+        for r in db.rows.values():
+            r["locked_at"] -= pool.lease_s + 1
+        reaper = asyncio.create_task(pool._reaper())
+        while db.rows[1]["state"] == "running":
+            await asyncio.sleep(0.001)
+        reaper.cancel()
+        await asyncio.gather(reaper, return_exceptions=True)
+
+    asyncio.run(main())
+    assert db.rows[1]["state"] == "pending" and db.rows[2]["state"] == "error"
+    assert db.rows[1]["error"] == "lease scaduto (morto)"
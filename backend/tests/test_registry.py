@@ -0,0 +1,109 @@
+# backend/tests/test_registry.py
+#
+# ModelRegistry del motore AI: caricamento, canary, promozione, rollback e ritiro delle
+# versioni. Loader finto che registra le chiamate, niente modello.
+
+import asyncio
+import random
+import pytest
+from ai_microservice.registry import ModelRegistry
+
+
+def spec(version):
+    return (version, f"/modelli/{version}", "torch")
+
+
+class LoaderFinto:
+    def __init__(self, fallite=()):
+        self.caricate = []
+        self.scaricate = []
+        self.fallite = set(fallite)
+
+    async def load(self, spec):
+        self.caricate.append(spec[0])
+        if spec[0] in self.fallite:
+            raise RuntimeError("pesi mancanti")
+        return {"model_load": 0.5, "warmup": 0.25}
+
+    async def unload(self, version):
+        self.scaricate.append(version)
+
+
+def test_canary_instrada_la_quota_alla_candidata(monkeypatch):
+    loader = LoaderFinto()
+    reg = ModelRegistry(loader.load, loader.unload)
+
+    async def main():
+        await reg.load(spec("v1"), role="active")
+        await reg.load(spec("v2"), canary_share=0.25)
+
+    asyncio.run(main())
+    assert (reg.active, reg.candidate, reg.canary_share) == ("v1", "v2", 0.25)
+    estrazioni = iter([0.1, 0.3, 0.9, 0.24, 0.25])
+    monkeypatch.setattr(random, "random", lambda: next(estrazioni))
+    assert [reg.pick()[0] for _ in range(5)] == ["v2", "v1", "v1", "v2", "v1"]
+    versions = reg.snapshot()["versions"]
+    assert versions["v1"]["requests"] == 3 and versions["v2"]["requests"] == 2
+    assert versions["v2"]["path"] == "/modelli/v2" and versions["v2"]["warmup_s"] == 0.25
+
+    # Quota a zero: tutto alla versione attiva; la quota resta in [0, 1]
+    reg.set_canary(0)
+    assert all(reg.pick()[0] == "v1" for _ in range(20))
+    assert reg.set_canary(7)["canary_share"] == 1.0
+
+
+def test_promozione_rollback_e_ritiro():
+    loader = LoaderFinto()
+    reg = ModelRegistry(loader.load, loader.unload)
+
+    async def main():
+        await reg.load(spec("v1"), role="active")
+        await reg.load(spec("v2"))
+        await reg.promote()
+        assert (reg.active, reg.candidate, reg.previous) == ("v2", None, "v1")
+        await reg.rollback()
+        assert (reg.active, reg.previous) == ("v1", "v2")
+        await reg.rollback()
+        assert (reg.active, reg.previous) == ("v2", "v1")
+        # Una terza versione attiva ritira la più vecchia, che non serve più al rollback
+        await reg.load(spec("v3"), role="active")
+        assert (reg.active, reg.previous) == ("v3", "v2")
+
+    asyncio.run(main())
+    assert loader.caricate == ["v1", "v2", "v3"]  # le versioni già pronte non si ricaricano
+    assert loader.scaricate == ["v1"]
+    assert reg.snapshot()["versions"]["v1"]["status"] == "retired"
+
+
+def test_caricamento_fallito_non_tocca_la_versione_attiva():
+    loader = LoaderFinto(fallite={"v2"})
+    reg = ModelRegistry(loader.load, loader.unload)
+
+    async def main():
+        await reg.load(spec("v1"), role="active")
+        with pytest.raises(RuntimeError):
+            await reg.load(spec("v2"), role="active")
+        with pytest.raises(ValueError):
+            await reg.promote("v2")
+
+    asyncio.run(main())
+    assert reg.active == "v1" and reg.candidate is None
+    info = reg.snapshot()["versions"]["v2"]
+    assert info["status"] == "failed" and "pesi mancanti" in info["error"]
+    assert reg.pick()[0] == "v1"
+
+
+def test_errori_di_uso():
+    reg = ModelRegistry(LoaderFinto().load)
+
+    async def main():
+        with pytest.raises(ValueError):
+            await reg.load(spec("v1"), role="previous")
+        with pytest.raises(ValueError):
+            await reg.promote()
+        with pytest.raises(ValueError):
+            await reg.rollback()
+
+    asyncio.run(main())
+    with pytest.raises(KeyError):
+        reg.spec("v9")
@@ -0,0 +1,48 @@
+# backend/tests/test_segformer_scripts.py
+#
+# Script di dataset in segformer/: la patch centrata ha al centro il pixel mappa che
+# contiene il punto (tile scaricate sostituite da tile finte).
+
+import asyncio
+import importlib.util
+import os
+import numpy as np
+import pytest
+from supporto import TileFinte, punti_italia, ref_global_px
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _carica_script(path):
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.mark.parametrize("script", [
+    "segformer/prepare_features_dataset/prepare_feature_dataset.py",
+    "segformer/arricchimento_modello.py",
+])
+def test_script_dataset_patch_centrata(script, rng, monkeypatch):
+    for dep in ("aiohttp", "async_timeout", "pandas"):
+        pytest.importorskip(dep)
+    if script.endswith("arricchimento_modello.py"):
+        pytest.importorskip("sklearn")
+    from PIL import Image
+
+    module = _carica_script(os.path.join(REPO_DIR, script))
+    provider = TileFinte()
+
+    async def fetch_tile(session, z, x, y, *args, **kwargs):
+        return Image.fromarray(provider.tile(x, y))
+
+    monkeypatch.setattr(module, "fetch_tile", fetch_tile)
+    for _ in range(20):
+        lat, lng = (float(v[0]) for v in punti_italia(rng, 1))
+        z, out_px = int(rng.integers(14, 20)), int(rng.choice([256, 512, 768]))
+        patch = np.asarray(asyncio.run(module.fetch_centered_patch(None, lat, lng, z, out_px)))
+        # Il pixel centrale della patch è il pixel mappa che contiene (lat, lng)
+        x, y = ref_global_px(lat, lng, z)
+        cx, cy = int(x), int(y)
+        assert tuple(patch[out_px // 2, out_px // 2]) == (cx % 256, cy % 256, TileFinte.firma(cx // 256, cy // 256))
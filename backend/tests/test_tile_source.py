@@ -0,0 +1,37 @@
+# backend/tests/test_tile_source.py
+#
+# build_crop di tile_source: ogni pixel della crop è il pixel mappa che la proiezione
+# condivisa assegna alla sua posizione (tile finte che codificano offset e tile nei pixel).
+
+import asyncio
+import math
+import numpy as np
+from mercator import TILE_SIZE, crop_px_to_latlng, latlng_to_global_px
+from supporto import TileFinte, punti_italia
+
+
+def test_tile_source_crop_mostra_il_pixel_proiettato(rng):
+    from armonizzazione_single_cabin.tile_source import build_crop
+
+    provider = TileFinte()
+    for _ in range(40):
+        lat, lng = (float(v[0]) for v in punti_italia(rng, 1))
+        zoom = float(rng.uniform(14.0, 19.9))
+        bearing = float(rng.choice([0.0, rng.uniform(-180.0, 180.0)]))
+        w, h = int(rng.integers(120, 400)), int(rng.integers(120, 400))
+        crop = asyncio.run(build_crop(provider, lat, lng, zoom, w, bearing, height=h))
+        assert crop.shape == (h, w, 3)
+
+        # Pixel della crop -> lat/lng come li legge coord_optimizer -> pixel delle tile.
+        # Si leggono solo i pixel lontani dai bordi delle tile, dove l'interpolazione
+        # bilineare non mescola tile diverse: lì il valore è l'offset nella tile
+        ix, iy = rng.integers(10, w - 10, 50), rng.integers(10, h - 10, 50)
+        z = min(provider.max_zoom, math.ceil(zoom))
+        gx, gy = latlng_to_global_px(*crop_px_to_latlng(ix, iy, lat, lng, zoom, w, h, bearing=bearing), z)
+        fx, fy = gx % TILE_SIZE, gy % TILE_SIZE
+        ok = (fx > 2) & (fx < TILE_SIZE - 3) & (fy > 2) & (fy < TILE_SIZE - 3)
+        got = crop[iy[ok], ix[ok]].astype(float)
+        assert np.all(np.abs(got[:, 0] - fx[ok]) <= 0.6)
+        assert np.all(np.abs(got[:, 1] - fy[ok]) <= 0.6)
+        tx, ty = (gx[ok] // TILE_SIZE).astype(int), (gy[ok] // TILE_SIZE).astype(int)
+        assert np.array_equal(got[:, 2], TileFinte.firma(tx, ty))
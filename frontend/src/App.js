@@ -6,7 +6,6 @@ import BatchConsole from "./batch/BatchConsole";
 import { useBatchRunner } from "./batch/useBatchRunner";
 import "leaflet/dist/leaflet.css";
 import "./App.css";
-import MarkerClusterGroup from 'react-leaflet-markercluster';
 import 'leaflet.markercluster/dist/MarkerCluster.css';
 import 'leaflet.markercluster/dist/MarkerCluster.Default.css';
 import html2canvas from 'html2canvas';
@@ -127,6 +126,16 @@ function uniqueSorted(arr) {
 }
 
 // -- ICON
+// Cluster di /cabine/clusters: stesse classi CSS di leaflet.markercluster (MarkerCluster.Default.css)
+function clusterIcon(count) {
+  const size = count < 10 ? "small" : count < 100 ? "medium" : "large";
+  return L.divIcon({
+    html: `<div><span>${count}</span></div>`,
+    className: `marker-cluster marker-cluster-${size}`,
+    iconSize: L.point(40, 40),
+  });
+}
+
 const blueIcon = new L.Icon({
   iconUrl: "https://raw.githubusercontent.com/pointhi/leaflet-color-markers/master/img/marker-icon-blue.png",
   shadowUrl: "https://cdnjs.cloudflare.com/ajax/libs/leaflet/0.7.7/images/marker-shadow.png",
@@ -636,7 +645,7 @@ function rotatePolygonCoords(points, map, angleDeg) {
 }
 
 
-function MapView({ coords, polygonData, cabine, mapRef, setCenterCoords, hideMarkers, armonizedMarker, setZoomLevel, setLat, setLng, setIdCabina, lat, lng, idCabina, setMapBounds, filtroArea, fetchSeq, setSelectedFromMarker }) {
+function MapView({ coords, polygonData, clusters, mapRef, setCenterCoords, hideMarkers, armonizedMarker, setZoomLevel, setLat, setLng, setIdCabina, lat, lng, idCabina, setMapBounds, setSelectedFromMarker }) {
 
     console.log("MapView polygonData:", polygonData);
   return (
@@ -673,9 +682,18 @@ function MapView({ coords, polygonData, cabine, mapRef, setCenterCoords, hideMar
          />
 
 
-      {!hideMarkers && (
-        <MarkerClusterGroup key={`${filtroArea || 'ALL'}|${fetchSeq}`}>
-          {cabine.map((cab, idx) => (
+      {/* Solo la vista corrente: cluster calcolati dal backend (GET /cabine/clusters) */}
+      {!hideMarkers && clusters.map((cab) => (
+          cab.cluster ? (
+            <Marker
+              key={`c${cab.lat},${cab.lng}`}
+              position={[cab.lat, cab.lng]}
+              icon={clusterIcon(cab.count)}
+              eventHandlers={{
+                  click: () => mapRef.current?.setView([cab.lat, cab.lng], cab.expansion_zoom)
+                }}
+            />
+          ) : (
             <Marker
               key={cab.chk || `${cab.lat},${cab.lng}`}
               position={[cab.lat, cab.lng]}
@@ -696,9 +714,8 @@ function MapView({ coords, polygonData, cabine, mapRef, setCenterCoords, hideMar
                 Lng: {cab.lng.toFixed(6)}
               </Popup>
             </Marker>
-          ))}
-        </MarkerClusterGroup>
-      )}
+          )
+      ))}
         {/* Marker verde per nuova coordinata armonizzata */}
         {!hideMarkers && armonizedMarker && (
               <Marker
@@ -895,6 +912,7 @@ function App() {
   const [zoomLevel, setZoomLevel] = useState(6);  // Zoom iniziale
   const [polygonData, setPolygonData] = useState(null);
   const [cabine, setCabine] = useState([]);
+  const [clusters, setClusters] = useState([]);
   const [armonizedMarker, setArmonizedMarker] = useState(null);
   // const [autoZoom, setAutoZoom] = useState(false);
   const [captureMode, setCaptureMode] = useState(false);
@@ -904,6 +922,7 @@ function App() {
   const [pendingFlyTo, setPendingFlyTo] = useState(null); // [coords, zoom]
   const mapRef = useRef(null);
   const fetchSeqRef = useRef(0);
+  const clusterSeqRef = useRef(0);
   const [rotation, setRotation] = useState(0);
   const [hideMarkers, setHideMarkers] = useState(false);
   const [consoleOpen, setConsoleOpen] = useState(false);
@@ -1027,6 +1046,45 @@ function App() {
       return () => controller.abort();
     }, [filtroTipoCabina, filtroArea, filtroRegione, filtroProvincia]);
 
+    // Marker della mappa: cluster della vista corrente con gli stessi filtri, ricaricati a
+    // ogni fine spostamento/zoom (BoundsTracker aggiorna mapBounds su moveend e zoomend)
+    useEffect(() => {
+      const map = mapRef.current;
+      if (!mapBounds || !map || filtroTipoCabina.size === 0) {
+        setClusters([]);
+        return;
+      }
+      const controller = new AbortController();
+      const mySeq = ++clusterSeqRef.current;
+
+      const url = new URL("http://localhost:8000/cabine/clusters");
+      url.searchParams.set("bbox", [mapBounds.getWest(), mapBounds.getSouth(), mapBounds.getEast(), mapBounds.getNorth()].join(","));
+      url.searchParams.set("zoom", map.getZoom());
+      [...filtroTipoCabina].forEach(t => url.searchParams.append("tipo", t));
+      if (filtroArea) url.searchParams.set("area_regionale", filtroArea);
+      if (filtroRegione) url.searchParams.set("regione", filtroRegione);
+      if (filtroProvincia && filtroProvincia.trim().length === 2) {
+        url.searchParams.set("provincia", filtroProvincia.trim().toUpperCase());
+      }
+
+      fetch(url.toString(), { signal: controller.signal, cache: "no-store" })
+        .then(r => r.ok ? r.json() : Promise.reject(new Error(r.statusText)))
+        .then(data => {
+          if (mySeq !== clusterSeqRef.current) return;
+          const rows = Array.isArray(data.data) ? data.data : [];
+          setClusters(rows.map(c => ({ ...c, lat: +c.lat, lng: +c.lng }))
+                          .filter(c => Number.isFinite(c.lat) && Number.isFinite(c.lng)));
+        })
+        .catch(err => {
+          if (err.name === "AbortError") return;
+          if (mySeq !== clusterSeqRef.current) return;
+          console.warn("fetch cabine/clusters", err);
+          setClusters([]);
+        });
+
+      return () => controller.abort();
+    }, [mapBounds, filtroTipoCabina, filtroArea, filtroRegione, filtroProvincia]);
+
     // --- CARICA AREE in base ai TIPI selezionati
     useEffect(() => {
       if (filtroTipoCabina.size === 0) {
@@ -1336,11 +1394,9 @@ function App() {
           setIdCabina={setIdCabina}
           lat={lat}
           lng={lng}
-          cabine={cabineFiltrate}
+          clusters={clusters}
           idCabina={idCabina}
           setMapBounds={setMapBounds}
-          filtroArea={filtroArea}
-          fetchSeq={fetchSeqRef.current}
           setSelectedFromMarker={setSelectedFromMarker}
         />
       </div>
@@ -2,7 +2,6 @@
 import html2canvas from "html2canvas";
 import * as XLSX from "xlsx";
 import { BATCH_SETTINGS } from "./config";
-import { convertPolygonData } from "../utils/geo";
 import { captureMapShot, waitForMapToSettleStrict } from "../utils/capture-guards";
 
 export function useBatchRunner({
@@ -214,23 +213,28 @@ async function scatta(map, settings) {
 }
 
   // ---------- chiamata AI ----------
-  async function segmenta({ image, center, crop, zoom }, setLogs) {
-    const res = await fetch("http://localhost:8000/segmenta", {
+  async function segmenta({ image, center, crop, zoom, bearing }, setLogs) {
+    // invio binario: niente base64 dentro il JSON (circa 33% di byte in meno per hop)
+    const blob = await (await fetch(image)).blob();
+    const params = new URLSearchParams({
+      lat: center[0],
+      lng: center[1],
+      crop_width: crop,
+      crop_height: crop,
+      zoom,
+      bearing: bearing ?? 0,
+      // poligoni già in [lat,lng] con mq calcolati dal server
+      format: "geo",
+    });
+    const res = await fetch(`http://localhost:8000/segmenta_bin?${params}`, {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({
-        image,
-        lat: center[0],
-        lng: center[1],
-        crop_width: crop,
-        crop_height: crop,
-        zoom,
-      }),
+      headers: { "Content-Type": blob.type || "image/jpeg" },
+      body: blob,
     });
     const data = await res.json();
-    if (!res.ok || !data?.poligoni)
-      throw new Error(data?.detail || "segmentazione fallita");
-    return data.poligoni;
+    if (!res.ok || !data?.poligoni_geo)
+      throw new Error(data?.detail || data?.errore || "segmentazione fallita");
+    return data.poligoni_geo;
   }
 
   // ---------- excel ----------
@@ -284,27 +288,19 @@ async function scatta(map, settings) {
         const centerCoords = getCenterCoords(); // letti dall’overlay live
 
         const tSeg0 = performance.now();
-        const poligoniPx = await segmenta(
+        const converted = await segmenta(
           {
             image: shot.dataUrl,
             center: centerCoords,
             crop: shot.crop,
             zoom: shot.zoom,
+            bearing: shot.bearing,
           },
           ui.setLogs
         );
         const tSeg = Math.round(performance.now() - tSeg0);
         pushLog(ui.setLogs, `⏱️ segmenta: ${tSeg} ms`);
 
-        const converted = convertPolygonData(poligoniPx, {
-          crop_width: shot.crop,
-          crop_height: shot.crop,
-          zoom: shot.zoom,
-          centerLat: centerCoords[0],
-          centerLng: centerCoords[1],
-          bearing: shot.bearing,
-        });
-
         converted.forEach((p) => {
           outRows.push({
             chk: c.chk,